@@ -86,6 +86,7 @@ setuptools.setup(
     ],
     install_requires = [
         'numpy',
+        'scipy',
         'utillib[cache,options,interpolate,cholmod]',
         'measurements',
     ],
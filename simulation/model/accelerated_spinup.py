@@ -0,0 +1,118 @@
+import numpy as np
+
+import util.logging
+
+import simulation.model.constants
+import simulation.model.job
+import simulation.model.warm_start
+
+logger = util.logging.logger
+
+
+
+class Anderson_Accelerator:
+
+    ## anderson acceleration of the fixed point iteration x = g(x) with the last memory differences
+
+    def __init__(self, memory=None, regularization=None, restart_factor=None):
+        if memory is None:
+            memory = simulation.model.constants.MODEL_SPINUP_ACCELERATION_MEMORY
+        if regularization is None:
+            regularization = simulation.model.constants.MODEL_SPINUP_ACCELERATION_REGULARIZATION
+        if restart_factor is None:
+            restart_factor = simulation.model.constants.MODEL_SPINUP_ACCELERATION_RESTART_FACTOR
+        self.memory = memory
+        self.regularization = regularization
+        self.restart_factor = restart_factor
+        self.restart()
+
+
+    def __str__(self):
+        return 'Anderson_Accelerator(memory={}, history={})'.format(self.memory, len(self._delta_f))
+
+
+    def restart(self):
+        self._last_f = None
+        self._last_g = None
+        self._delta_f = []
+        self._delta_g = []
+
+
+    def update(self, x, g):
+        ## add iterate x with its fixed point map value g to the history
+        x = np.asarray(x, dtype=np.float64)
+        g = np.asarray(g, dtype=np.float64)
+        f = g - x
+        f_norm = np.linalg.norm(f)
+
+        ## restart if residual grows
+        if self._last_f is not None and f_norm > self.restart_factor * np.linalg.norm(self._last_f):
+            logger.debug('{}: Residual norm {} increased. Restarting.'.format(self, f_norm))
+            self.restart()
+
+        ## update differences
+        if self._last_f is not None:
+            self._delta_f.append(f - self._last_f)
+            self._delta_g.append(g - self._last_g)
+            if len(self._delta_f) > self.memory:
+                self._delta_f.pop(0)
+                self._delta_g.pop(0)
+        self._last_f = f
+        self._last_g = g
+        return f
+
+
+    def next_state(self, x, g):
+        f = self.update(x, g)
+        f_norm = np.linalg.norm(f)
+
+        ## plain fixed point step without history
+        if len(self._delta_f) == 0:
+            return g
+
+        ## solve regularized least squares problem min ||f - delta_f gamma||
+        delta_f = np.array(self._delta_f).T
+        delta_g = np.array(self._delta_g).T
+        A = delta_f.T.dot(delta_f)
+        A += self.regularization * np.trace(A) / len(A) * np.eye(len(A))
+        try:
+            gamma = np.linalg.solve(A, delta_f.T.dot(f))
+        except np.linalg.LinAlgError:
+            logger.debug('{}: Least squares problem is singular. Restarting.'.format(self))
+            self.restart()
+            return g
+
+        logger.debug('{}: Residual norm {} and coefficients {}.'.format(self, f_norm, gamma))
+        return g - delta_g.dot(gamma)
+
+
+
+## tracer vectors as one state vector
+
+def state_from_tracer_vectors(tracer_vectors):
+    return np.concatenate(tracer_vectors)
+
+
+def tracer_vectors_from_state(state, tracer_vectors_like):
+    split_indices = np.cumsum([len(tracer_vector) for tracer_vector in tracer_vectors_like])[:-1]
+    return np.split(state, split_indices)
+
+
+def run_input_and_output_tracer_vectors(run_dir):
+    with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+        tracer_input_files = job.tracer_input_files
+        tracer_output_files = job.tracer_output_files
+    if len(tracer_input_files) == 0:
+        tracer_input_vectors = None
+    else:
+        tracer_input_vectors = simulation.model.warm_start.load_tracer_vectors(tracer_input_files)
+    tracer_output_vectors = simulation.model.warm_start.load_tracer_vectors(tracer_output_files)
+    return (tracer_input_vectors, tracer_output_vectors)
+
+
+def update_accelerator_with_runs(accelerator, run_dirs):
+    ## add finished runs in chronological order to the history (runs without tracer input are skipped)
+    for run_dir in run_dirs:
+        tracer_input_vectors, tracer_output_vectors = run_input_and_output_tracer_vectors(run_dir)
+        if tracer_input_vectors is not None:
+            accelerator.update(state_from_tracer_vectors(tracer_input_vectors), state_from_tracer_vectors(tracer_output_vectors))
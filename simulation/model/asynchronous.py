@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import weakref
+
+import util.logging
+
+import simulation.model.constants
+import simulation.model.job
+
+logger = util.logging.logger
+
+
+
+class Job_Poller:
+
+    ## polls all outstanding jobs of one event loop in one task
+
+    def __init__(self, pause_seconds_min=None, pause_seconds_max=None):
+        if pause_seconds_min is None:
+            pause_seconds_min = simulation.model.constants.JOB_WAIT_PAUSE_SECONDS_MIN
+        if pause_seconds_max is None:
+            pause_seconds_max = simulation.model.constants.JOB_WAIT_PAUSE_SECONDS_MAX
+        self.pause_seconds_min = pause_seconds_min
+        self.pause_seconds_max = pause_seconds_max
+
+        self._futures = {}
+        self._task = None
+        self._new_job_event = None
+
+
+    def __str__(self):
+        return 'Job_Poller(outstanding_jobs={})'.format(len(self._futures))
+
+
+    def wait_until_finished(self, run_dir):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        ## register job
+        try:
+            self._futures[run_dir].append(future)
+        except KeyError:
+            self._futures[run_dir] = [future]
+        logger.debug('Job in {} registered at {}.'.format(run_dir, self))
+
+        ## start or wake up poll task
+        if self._task is None or self._task.done():
+            self._new_job_event = asyncio.Event()
+            self._task = loop.create_task(self._poll())
+        else:
+            self._new_job_event.set()
+
+        return future
+
+
+    def _is_finished(self, run_dir):
+        if simulation.model.job.is_reserved(run_dir):
+            return False
+        ## never wait for incomplete output, poll again instead
+        with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+            return job.is_finished(wait_until_output_written=False)
+
+
+    def _are_finished(self, run_dirs):
+        ## blocking (job status requests), so it is called in an executor
+        are_finished = {}
+        for run_dir in run_dirs:
+            try:
+                are_finished[run_dir] = self._is_finished(run_dir)
+            except Exception as exception:
+                are_finished[run_dir] = exception
+        return are_finished
+
+
+    async def _poll_once(self):
+        any_finished = False
+
+        are_finished = await run_blocking(self._are_finished, tuple(self._futures.keys()))
+
+        for run_dir, is_finished in are_finished.items():
+            if isinstance(is_finished, Exception):
+                futures = self._futures.pop(run_dir, ())
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(is_finished)
+            elif is_finished:
+                logger.debug('Job in {} finished.'.format(run_dir))
+                any_finished = True
+                futures = self._futures.pop(run_dir, ())
+                for future in futures:
+                    if not future.done():
+                        future.set_result(run_dir)
+
+        return any_finished
+
+
+    async def _poll(self):
+        pause_seconds = self.pause_seconds_min
+
+        while len(self._futures) > 0:
+            if await self._poll_once():
+                pause_seconds = self.pause_seconds_min
+
+            ## wait with exponential backoff or until new job is registered
+            if len(self._futures) > 0:
+                try:
+                    await asyncio.wait_for(self._new_job_event.wait(), timeout=pause_seconds)
+                except asyncio.TimeoutError:
+                    pause_seconds = min(pause_seconds * 2, self.pause_seconds_max)
+                else:
+                    pause_seconds = self.pause_seconds_min
+                self._new_job_event.clear()
+
+
+
+_JOB_POLLERS = weakref.WeakKeyDictionary()
+
+def job_poller():
+    loop = asyncio.get_event_loop()
+    try:
+        poller = _JOB_POLLERS[loop]
+    except KeyError:
+        poller = Job_Poller()
+        _JOB_POLLERS[loop] = poller
+    return poller
+
+
+
+class Job_Handle:
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+
+
+    def __str__(self):
+        return 'Job_Handle({})'.format(self.run_dir)
+
+
+    def __await__(self):
+        return self.wait_until_finished().__await__()
+
+
+    async def wait_until_finished(self):
+        await job_poller().wait_until_finished(self.run_dir)
+        return self.run_dir
+
+
+
+async def wait_until_finished(run_dir):
+    return await Job_Handle(run_dir)
+
+
+
+async def run_blocking(function, *args, **kargs):
+    ## run blocking function (file locks, job status requests, job submission) in the default executor of the event loop
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(function, *args, **kargs))
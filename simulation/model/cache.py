@@ -4,8 +4,10 @@ import numpy as np
 
 import measurements.universal.data
 
+import simulation.model.asynchronous
 import simulation.model.eval
 import simulation.model.constants
+import simulation.model.data
 
 import util.logging
 logger = util.logging.logger
@@ -95,6 +97,7 @@ class Cache:
             util.io.np.save_np_and_txt(file, value, make_read_only=True, overwrite=True)
         else:
             util.io.np.save(file, value, make_read_only=True, overwrite=True)
+        self.model._update_catalog('add_file', file, self.model.parameter_set_dir)
 
 
     def get_value(self, filename, calculate_function, derivative_used, save_also_txt=False, use_memmap=False, as_shared_array=False):
@@ -123,31 +126,100 @@ class Model_With_F_File_and_MemoryCached(simulation.model.eval.Model_With_F_Memo
     def __init__(self, *args, **kargs):
         super().__init__(*args, **kargs)
         self._cache = Cache(self)
+        self._interest_sets = {}
+        self.f_all_prefetch_time_dim = simulation.model.constants.DATABASE_F_ALL_PREFETCH_TIME_DIM
+        self.df_all_prefetch_time_dim = simulation.model.constants.DATABASE_DF_ALL_PREFETCH_TIME_DIM
+
+
+    def _concurrent_copy(self, model_options=None):
+        model = super()._concurrent_copy(model_options=model_options)
+        model._cache = Cache(model, cache_dirname=self._cache.cache_dirname)
+        return model
+
+
+    def _all_data_set_name(self, time_dim):
+        if self.trajectory_averaging_mode == 'snapshot':
+            return simulation.model.constants.DATABASE_ALL_SNAPSHOT_DATASET_NAME.format(time_dim=time_dim)
+        else:
+            return simulation.model.constants.DATABASE_ALL_DATASET_NAME.format(time_dim=time_dim)
     
     
+    ## temporal pyramid of boxes values (coarser time dims are averaged from cached finer time dims)
+
+    def _pyramid_prefetch_time_dim(self, derivative_used):
+        if derivative_used:
+            return self.df_all_prefetch_time_dim
+        else:
+            return self.f_all_prefetch_time_dim
+
+
+    def _pyramid_time_dims(self, time_dim):
+        ## finer time dims from which time dim can be averaged in increasing order
+        if self.trajectory_averaging_mode != 'average':
+            return []
+        time_steps_per_year = self.model_options.time_steps_per_year
+        return [finer_time_dim for finer_time_dim in range(2 * time_dim, time_steps_per_year + 1, time_dim) if time_steps_per_year % finer_time_dim == 0]
+
+
+    def _pyramid_calculation_time_dim(self, time_dim, derivative_used):
+        ## finest time dim up to the prefetch time dim from which time dim can be averaged (only if prefetching is enabled)
+        prefetch_time_dim = self._pyramid_prefetch_time_dim(derivative_used)
+        if prefetch_time_dim is None:
+            return time_dim
+        calculation_time_dims = [finer_time_dim for finer_time_dim in self._pyramid_time_dims(time_dim) if finer_time_dim <= prefetch_time_dim]
+        if len(calculation_time_dims) > 0:
+            return calculation_time_dims[-1]
+        else:
+            return time_dim
+
+
+    def _load_cached_value_for_boxes(self, time_dim, file_pattern, tracer, derivative_used):
+        ## load value for time dim or average value of cached finer time dim
+        file = file_pattern.format(tracer=tracer, data_set_name=self._all_data_set_name(time_dim))
+        if self._cache.has_value(file, derivative_used=derivative_used):
+            return self._cache.load_value(file, derivative_used=derivative_used)
+
+        for finer_time_dim in self._pyramid_time_dims(time_dim):
+            finer_file = file_pattern.format(tracer=tracer, data_set_name=self._all_data_set_name(finer_time_dim))
+            if self._cache.has_value(finer_file, derivative_used=derivative_used):
+                logger.debug('Averaging cached values for tracer {} with time dim {} to time dim {}.'.format(tracer, finer_time_dim, time_dim))
+                finer_value = self._cache.load_value(finer_file, derivative_used=derivative_used, use_memmap=True)
+                value = simulation.model.data.aggregate_trajectory(finer_value, time_dim_desired=time_dim)
+                self._cache.save_value(file, value, derivative_used=derivative_used)
+                return value
+
+        return None
+
+
     def _cached_values_for_boxes(self, time_dim, calculate_function_for_boxes, file_pattern, derivative_used, tracers=None):
         assert callable(calculate_function_for_boxes)
         tracers = self.check_tracers(tracers)
     
         ## load cached values from cache
-        data_set_name = simulation.model.constants.DATABASE_ALL_DATASET_NAME.format(time_dim=time_dim)
-
         results_dict = {}
         not_cached_tracers = []
         for tracer in tracers:
-            file = file_pattern.format(tracer=tracer, data_set_name=data_set_name)
-            if self._cache.has_value(file, derivative_used=derivative_used):
-                results_dict[tracer] = self._cache.load_value(file, derivative_used=derivative_used)
+            value = self._load_cached_value_for_boxes(time_dim, file_pattern, tracer, derivative_used)
+            if value is not None:
+                results_dict[tracer] = value
             else:
                 not_cached_tracers.append(tracer)
         
-        ## calculate not cached values
-        calculated_results_dict = calculate_function_for_boxes(time_dim, tracers=not_cached_tracers)
+        ## calculate not cached values (with finer time dim if prefetching is enabled)
+        if len(not_cached_tracers) > 0:
+            calculation_time_dim = self._pyramid_calculation_time_dim(time_dim, derivative_used)
+            calculated_results_dict = calculate_function_for_boxes(calculation_time_dim, tracers=not_cached_tracers)
+        else:
+            calculated_results_dict = {}
         
         ## save calculated values and store in result
         for tracer, tracer_values in calculated_results_dict.items():
-            file = file_pattern.format(tracer=tracer, data_set_name=data_set_name)
+            file = file_pattern.format(tracer=tracer, data_set_name=self._all_data_set_name(calculation_time_dim))
             self._cache.save_value(file, tracer_values, derivative_used=derivative_used)
+            if calculation_time_dim != time_dim:
+                tracer_values = simulation.model.data.aggregate_trajectory(tracer_values, time_dim_desired=time_dim)
+                file = file_pattern.format(tracer=tracer, data_set_name=self._all_data_set_name(time_dim))
+                self._cache.save_value(file, tracer_values, derivative_used=derivative_used)
             results_dict[tracer] = tracer_values
             
         ## return
@@ -200,8 +272,7 @@ class Model_With_F_File_and_MemoryCached(simulation.model.eval.Model_With_F_Memo
         return self._cached_values_for_points(points, calculate_function_for_points, file_pattern, derivative_used=False)
 
     
-    def _cached_values_for_measurements(self, calculate_function_for_points, *measurements_list):
-        ## get base measurements
+    def _base_measurements_list(self, *measurements_list):
         not_base_measurements_list = measurements_list
         base_measurements_list = []
         
@@ -215,6 +286,18 @@ class Model_With_F_File_and_MemoryCached(simulation.model.eval.Model_With_F_Memo
                 else:
                     base_measurements_list.append(current_measurements)
             not_base_measurements_list = new_not_base_measurements_list
+
+        return base_measurements_list
+
+
+    def _has_cached_values_for_measurements(self, file_pattern, derivative_used, *measurements_list):
+        base_measurements_list = self._base_measurements_list(*measurements_list)
+        return all(self._cache.has_value(file_pattern.format(tracer=base_measurements.tracer, data_set_name=base_measurements.data_set_name), derivative_used=derivative_used) for base_measurements in base_measurements_list)
+
+
+    def _cached_values_for_measurements(self, calculate_function_for_points, *measurements_list):
+        ## get base measurements
+        base_measurements_list = self._base_measurements_list(*measurements_list)
         
         ## calculate results for base measurements (using caching)
         base_measurements_collection = measurements.universal.data.MeasurementsCollection(*base_measurements_list)
@@ -257,6 +340,131 @@ class Model_With_F_File_and_MemoryCached(simulation.model.eval.Model_With_F_Memo
         return self._cached_values_for_measurements(self.f_points, *measurements_list)
 
 
+    ## interest sets (evaluated with each trajectory of a matching run and saved in the cache)
+
+    def register_interest_set(self, name, measurements_list=(), time_dims=()):
+        logger.debug('Registering interest set {} with measurements {} and time dims {}.'.format(name, tuple(map(str, measurements_list)), time_dims))
+        base_measurements_list = self._base_measurements_list(*measurements_list)
+        self._interest_sets[name] = (tuple(base_measurements_list), tuple(int(time_dim) for time_dim in time_dims))
+
+
+    def unregister_interest_set(self, name):
+        logger.debug('Unregistering interest set {}.'.format(name))
+        del self._interest_sets[name]
+
+
+    @property
+    def interest_sets(self):
+        return tuple(self._interest_sets.keys())
+
+
+    def _not_cached_interest_values(self, file_pattern):
+        ## base measurements and time dims of all interest sets without cached values
+        not_cached_measurements = {}
+        not_cached_time_dims = set()
+        for base_measurements_list, time_dims in self._interest_sets.values():
+            for base_measurements in base_measurements_list:
+                key = (base_measurements.tracer, base_measurements.data_set_name)
+                if key not in not_cached_measurements and not self._cache.has_value(file_pattern.format(tracer=base_measurements.tracer, data_set_name=base_measurements.data_set_name), derivative_used=False):
+                    not_cached_measurements[key] = base_measurements
+            for time_dim in time_dims:
+                if any(not self._cache.has_value(file_pattern.format(tracer=tracer, data_set_name=self._all_data_set_name(time_dim)), derivative_used=False) for tracer in self.model_options.tracers):
+                    not_cached_time_dims.add(time_dim)
+        return (list(not_cached_measurements.values()), sorted(not_cached_time_dims))
+
+
+    def _capture_trajectory(self, trajectory_output_dir):
+        if len(self._interest_sets) == 0:
+            return
+        file_pattern = os.path.join(simulation.model.constants.DATABASE_POINTS_OUTPUT_DIRNAME, simulation.model.constants.DATABASE_F_FILENAME)
+        not_cached_measurements_list, not_cached_time_dims = self._not_cached_interest_values(file_pattern)
+
+        ## boxes values are only available for averages since all time steps are written
+        if self.trajectory_averaging_mode != 'average':
+            not_cached_time_dims = []
+        if len(not_cached_measurements_list) == 0 and len(not_cached_time_dims) == 0:
+            return
+        logger.debug('Capturing values for {} measurements and time dims {} of interest sets from trajectory in {}.'.format(len(not_cached_measurements_list), not_cached_time_dims, trajectory_output_dir))
+
+        ## prepare load function for points
+        if len(not_cached_measurements_list) > 0:
+            points_dict = measurements.universal.data.MeasurementsCollection(*not_cached_measurements_list).points_dict
+            points, split_dict = self._merge_data_sets(points_dict)
+            trajectory_load_function_for_points = self._trajectory_load_function_for_points(points)
+        else:
+            points = {}
+
+        ## evaluate each tracer
+        try:
+            for tracer in self.model_options.tracers:
+                trajectory_loader = simulation.model.data.trajectory_loader_for_files(trajectory_output_dir, tracer)
+
+                for time_dim in not_cached_time_dims:
+                    file = file_pattern.format(tracer=tracer, data_set_name=self._all_data_set_name(time_dim))
+                    if not self._cache.has_value(file, derivative_used=False):
+                        self._cache.save_value(file, self._trajectory_load_function_for_all(time_dim)(trajectory_loader, tracer=tracer), derivative_used=False)
+
+                if tracer in points:
+                    tracer_values = trajectory_load_function_for_points(trajectory_loader, tracer=tracer)
+                    tracer_values_dict = self._split_data_sets({tracer: tracer_values}, split_dict)[tracer]
+                    for data_set_name, data_set_values in tracer_values_dict.items():
+                        self._cache.save_value(file_pattern.format(tracer=tracer, data_set_name=data_set_name), data_set_values, derivative_used=False)
+        except OSError as exception:
+            logger.warn('Values of interest sets could not be saved: {}'.format(exception))
+
+
+    ## batch evaluation for multiple parameters
+
+    def _for_each_parameters(self, parameters_list, function):
+        old_parameters = self.model_options.parameters
+        results = []
+        try:
+            for parameters in parameters_list:
+                self.model_options.parameters = parameters
+                results.append(function())
+        finally:
+            self.model_options.parameters = old_parameters
+        return results
+
+
+    def _start_spinup_runs_batch(self, parameters_list):
+        logger.debug('Starting missing spinup runs for {} parameter sets.'.format(len(parameters_list)))
+        return self._for_each_parameters(parameters_list, self.start_matching_run)
+
+
+    def f_measurements_batch(self, parameters_list, *measurements_list):
+        logger.debug('Calculating f values for {} parameter sets and measurements {}.'.format(len(parameters_list), tuple(map(str, measurements_list))))
+
+        ## start all missing spinups without waiting
+        self._start_spinup_runs_batch(parameters_list)
+
+        ## wait for spinups and calculate values in input order
+        return self._for_each_parameters(parameters_list, lambda: self.f_measurements(*measurements_list))
+
+
+    ## asynchronous evaluation
+
+    async def f_measurements_async(self, *measurements_list):
+        logger.debug('Calculating f values asynchronously for measurements {}.'.format(tuple(map(str, measurements_list))))
+        ## evaluated with an own copy of the model options, so concurrent evaluations do not interfere
+        model = self._concurrent_copy()
+
+        ## wait for spinup
+        run_dir = await model.matching_run_dir_async()
+
+        ## wait for trajectory if values are not cached
+        file_pattern = os.path.join(simulation.model.constants.DATABASE_POINTS_OUTPUT_DIRNAME, simulation.model.constants.DATABASE_F_FILENAME)
+        prepared_trajectory_keys = []
+        if not await simulation.model.asynchronous.run_blocking(model._has_cached_values_for_measurements, file_pattern, False, *measurements_list):
+            prepared_trajectory_keys.append(await model._prepare_trajectory_async(run_dir, model.model_options.parameters))
+
+        ## calculate values with finished runs
+        try:
+            return await simulation.model.asynchronous.run_blocking(model.f_measurements, *measurements_list)
+        finally:
+            model._remove_prepared_trajectories(prepared_trajectory_keys)
+
+
 
 
 class Model_With_F_And_DF_File_and_MemoryCached(Model_With_F_File_and_MemoryCached, simulation.model.eval.Model_With_F_And_DF_MemoryCached):
@@ -281,4 +489,46 @@ class Model_With_F_And_DF_File_and_MemoryCached(Model_With_F_File_and_MemoryCach
         return self._cached_values_for_measurements(calculate_function_for_points, *measurements_list)
 
 
+    def df_measurements_batch(self, parameters_list, *measurements_list, partial_derivative_kind='model_parameters'):
+        logger.debug('Calculating df values for {} parameter sets, measurements {} and partial_derivative_kind {}.'.format(len(parameters_list), tuple(map(str, measurements_list)), partial_derivative_kind))
+
+        ## start all missing spinups without waiting
+        self._start_spinup_runs_batch(parameters_list)
+
+        ## wait for spinups and start all missing partial derivative runs without waiting
+        file_pattern = os.path.join(simulation.model.constants.DATABASE_POINTS_OUTPUT_DIRNAME, simulation.model.constants.DATABASE_DF_FILENAME.format(derivative_kind=partial_derivative_kind))
+
+        def start_partial_derivative_runs_if_needed():
+            if not self._has_cached_values_for_measurements(file_pattern, True, *measurements_list):
+                self.start_partial_derivative_runs(partial_derivative_kind=partial_derivative_kind)
+
+        self._for_each_parameters(parameters_list, start_partial_derivative_runs_if_needed)
+
+        ## wait for partial derivative runs and calculate values in input order
+        return self._for_each_parameters(parameters_list, lambda: self.df_measurements(*measurements_list, partial_derivative_kind=partial_derivative_kind))
+
+
+    ## asynchronous evaluation
+
+    async def df_measurements_async(self, *measurements_list, partial_derivative_kind='model_parameters'):
+        logger.debug('Calculating df values asynchronously for measurements {} and partial_derivative_kind {}.'.format(tuple(map(str, measurements_list)), partial_derivative_kind))
+        ## evaluated with an own copy of the model options, so concurrent evaluations do not interfere
+        model = self._concurrent_copy()
+
+        ## wait for spinup
+        await model.matching_run_dir_async()
+
+        ## wait for partial derivative runs and their trajectories if values are not cached
+        file_pattern = os.path.join(simulation.model.constants.DATABASE_POINTS_OUTPUT_DIRNAME, simulation.model.constants.DATABASE_DF_FILENAME.format(derivative_kind=partial_derivative_kind))
+        prepared_trajectory_keys = []
+        if not await simulation.model.asynchronous.run_blocking(model._has_cached_values_for_measurements, file_pattern, True, *measurements_list):
+            prepared_trajectory_keys = await model._prepare_partial_derivative_trajectories_async(partial_derivative_kind)
+
+        ## calculate values with finished runs
+        try:
+            return await simulation.model.asynchronous.run_blocking(model.df_measurements, *measurements_list, partial_derivative_kind=partial_derivative_kind)
+        finally:
+            model._remove_prepared_trajectories(prepared_trajectory_keys)
+
+
 Model = Model_With_F_And_DF_File_and_MemoryCached
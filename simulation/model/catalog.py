@@ -0,0 +1,261 @@
+import argparse
+import contextlib
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+import util.pattern
+import util.logging
+
+import simulation.model.constants
+
+logger = util.logging.logger
+
+
+
+def parameter_set_dir_of(path):
+    ## the parameter set dir containing the passed path
+    DATABASE_PARAMETERS_DIRNAME_REGULAR_EXPRESSION = util.pattern.convert_format_string_in_regular_expression(simulation.model.constants.DATABASE_PARAMETERS_DIRNAME)
+    path = os.path.normpath(path)
+    while True:
+        (parent_path, basename) = os.path.split(path)
+        if re.fullmatch(DATABASE_PARAMETERS_DIRNAME_REGULAR_EXPRESSION, basename) is not None:
+            return path
+        if parent_path == path:
+            return None
+        path = parent_path
+
+
+def run_kind(run_dir):
+    if os.path.basename(os.path.dirname(os.path.normpath(run_dir))) == simulation.model.constants.DATABASE_SPINUP_DIRNAME:
+        return 'spinup'
+    else:
+        return 'derivative'
+
+
+
+class Catalog:
+
+    ## sqlite catalog of parameter sets, runs and cached value files of the database
+    ## (rollback journal instead of write ahead log since the database is usually on a parallel file system)
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS parameter_sets (dir TEXT PRIMARY KEY, model_name TEXT, concentrations_kind TEXT, concentrations_index INTEGER, concentrations TEXT, time_step INTEGER, parameter_set_index INTEGER, parameters TEXT)',
+        'CREATE INDEX IF NOT EXISTS parameter_sets_model ON parameter_sets (model_name, time_step)',
+        'CREATE TABLE IF NOT EXISTS runs (dir TEXT PRIMARY KEY, parent_dir TEXT, parameter_set_dir TEXT, kind TEXT, run_index INTEGER, years INTEGER, cumulative_years INTEGER, tolerance REAL, finished INTEGER)',
+        'CREATE INDEX IF NOT EXISTS runs_parameter_set ON runs (parameter_set_dir)',
+        'CREATE INDEX IF NOT EXISTS runs_parent ON runs (parent_dir, run_index)',
+        'CREATE TABLE IF NOT EXISTS files (file TEXT PRIMARY KEY, parameter_set_dir TEXT, modified_time REAL)',
+        'CREATE INDEX IF NOT EXISTS files_parameter_set ON files (parameter_set_dir)',
+    )
+
+    def __init__(self, file=None, timeout=None):
+        if file is None:
+            file = simulation.model.constants.DATABASE_CATALOG_FILE
+        if timeout is None:
+            timeout = simulation.model.constants.DATABASE_CATALOG_TIMEOUT
+        self.file = file
+        self.timeout = timeout
+        self._schema_created = False
+
+
+    def __str__(self):
+        return 'Catalog({})'.format(self.file)
+
+
+    @contextlib.contextmanager
+    def _connection(self):
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        connection = sqlite3.connect(self.file, timeout=self.timeout)
+        try:
+            with connection:
+                if not self._schema_created:
+                    for statement in self.SCHEMA:
+                        connection.execute(statement)
+                    self._schema_created = True
+                yield connection
+        finally:
+            connection.close()
+
+
+    @staticmethod
+    def _values_to_str(values):
+        if values is None:
+            return None
+        return ','.join(map(lambda value: simulation.model.constants.DATABASE_PARAMETERS_FORMAT_STRING.format(value), np.asarray(values).reshape(-1)))
+
+
+    @staticmethod
+    def _str_to_values(values_str):
+        if values_str is None:
+            return None
+        return np.array([float(value) for value in values_str.split(',')])
+
+
+    ## complete flag (set by rebuild, afterwards all writers keep the catalog up to date)
+
+    def is_complete(self):
+        with self._connection() as connection:
+            row = connection.execute('SELECT value FROM meta WHERE key = ?', ('complete',)).fetchone()
+        return row is not None and row[0] == '1'
+
+
+    def _set_complete(self, connection, complete):
+        connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('complete', '1' if complete else '0'))
+
+
+    def set_complete(self, complete):
+        with self._connection() as connection:
+            self._set_complete(connection, complete)
+
+
+    ## add and remove
+
+    def _add_parameter_set(self, connection, dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters):
+        ## values of vector concentrations are not stored (they are available with their index)
+        if concentrations_kind != 'constant':
+            concentrations = None
+        connection.execute('INSERT OR REPLACE INTO parameter_sets (dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (dir, model_name, concentrations_kind, int(concentrations_index), self._values_to_str(concentrations), int(time_step), int(parameter_set_index), self._values_to_str(parameters)))
+
+
+    def add_parameter_set(self, dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters):
+        logger.debug('{}: Adding parameter set {}.'.format(self, dir))
+        with self._connection() as connection:
+            self._add_parameter_set(connection, dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters)
+
+
+    def remove_parameter_set(self, dir):
+        logger.debug('{}: Removing parameter set {}.'.format(self, dir))
+        with self._connection() as connection:
+            connection.execute('DELETE FROM parameter_sets WHERE dir = ?', (dir,))
+            connection.execute('DELETE FROM runs WHERE parameter_set_dir = ?', (dir,))
+            connection.execute('DELETE FROM files WHERE parameter_set_dir = ?', (dir,))
+
+
+    def _add_run(self, connection, run_dir, parameter_set_dir, kind, run_index, years=None, cumulative_years=None, tolerance=None, finished=False):
+        connection.execute('INSERT OR REPLACE INTO runs (dir, parent_dir, parameter_set_dir, kind, run_index, years, cumulative_years, tolerance, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (run_dir, os.path.dirname(run_dir), parameter_set_dir, kind, int(run_index), years, cumulative_years, tolerance, int(finished)))
+
+
+    def add_run(self, run_dir, parameter_set_dir, kind, run_index, years=None, cumulative_years=None, tolerance=None, finished=False):
+        logger.debug('{}: Adding run {} with years {}, cumulative years {}, tolerance {} and finished {}.'.format(self, run_dir, years, cumulative_years, tolerance, finished))
+        with self._connection() as connection:
+            self._add_run(connection, run_dir, parameter_set_dir, kind, run_index, years=years, cumulative_years=cumulative_years, tolerance=tolerance, finished=finished)
+
+
+    def remove_run(self, run_dir):
+        logger.debug('{}: Removing run {}.'.format(self, run_dir))
+        with self._connection() as connection:
+            connection.execute('DELETE FROM runs WHERE dir = ?', (run_dir,))
+
+
+    def remove_runs_from(self, parent_dir, run_index):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM runs WHERE parent_dir = ? AND run_index >= ?', (parent_dir, int(run_index)))
+
+
+    def _add_file(self, connection, file, parameter_set_dir):
+        try:
+            modified_time = os.path.getmtime(file)
+        except OSError:
+            modified_time = None
+        connection.execute('INSERT OR REPLACE INTO files (file, parameter_set_dir, modified_time) VALUES (?, ?, ?)', (file, parameter_set_dir, modified_time))
+
+
+    def add_file(self, file, parameter_set_dir):
+        with self._connection() as connection:
+            self._add_file(connection, file, parameter_set_dir)
+
+
+    ## queries
+
+    def parameter_sets(self, model_names=None, time_steps=None):
+        ## (dir, model name, concentrations kind, concentrations index, constant concentrations, time step, parameter set index, parameters)
+        query = 'SELECT dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters FROM parameter_sets'
+        conditions = []
+        arguments = []
+        if model_names is not None:
+            conditions.append('model_name IN ({})'.format(','.join('?' * len(model_names))))
+            arguments.extend(model_names)
+        if time_steps is not None:
+            conditions.append('time_step IN ({})'.format(','.join('?' * len(time_steps))))
+            arguments.extend(int(time_step) for time_step in time_steps)
+        if len(conditions) > 0:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY model_name, concentrations_kind, concentrations_index, time_step, parameter_set_index'
+
+        with self._connection() as connection:
+            rows = connection.execute(query, arguments).fetchall()
+        return [(dir, model_name, concentrations_kind, concentrations_index, self._str_to_values(concentrations), time_step, parameter_set_index, self._str_to_values(parameters)) for (dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters) in rows]
+
+
+    def runs(self, parameter_set_dir=None, kind=None, finished=None):
+        ## (dir, parameter set dir, kind, run index, years, cumulative years, tolerance, finished)
+        query = 'SELECT dir, parameter_set_dir, kind, run_index, years, cumulative_years, tolerance, finished FROM runs'
+        conditions = []
+        arguments = []
+        if parameter_set_dir is not None:
+            conditions.append('parameter_set_dir = ?')
+            arguments.append(parameter_set_dir)
+        if kind is not None:
+            conditions.append('kind = ?')
+            arguments.append(kind)
+        if finished is not None:
+            conditions.append('finished = ?')
+            arguments.append(int(finished))
+        if len(conditions) > 0:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY parent_dir, run_index'
+
+        with self._connection() as connection:
+            rows = connection.execute(query, arguments).fetchall()
+        return [(dir, parameter_set_dir, kind, run_index, years, cumulative_years, tolerance, bool(finished)) for (dir, parameter_set_dir, kind, run_index, years, cumulative_years, tolerance, finished) in rows]
+
+
+    def files(self, parameter_set_dir=None):
+        query = 'SELECT file FROM files'
+        arguments = []
+        if parameter_set_dir is not None:
+            query += ' WHERE parameter_set_dir = ?'
+            arguments.append(parameter_set_dir)
+        query += ' ORDER BY file'
+
+        with self._connection() as connection:
+            rows = connection.execute(query, arguments).fetchall()
+        return [file for (file,) in rows]
+
+
+    ## rebuild
+
+    def rebuild(self, parameter_sets, runs, files):
+        ## replace all entries in one transaction (lists of the argument tuples of add_parameter_set, add_run and add_file)
+        logger.debug('{}: Rebuilding with {} parameter sets, {} runs and {} files.'.format(self, len(parameter_sets), len(runs), len(files)))
+        with self._connection() as connection:
+            connection.execute('DELETE FROM parameter_sets')
+            connection.execute('DELETE FROM runs')
+            connection.execute('DELETE FROM files')
+            for parameter_set in parameter_sets:
+                self._add_parameter_set(connection, *parameter_set)
+            for run in runs:
+                self._add_run(connection, *run)
+            for file in files:
+                self._add_file(connection, *file)
+            self._set_complete(connection, True)
+
+
+
+if __name__ == "__main__":
+    ## configure arguments
+    parser = argparse.ArgumentParser(description='Catalog of the simulation database.')
+    parser.add_argument('-r', '--rebuild', action='store_true', help='Rebuild the catalog by searching the whole database.')
+    parser.add_argument('-d', '--debug_level', choices=util.logging.LEVELS, default='INFO', help='Print debug infos low to passed level.')
+    args = parser.parse_args()
+    ## run
+    with util.logging.Logger(level=args.debug_level):
+        if args.rebuild:
+            import simulation.model.eval
+            simulation.model.eval.Model().rebuild_catalog()
+        catalog = Catalog()
+        logger.info('{} is complete: {}, parameter sets: {}, runs: {}, files: {}.'.format(catalog, catalog.is_complete(), len(catalog.parameter_sets()), len(catalog.runs()), len(catalog.files())))
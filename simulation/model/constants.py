@@ -12,6 +12,7 @@ from simulation.constants import METOS3D_DIR, METOS3D_DIR_ENV_NAME
 ## METOS 3D
 METOS_DATA_DIR = os.path.join(METOS3D_DIR, 'data', 'data', 'TMM', '2.8')
 METOS_DATA_DIR_ENV = os.path.join('${{{}}}'.format(METOS3D_DIR_ENV_NAME), 'data', 'data', 'TMM', '2.8')
+METOS_VOLUMES_FILE = os.path.join(METOS_DATA_DIR, 'Geometry', 'volumes.petsc')
 METOS_SIM_FILE = os.path.join(METOS3D_DIR, 'metos3d', 'metos3d-simpack-{model_name}.exe')
 METOS_SIM_FILE_ENV = os.path.join('${{{}}}'.format(METOS3D_DIR_ENV_NAME), 'metos3d', 'metos3d-simpack-{model_name}.exe')
 
@@ -33,6 +34,7 @@ METOS_VECTOR_LEN = 52749
 
 
 METOS_TRAJECTORY_FILENAME = 'sp0000-ts{time_step:0>4d}-{tracer}_output.petsc'
+METOS_TRAJECTORY_LOAD_MAX_WORKERS = 8
 
 ## METOS 3D N-DOP
 METOS_TRAJECTORY_FILENAMES = ('sp0000-ts{:0>4}-dop_output.petsc', 'sp0000-ts{:0>4}-po4_output.petsc')
@@ -41,14 +43,37 @@ METOS_TRACER_DIM = len(METOS_TRAJECTORY_FILENAMES)
 
 ## job
 JOB_OPTIONS_FILENAME = 'job_options.hdf5'
+JOB_ID_FILENAME = 'job_id.txt'                                  # written into the output dir when the job is started
 JOB_MEMORY_GB = 4
+JOB_WAIT_PAUSE_SECONDS_MIN = 0.5
+JOB_WAIT_PAUSE_SECONDS_MAX = 60
+JOB_OUTPUT_COMPLETELY_WRITTEN_TIMEOUT = 30     # seconds the job output may stay unchanged without final output
+JOB_OUTPUT_PARSERS_CACHE_SIZE = 256            # number of job output files whose parsed output is kept in memory
+JOB_ARRAY_OPTIONS = {'RZ-PBS': ('#PBS -J 0-{max_index:d}', 'PBS_ARRAY_INDEX')}   # job array header line and index variable for each batch system
 
 
 ## model spinup
 MODEL_SPINUP_MAX_YEARS = 50000
 MODEL_START_FROM_CLOSEST_PARAMETER_SET = False
-MODEL_DEFAULT_SPINUP_OPTIONS = {'years':10000, 'tolerance':0.0, 'combination':'or', 'match_type': 'best'}
+MODEL_WARM_START_INTERPOLATION = False         # True: start new spinups from the interpolated tracer vectors of the nearest parameter sets (needs MODEL_START_FROM_CLOSEST_PARAMETER_SET)
+MODEL_WARM_START_NEIGHBOURS = 4                # number of nearest parameter sets used for interpolation
+MODEL_WARM_START_TAYLOR = True                 # True: use first order taylor prediction at the nearest parameter set if its partial derivative runs are available
+MODEL_WARM_START_REGULARIZATION = 10**(-6)
+MODEL_WARM_START_MAX_EXTRAPOLATION = 3         # maximal sum of absolute interpolation weights, otherwise inverse distance weights are used
+MODEL_SPINUP_ACCELERATION_SEGMENT_YEARS = 100  # years of each run of an accelerated spinup
+MODEL_SPINUP_ACCELERATION_MEMORY = 5           # number of previous runs used for anderson acceleration
+MODEL_SPINUP_ACCELERATION_REGULARIZATION = 10**(-10)
+MODEL_SPINUP_ACCELERATION_RESTART_FACTOR = 2   # history is discarded if the residual norm grows by this factor
+MODEL_DEFAULT_SPINUP_OPTIONS = {'years':10000, 'tolerance':0.0, 'combination':'or', 'match_type': 'best', 'multilevel_time_steps': (), 'multilevel_years': 1000, 'multilevel_tolerance': 0.0}   # multilevel: spinup first with coarser time steps (years or tolerance at each coarse time step, only used with tolerance > 0 and combination 'or' since coarse years are not counted as spinup years)
 MODEL_DEFAULT_DERIVATIVE_OPTIONS = {'years': 500, 'step_size': 10**(-6), 'accuracy_order': 2}
+MODEL_DERIVATIVE_MAX_CONCURRENT_TRAJECTORIES = 8
+MODEL_DERIVATIVE_SPINUP_BATCH = False          # True: submit the spinups of all partial derivative runs as one job array if supported, else as one batch job
+MODEL_DERIVATIVE_TRAJECTORY_BATCH = False      # True: extract the trajectories of all partial derivative runs in one batch job
+MODEL_TRAJECTORY_BATCH_PARALLEL_RUNS = None    # number of trajectory runs executed simultaneously in a batch job (the nodes and cpus are split between them, None: one run for each cpu)
+
+
+## model trajectory
+MODEL_TRAJECTORY_AVERAGING_MODE = 'average'     # 'average': write all time steps and average them, 'snapshot': write only one time step per desired time dim entry
 
 
 ## model names
@@ -206,6 +231,16 @@ DATABASE_SPINUP_DIRNAME = 'spinup'
 DATABASE_DERIVATIVE_DIRNAME = os.path.join('derivative', 'spinup_years_{spinup_real_years:d}', 'derivative_step_size_{derivative_step_size:g}', 'derivative_spinup_years_{derivative_years:d}')
 DATABASE_PARTIAL_DERIVATIVE_DIRNAME = 'partial_derivative_{kind}_{index:d}_{h_factor:+d}'
 DATABASE_RUN_DIRNAME = 'run_{:0>5d}'
+DATABASE_RUN_LEDGER_FILENAME = 'run_ledger.txt'
+DATABASE_WARM_START_FILENAME = '{tracer}_warm_start.petsc'
+DATABASE_ACCELERATED_SPINUP_FILENAME = '{tracer}_accelerated.petsc'
+DATABASE_RUN_LOCK_FILENAME = 'runs'                           # lock file (with suffix .lock) in each spinup and partial derivative dir
+DATABASE_RUN_RESERVATION_FILENAME = 'run_reservation.txt'      # written into new run dirs until their jobs are started
+DATABASE_RUN_RESERVATION_TIMEOUT = 10 * 60                     # seconds after which a reserved run dir whose job is not started is abandoned
+DATABASE_INDEX_LOCK_FILENAME = 'index_allocation'              # lock file (with suffix .lock) for adding parameter sets and concentrations
+DATABASE_CATALOG = True                                        # True: record parameter sets, runs and cached files in the catalog
+DATABASE_CATALOG_FILE = os.path.join(DATABASE_OUTPUT_DIR, 'catalog.sqlite')
+DATABASE_CATALOG_TIMEOUT = 10 * 60                             # seconds to wait for the catalog lock of another process
 
 DATABASE_VECTOR_CONCENTRATIONS_DIRNAME = 'initial_concentration_vector'
 DATABASE_VECTOR_CONCENTRATIONS_FILENAME = 'concentration_{tracer}.petsc'
@@ -221,6 +256,9 @@ DATABASE_CONCENTRATIONS_DIRNAME = 'concentration_{:0>5d}'
 DATABASE_PARAMETERS_DIRNAME = 'parameter_set_{:0>5d}'
 DATABASE_PARAMETERS_FILENAME = 'parameters.txt'
 DATABASE_PARAMETERS_LOOKUP_ARRAY_FILENAME = 'parameter_set_database.npy'
+DATABASE_PARAMETERS_INDEX_FILENAME = 'parameter_set_index.npy'
+DATABASE_PARAMETERS_HASH_FILENAME = 'parameter_set_hash.npy'
+DATABASE_PARAMETERS_HASH_CELL_SIZE = 1024                       # edge length of the hash cells in multiples of the parameter tolerance
 DATABASE_PARAMETERS_RELIABLE_DECIMAL_PLACES = np.finfo(np.float64).precision
 assert DATABASE_PARAMETERS_RELIABLE_DECIMAL_PLACES == 15
 DATABASE_PARAMETERS_FORMAT_STRING = '{:.' + '{}'.format(DATABASE_PARAMETERS_RELIABLE_DECIMAL_PLACES) + 'f}'
@@ -230,6 +268,9 @@ DATABASE_CACHE_SPINUP_DIRNAME = 'spinup_years_{real_years:d}'
 DATABASE_CACHE_DERIVATIVE_DIRNAME = os.path.join('derivative_step_size_{derivative_step_size:g}', 'derivative_spinup_years_{derivative_years:d}', 'derivative_accuracy_order_{derivative_accuracy_order:d}')
 DATABASE_POINTS_OUTPUT_DIRNAME = os.path.join('output', '{tracer}', '{data_set_name}')
 DATABASE_ALL_DATASET_NAME = 'all_model_values_-_time_dim_{time_dim}'
+DATABASE_ALL_SNAPSHOT_DATASET_NAME = 'all_model_values_-_time_dim_{time_dim}_-_snapshot'
+DATABASE_F_ALL_PREFETCH_TIME_DIM = None                         # finer time dim at which not cached all f values are calculated and cached to average coarser time dims from (None to calculate only the requested time dim)
+DATABASE_DF_ALL_PREFETCH_TIME_DIM = None                        # finer time dim at which not cached all df values are calculated and cached to average coarser time dims from (None to calculate only the requested time dim)
 DATABASE_F_FILENAME = 'f.npz'
 DATABASE_DF_FILENAME = 'df_{derivative_kind}.npz'
 DATABASE_CACHE_OPTION_FILE_SUFFIX = '_options'
@@ -237,8 +278,31 @@ DATABASE_CACHE_OPTION_FILE_SUFFIX = '_options'
 DATABASE_TMP_DIR = os.path.join(util.constants.TMP_DIR, 'metos3d_simulations')
 
 
+## job walltime estimator
+JOB_WALLTIME_ESTIMATOR_FILE = os.path.join(DATABASE_OUTPUT_DIR, 'walltime_estimator.npz')
+JOB_WALLTIME_ESTIMATOR_QUANTILE = 0.95     # quantile of the finished runs whose walltime should not be underestimated
+
+## job node setup selection
+MODEL_NODES_SETUP_SELECTION = False     # True: choose node kind, nodes and cpus of each job with minimal expected queue wait and runtime
+NODES_SETUP_SELECTION_QUEUE_SECONDS_PER_MISSING_NODE = 30 * 60     # expected queue wait for each requested node which is not free at the moment
+
+
+## metos vector index map
+METOS_VECTOR_3D_FLAT_INDICES_FILE = os.path.join(DATABASE_OUTPUT_DIR, 'metos_vector_3D_flat_indices.npy')
+
+
 ## model interpolator
 MODEL_INTERPOLATOR_FILE = os.path.join(DATABASE_OUTPUT_DIR, 'interpolator.ppy')
 MODEL_INTERPOLATOR_AMOUNT_OF_WRAP_AROUND = (1/METOS_T_DIM, 1/METOS_X_DIM, 0, 0)
 MODEL_INTERPOLATOR_NUMBER_OF_LINEAR_INTERPOLATOR = 0
 MODEL_INTERPOLATOR_SINGLE_OVERLAPPING_AMOUNT_OF_LINEAR_INTERPOLATOR = 0
+
+## model interpolation operator
+MODEL_INTERPOLATION_OPERATOR_DIR = os.path.join(DATABASE_OUTPUT_DIR, 'interpolation_operator')
+MODEL_INTERPOLATION_OPERATOR_FILENAME = 'interpolation_operator_-_lsm_{lsm}_-_time_dim_{time_dim}_-_points_{points_hash}.npz'
+
+
+## model trajectory store
+MODEL_TRAJECTORY_STORE_DIR = os.path.join(DATABASE_OUTPUT_DIR, 'trajectory_store')
+MODEL_TRAJECTORY_STORE_FILENAME = '{tracer}_-_time_dim_{time_dim:0>4d}.npz'
+MODEL_TRAJECTORY_STORE_MAX_SIZE_GB = None       # None: no trajectory store, else disk budget of the store in GB (least recently used trajectories are removed first)
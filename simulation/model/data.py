@@ -1,70 +1,182 @@
 import os
-import itertools
+import re
+import concurrent.futures
 
 import numpy as np
 
 import simulation.model.constants
 
-import util.petsc.universal
+import util.io.np
 import util.logging
 logger = util.logging.logger
 
 
+## index map between Metos vector and 3D array
+
+_METOS_VECTOR_3D_FLAT_INDICES = None
+
+def calculate_metos_vector_3D_flat_indices():
+    METOS_LSM = simulation.model.constants.METOS_LSM
+    METOS_SPACE_DIM = simulation.model.constants.METOS_SPACE_DIM
+
+    logger.debug('Calculating flat 3D indices of metos vector entries for land sea mask {}.'.format(METOS_LSM))
+
+    ## water boxes in metos order (y, x, z)
+    lsm = np.asarray(METOS_LSM.lsm, dtype=np.int64)
+    z = np.arange(METOS_SPACE_DIM[2])
+    water_mask = z[np.newaxis, np.newaxis, :] < lsm.T[:, :, np.newaxis]
+    iy, ix, iz = np.nonzero(water_mask)
+
+    ## flat indices in (x, y, z) array
+    flat_indices = np.ravel_multi_index((ix, iy, iz), METOS_SPACE_DIM)
+    assert flat_indices.ndim == 1 and len(flat_indices) == simulation.model.constants.METOS_VECTOR_LEN
+    return flat_indices
+
+
+def metos_vector_3D_flat_indices():
+    global _METOS_VECTOR_3D_FLAT_INDICES
+
+    if _METOS_VECTOR_3D_FLAT_INDICES is None:
+        file = simulation.model.constants.METOS_VECTOR_3D_FLAT_INDICES_FILE
+
+        ## try to load saved indices
+        try:
+            flat_indices = np.load(file)
+        except OSError:
+            flat_indices = None
+        else:
+            if flat_indices.shape != (simulation.model.constants.METOS_VECTOR_LEN,):
+                logger.warn('Saved flat 3D indices in {} have wrong shape {}. They are recalculated.'.format(file, flat_indices.shape))
+                flat_indices = None
+            else:
+                logger.debug('Flat 3D indices of metos vector entries loaded from {}.'.format(file))
+
+        ## otherwise calculate and save indices
+        if flat_indices is None:
+            flat_indices = calculate_metos_vector_3D_flat_indices()
+            try:
+                util.io.np.save(file, flat_indices, make_read_only=True, overwrite=True)
+            except OSError as exception:
+                logger.warn('Flat 3D indices of metos vector entries could not be saved to {}: {}'.format(file, exception))
+            else:
+                logger.debug('Flat 3D indices of metos vector entries saved to {}.'.format(file))
+
+        flat_indices.flags.writeable = False
+        _METOS_VECTOR_3D_FLAT_INDICES = flat_indices
+
+    return _METOS_VECTOR_3D_FLAT_INDICES
+
+
 ## convert Metos vector to 3D vector
 
 def convert_metos_1D_to_3D(metos_vec):
     assert len(metos_vec) == simulation.model.constants.METOS_VECTOR_LEN
-    
-    METOS_LSM = simulation.model.constants.METOS_LSM
+    return convert_metos_1D_to_3D_batch(metos_vec)
+
+
+def convert_metos_1D_to_3D_batch(metos_vecs):
+    metos_vecs = np.asanyarray(metos_vecs)
+    assert metos_vecs.shape[-1] == simulation.model.constants.METOS_VECTOR_LEN
+
+    METOS_SPACE_DIM = simulation.model.constants.METOS_SPACE_DIM
+    batch_shape = metos_vecs.shape[:-1]
 
     ## init array
-    array = np.empty([METOS_LSM.x_dim, METOS_LSM.y_dim, METOS_LSM.z_dim], dtype=np.float64)
+    array = np.empty(batch_shape + (np.prod(METOS_SPACE_DIM),), dtype=np.float64)
     array.fill(np.nan)
 
     ## fill array
-    logger.debug('Converting metos {} vector to {} matrix.'.format(metos_vec.shape, array.shape))
-
-    offset = 0
-    for iy in range(METOS_LSM.y_dim):
-        for ix in range(METOS_LSM.x_dim):
-            length = METOS_LSM[ix, iy]
-            if length > 0:
-                array[ix, iy, 0:length] = metos_vec[offset:offset+length]
-                offset = offset + length
+    logger.debug('Converting metos {} vector to {} matrix.'.format(metos_vecs.shape, batch_shape + METOS_SPACE_DIM))
+    array[..., metos_vector_3D_flat_indices()] = metos_vecs
 
+    array = array.reshape(batch_shape + METOS_SPACE_DIM)
     return array
 
 
 def convert_3D_to_metos_1D(data):
     assert data.ndim == 3
 
-    metos_vec_len = np.sum(~np.isnan(data))
-    metos_vec = np.empty(metos_vec_len)
-    x_dim, y_dim, z_dim = data.shape
-
-    offset = 0
-    for iy in range(y_dim):
-        for ix in range(x_dim):
-            data_x_y = data[ix, iy]
-            mask = ~ np.isnan(data_x_y)
-            length = sum(mask)
-            if length > 0:
-                metos_vec[offset:offset+length] = data_x_y[mask]
-                offset = offset + length
+    ## use index map for metos shaped data
+    if data.shape == simulation.model.constants.METOS_SPACE_DIM:
+        return convert_3D_to_metos_1D_batch(data)
 
+    ## otherwise take not nan values in metos order (y, x, z)
+    data = data.transpose(1, 0, 2)
+    metos_vec = data[~ np.isnan(data)]
     return metos_vec
 
 
+def convert_3D_to_metos_1D_batch(data):
+    data = np.asanyarray(data)
+    METOS_SPACE_DIM = simulation.model.constants.METOS_SPACE_DIM
+    assert data.shape[-3:] == METOS_SPACE_DIM
+
+    batch_shape = data.shape[:-3]
+    data = data.reshape(batch_shape + (np.prod(METOS_SPACE_DIM),))
+    metos_vecs = data[..., metos_vector_3D_flat_indices()]
+    return metos_vecs
+
+
+## load petsc vectors
+
+PETSC_VEC_HEADER = 1211214
+
+def load_petsc_vec_to_numpy_memmap(file):
+    ## read header and length
+    header = np.fromfile(file, dtype='>i4', count=2)
+    if len(header) != 2 or header[0] != PETSC_VEC_HEADER:
+        raise OSError('File {} is not a PETSc vector file.'.format(file))
+    vec_len = header[1]
+
+    ## map values without copy
+    vec = np.memmap(file, dtype='>f8', mode='r', offset=header.nbytes, shape=(vec_len,))
+    return vec
+
+
+def _load_averaged_petsc_vecs(files, out=None, set_negative_values_to_zero=False):
+    for k, file in enumerate(files):
+        vec = load_petsc_vec_to_numpy_memmap(file)
+        if set_negative_values_to_zero:
+            vec = np.maximum(vec, 0)
+        if k == 0:
+            if out is None:
+                out = np.empty(vec.shape, dtype=np.float64)
+            out[...] = vec
+        else:
+            out += vec
+        del vec
+
+    if len(files) > 1:
+        out /= len(files)
+    return out
+
+
 ## load trajectory
 
-def load_trajectories_to_universal(path, convert_function=None, converted_result_shape=None, tracers=None, time_dim_desired=None, set_negative_values_to_zero=False):
-    logger.debug('Loading trajectories with tracers {}, desired time dim {}, set_negative_values_to_zero {} and convert function {} with result shape {} from {}.'.format(tracers, time_dim_desired, set_negative_values_to_zero, convert_function, converted_result_shape, path))
+def trajectory_file_time_steps(path, tracer):
+    ## make regular expression for trajectory filenames of tracer
+    filename_prefix, filename_suffix = simulation.model.constants.METOS_TRAJECTORY_FILENAME.split('{time_step:0>4d}')
+    filename_regular_expression = re.compile(re.escape(filename_prefix.format(tracer=tracer)) + r'(\d+)' + re.escape(filename_suffix.format(tracer=tracer)))
+
+    ## get sorted time steps of trajectory files
+    try:
+        filenames = os.listdir(path)
+    except OSError as exception:
+        raise FileNotFoundError('No PETSc vectors found in {}: {}'.format(path, exception)) from exception
+    time_steps = [int(match.group(1)) for match in map(filename_regular_expression.fullmatch, filenames) if match is not None]
+    time_steps.sort()
+    return time_steps
+
+
+def load_trajectories_to_universal(path, convert_function=None, converted_result_shape=None, tracers=None, time_dim_desired=None, time_indices=None, set_negative_values_to_zero=False):
+    logger.debug('Loading trajectories with tracers {}, desired time dim {}, time indices {}, set_negative_values_to_zero {} and convert function {} with result shape {} from {}.'.format(tracers, time_dim_desired, time_indices, set_negative_values_to_zero, convert_function, converted_result_shape, path))
 
     ## check input
     if isinstance(tracers, str):
         tracers = [tracers]
 
     # check convert_function
+    use_convert_function = convert_function is not None
     if convert_function is None:
         convert_function = lambda x: x
         if converted_result_shape is not None:
@@ -75,20 +187,12 @@ def load_trajectories_to_universal(path, convert_function=None, converted_result
     assert callable(convert_function)
 
     ## calculate tracer_time_dim
-    tracer_time_dim = simulation.model.constants.METOS_T_DIM
-    tracer_time_dim_found = False
-    while not tracer_time_dim_found:
-        filename = simulation.model.constants.METOS_TRAJECTORY_FILENAME.format(tracer=tracers[0], time_step=tracer_time_dim - 1)
-        file = os.path.join(path, filename)
-        if not os.path.exists(file):
-            if tracer_time_dim > 1:
-                tracer_time_dim -= 1
-            else:
-                raise FileNotFoundError('No PETSc vectors found in {}.'.format(path))
-        else:
-            tracer_time_dim_found = True
+    file_time_steps = trajectory_file_time_steps(path, tracers[0])
+    tracer_time_dim = len(file_time_steps)
+    if tracer_time_dim == 0:
+        raise FileNotFoundError('No PETSc vectors found in {}.'.format(path))
 
-    logger.debug('{} petsc vectors were found for each tracer.'.format(tracer_time_dim_found))
+    logger.debug('{} petsc vectors were found for each tracer.'.format(tracer_time_dim))
 
     ## calculate time_step, check time_dim_desired
     if time_dim_desired is not None:
@@ -102,98 +206,137 @@ def load_trajectories_to_universal(path, convert_function=None, converted_result
 
     assert tracer_time_dim % time_dim_desired == 0
 
+    ## check time_indices
+    if time_indices is not None:
+        time_indices = np.asanyarray(time_indices, dtype=np.int64)
+        if time_indices.ndim != 1:
+            raise ValueError('The time indices must be a vector, but their shape is {}.'.format(time_indices.shape))
+        if np.any(time_indices < 0) or np.any(time_indices >= time_dim_desired):
+            raise ValueError('The time indices {} must be between 0 and the desired time dimension {}.'.format(time_indices, time_dim_desired))
+    else:
+        time_indices = np.arange(time_dim_desired)
+
     ## init trajectory
     if converted_result_shape is None:
-        filename = simulation.model.constants.METOS_TRAJECTORY_FILENAME.format(tracer=tracers[0], time_step=0)
+        filename = simulation.model.constants.METOS_TRAJECTORY_FILENAME.format(tracer=tracers[0], time_step=file_time_steps[0])
         file = os.path.join(path, filename)
-        trajectory = util.petsc.universal.load_petsc_vec_to_numpy_array(file)
+        trajectory = load_petsc_vec_to_numpy_memmap(file)
         converted_result_shape = convert_function(trajectory).shape
+        del trajectory
 
     tracers_len = len(tracers)
-    trajectory_shape = (tracers_len, time_dim_desired) + converted_result_shape
-    trajectory = np.zeros(trajectory_shape, dtype=np.float64)
+    trajectory_shape = (tracers_len, len(time_indices)) + converted_result_shape
+    trajectory = np.empty(trajectory_shape, dtype=np.float64)
 
     ## load and calculate trajectory
-    logger.debug('Loading trajectories from {} to array of size {}.'.format(path, trajectory.shape))
+    max_workers = simulation.model.constants.METOS_TRAJECTORY_LOAD_MAX_WORKERS
+    logger.debug('Loading trajectories from {} to array of size {} with {} threads.'.format(path, trajectory.shape, max_workers))
 
-    for tracers_index in range(tracers_len):
+    def load_time_index(tracers_index, trajectory_time_index, time_index):
         tracer = tracers[tracers_index]
+        files = [os.path.join(path, simulation.model.constants.METOS_TRAJECTORY_FILENAME.format(tracer=tracer, time_step=file_time_steps[time_index * time_step + k])) for k in range(time_step)]
+
+        ## average trajectory directly in result array
+        if not use_convert_function:
+            _load_averaged_petsc_vecs(files, trajectory[tracers_index, trajectory_time_index], set_negative_values_to_zero=set_negative_values_to_zero)
 
-        logger.debug('Loading trajectory for tracer {}.'.format(tracer))
-        for time_index in range(time_dim_desired):
-            ## average trajectory
-            for k in range(time_step):
-                ## prepare filename
-                file_nr = time_index * time_step + k
-                filename = simulation.model.constants.METOS_TRAJECTORY_FILENAME.format(tracer=tracer, time_step=file_nr)
-                file = os.path.join(path, filename)
-
-                ## load vector and average
-                vec = util.petsc.universal.load_petsc_vec_to_numpy_array(file)
-                if set_negative_values_to_zero:
-                    vec[vec < 0] = 0
-                if k == 0:
-                    trajectory_averaged = vec
-                else:
-                    trajectory_averaged += vec
-
-            trajectory_averaged /= time_step
-
-            ## convert trajectory
+        ## average and convert trajectory
+        else:
+            trajectory_averaged = _load_averaged_petsc_vecs(files, set_negative_values_to_zero=set_negative_values_to_zero)
             trajectory_averaged = convert_function(trajectory_averaged)
             assert trajectory_averaged.shape == converted_result_shape
+            trajectory[tracers_index, trajectory_time_index] = trajectory_averaged
 
-            trajectory[tracers_index, time_index] = trajectory_averaged
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(load_time_index, tracers_index, trajectory_time_index, time_index) for tracers_index in range(tracers_len) for trajectory_time_index, time_index in enumerate(time_indices)]
+        for future in futures:
+            future.result()
 
     logger.debug('Trajectory with shape {} loaded.'.format(trajectory.shape))
 
     return trajectory
 
 
-def load_trajectories_to_map(path, tracers, time_dim_desired=None):
-    ## load trajectory
-    convert_function = lambda metos_vec: convert_metos_1D_to_3D(metos_vec)
-    trajectory = load_trajectories_to_universal(path, convert_function=convert_function, converted_result_shape=simulation.model.constants.METOS_SPACE_DIM, tracers=tracers, time_dim_desired=time_dim_desired)
-    trajectory = trajectory[0]
+def aggregate_trajectory(trajectory, time_dim_desired=None, time_indices=None):
+    trajectory = np.asanyarray(trajectory)
+    trajectory_time_dim = trajectory.shape[0]
+
+    ## average blocks of time steps
+    if time_dim_desired is not None and time_dim_desired != trajectory_time_dim:
+        if trajectory_time_dim % time_dim_desired != 0:
+            raise ValueError('The desired time dimension {0} can not be satisfied because the trajectory time dimension {1} is not divisible by {0}.'.format(time_dim_desired, trajectory_time_dim))
+        time_step = trajectory_time_dim // time_dim_desired
+        trajectory = trajectory.reshape((time_dim_desired, time_step) + trajectory.shape[1:]).mean(axis=1)
+    else:
+        time_dim_desired = trajectory_time_dim
+
+    ## choose time indices
+    if time_indices is not None:
+        time_indices = np.asanyarray(time_indices, dtype=np.int64)
+        if time_indices.ndim != 1:
+            raise ValueError('The time indices must be a vector, but their shape is {}.'.format(time_indices.shape))
+        if np.any(time_indices < 0) or np.any(time_indices >= time_dim_desired):
+            raise ValueError('The time indices {} must be between 0 and the desired time dimension {}.'.format(time_indices, time_dim_desired))
+        trajectory = trajectory[time_indices]
 
-    assert trajectory.ndim == 4
     return trajectory
 
 
-def load_trajectories_to_map_index_array(path, tracers, time_dim_desired=None):
-    ## load trajectory with universal function
-    def convert_function(metos_vec):
-        trajectory = convert_metos_1D_to_3D(metos_vec)
-        data_mask = np.logical_not(np.isnan(trajectory))
+def trajectory_loader_for_files(path, tracer):
+    def load_trajectory(time_dim_desired=None, time_indices=None):
+        trajectory = load_trajectories_to_universal(path, tracers=tracer, time_dim_desired=time_dim_desired, time_indices=time_indices)
+        return trajectory[0]
+    return load_trajectory
 
-        data_indices = np.array(np.where(data_mask)).swapaxes(0, 1)
-        assert data_indices.ndim == 2
-        assert data_indices.shape[1] == 3
 
-        data_values = trajectory[data_mask].reshape([len(data_indices), 1])
-        assert data_values.ndim == 2
-        assert data_values.shape[1] == 1
-        assert len(data_indices) == len(data_values)
+def trajectory_loader_for_array(trajectory):
+    def load_trajectory(time_dim_desired=None, time_indices=None):
+        return aggregate_trajectory(trajectory, time_dim_desired=time_dim_desired, time_indices=time_indices)
+    return load_trajectory
 
-        data = np.concatenate([data_indices, data_values], axis=1)
-        assert data.ndim == 2
-        assert data.shape[1] == 4
 
-        return data
+def convert_trajectory_to_map(trajectory):
+    assert trajectory.ndim == 2
+    trajectory = convert_metos_1D_to_3D_batch(trajectory)
+    assert trajectory.ndim == 4
+    return trajectory
 
-    trajectory = load_trajectories_to_universal(path, convert_function=convert_function, tracers=tracers, time_dim_desired=time_dim_desired)
-    trajectory = trajectory[0]
-    assert trajectory.ndim == 3
-    assert np.all(trajectory[:, :, :3] % 1 == 0)
 
-    ## convert time index to point value
-    t_dim, point_len_per_t, point_dim  = trajectory.shape
-    trajectory_point_array = np.empty((t_dim * point_len_per_t, point_dim + 1))
-    for t_index in range(t_dim):
-        trajectory_point_array[t_index*point_len_per_t : (t_index+1)*point_len_per_t, 0] = t_index
-        trajectory_point_array[t_index*point_len_per_t : (t_index+1)*point_len_per_t, 1:] = trajectory[t_index]
+def convert_trajectory_to_map_index_array(trajectory):
+    assert trajectory.ndim == 2
+
+    ## get map indices in (x, y, z) order
+    flat_indices = metos_vector_3D_flat_indices()
+    order = np.argsort(flat_indices)
+    map_indices = np.array(np.unravel_index(flat_indices[order], simulation.model.constants.METOS_SPACE_DIM)).swapaxes(0, 1)
+    assert map_indices.ndim == 2 and map_indices.shape[1] == 3
+
+    ## convert time index and map indices to point value
+    t_dim, point_len_per_t = trajectory.shape
+    trajectory_point_array = np.empty((t_dim, point_len_per_t, 5))
+    trajectory_point_array[:, :, 0] = np.arange(t_dim)[:, np.newaxis]
+    trajectory_point_array[:, :, 1:4] = map_indices[np.newaxis]
+    trajectory_point_array[:, :, 4] = trajectory[:, order]
+    trajectory_point_array = trajectory_point_array.reshape(t_dim * point_len_per_t, 5)
 
     assert trajectory_point_array.ndim == 2
     assert trajectory_point_array.shape[1] == 5
     return trajectory_point_array
 
+
+def load_trajectories_to_map(path, tracers, time_dim_desired=None):
+    ## load trajectory
+    trajectory = load_trajectories_to_universal(path, convert_function=convert_metos_1D_to_3D, converted_result_shape=simulation.model.constants.METOS_SPACE_DIM, tracers=tracers, time_dim_desired=time_dim_desired)
+    trajectory = trajectory[0]
+
+    assert trajectory.ndim == 4
+    return trajectory
+
+
+def load_trajectories_to_map_index_array(path, tracers, time_dim_desired=None):
+    ## load trajectory as metos vectors
+    trajectory = load_trajectories_to_universal(path, tracers=tracers, time_dim_desired=time_dim_desired)
+    trajectory = trajectory[0]
+
+    ## convert to point array
+    return convert_trajectory_to_map_index_array(trajectory)
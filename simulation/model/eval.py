@@ -1,10 +1,18 @@
+import asyncio
+import concurrent.futures
+import copy
 import os
+import hashlib
+import sqlite3
 import tempfile
+import time
 import warnings
 
 import numpy as np
+import scipy.sparse
 
 import util.io.fs
+import util.io.filelock.unix
 import util.index_database.array_and_txt_file_based
 import util.index_database.petsc_file_based
 import util.pattern
@@ -19,10 +27,19 @@ import measurements.land_sea_mask.lsm
 import measurements.universal.data
 
 import simulation.constants
+import simulation.model.accelerated_spinup
+import simulation.model.asynchronous
+import simulation.model.catalog
 import simulation.model.data
 import simulation.model.job
 import simulation.model.options
 import simulation.model.constants
+import simulation.model.nodes_setup_selector
+import simulation.model.parameter_hash
+import simulation.model.parameter_index
+import simulation.model.run_ledger
+import simulation.model.trajectory_store
+import simulation.model.warm_start
 
 logger = util.logging.logger
 
@@ -39,8 +56,36 @@ class Model_Database:
 
         self.database_output_dir = simulation.model.constants.DATABASE_OUTPUT_DIR
         self.start_from_closest_parameters = simulation.model.constants.MODEL_START_FROM_CLOSEST_PARAMETER_SET
+        self.warm_start_interpolation = simulation.model.constants.MODEL_WARM_START_INTERPOLATION
+        self.warm_start_neighbours = simulation.model.constants.MODEL_WARM_START_NEIGHBOURS
+        self.warm_start_taylor = simulation.model.constants.MODEL_WARM_START_TAYLOR
         self.model_spinup_max_years = simulation.model.constants.MODEL_SPINUP_MAX_YEARS
+        self.trajectory_averaging_mode = simulation.model.constants.MODEL_TRAJECTORY_AVERAGING_MODE
+        self.derivative_trajectory_batch = simulation.model.constants.MODEL_DERIVATIVE_TRAJECTORY_BATCH
+        self.derivative_spinup_batch = simulation.model.constants.MODEL_DERIVATIVE_SPINUP_BATCH
+        self.trajectory_batch_parallel_runs = simulation.model.constants.MODEL_TRAJECTORY_BATCH_PARALLEL_RUNS
+        if simulation.model.constants.MODEL_NODES_SETUP_SELECTION:
+            self.nodes_setup_selector = simulation.model.nodes_setup_selector.Nodes_Setup_Selector()
+        else:
+            self.nodes_setup_selector = None
         self._cached_interpolator = None
+        self._cached_interpolation_operators = {}
+        self._prepared_trajectory_dirs = {}
+        self._batch_dirs = []
+        self._parameter_hashes = {}
+        self._parameter_indices = {}
+        self._locks = {}
+
+        if simulation.model.constants.DATABASE_CATALOG:
+            self.catalog = simulation.model.catalog.Catalog()
+        else:
+            self.catalog = None
+
+        trajectory_store_max_size_gb = simulation.model.constants.MODEL_TRAJECTORY_STORE_MAX_SIZE_GB
+        if trajectory_store_max_size_gb is not None:
+            self.trajectory_store = simulation.model.trajectory_store.Trajectory_Store(simulation.model.constants.MODEL_TRAJECTORY_STORE_DIR, trajectory_store_max_size_gb)
+        else:
+            self.trajectory_store = None
 
         self.model_lsm = simulation.model.constants.METOS_LSM
 
@@ -90,6 +135,20 @@ class Model_Database:
         self.job_options = job_options
 
 
+    def _concurrent_copy(self, model_options=None):
+        ## shallow copy with own model options, file locks and memory caches for concurrent evaluations (also in other threads)
+        ## (prepared trajectories, batch jobs and caches of interpolation operators are shared)
+        if model_options is None:
+            model_options = self.model_options
+        model = copy.copy(self)
+        model.model_options = model_options.copy()
+        model._locks = {}
+        model._parameter_hashes = {}
+        model._parameter_indices = {}
+        model.__dict__.pop('__cache_dict__', None)
+        return model
+
+
     ## model dir
 
     @property
@@ -156,7 +215,8 @@ class Model_Database:
         else:
             concentration_db = self._vector_concentrations_db
 
-        index = concentration_db.get_or_add_index(concentrations)
+        with self._lock(self.initial_concentration_base_dir, simulation.model.constants.DATABASE_INDEX_LOCK_FILENAME):
+            index = concentration_db.get_or_add_index(concentrations)
         assert index is not None
         return index
 
@@ -233,7 +293,13 @@ class Model_Database:
         parameters = self.model_options.parameters
         logger.debug('Searching parameter directory for parameters {}.'.format(parameters))
 
-        index = self._parameter_db.get_or_add_index(parameters)
+        with self._lock(self.time_step_dir, simulation.model.constants.DATABASE_INDEX_LOCK_FILENAME):
+            parameter_hash = self._parameter_hash
+            index = parameter_hash.index(parameters)
+            if index is None:
+                index = parameter_hash.parameter_db.add_value(parameters)
+                parameter_hash.add(index, parameters)
+                self._update_catalog('add_parameter_set', self.parameter_set_dir_with_index(index), self.model_options.model_name, self._concentrations_kind, self.initial_concentration_dir_index, self.model_options.initial_concentration_options.concentrations, self.model_options.time_step, index, parameters)
         parameter_set_dir = self.parameter_set_dir_with_index(index)
 
         ## return
@@ -242,22 +308,73 @@ class Model_Database:
         return parameter_set_dir
 
 
+    @property
+    def _parameter_hash(self):
+        file = os.path.join(self.time_step_dir, simulation.model.constants.DATABASE_PARAMETERS_HASH_FILENAME)
+        parameter_db = self._parameter_db
+        key = (file, tuple(parameter_db.relative_tolerance), tuple(parameter_db.absolute_tolerance))
+        try:
+            parameter_hash = self._parameter_hashes[key]
+        except KeyError:
+            parameter_hash = simulation.model.parameter_hash.Parameter_Hash(file, parameter_db)
+            self._parameter_hashes[key] = parameter_hash
+        return parameter_hash
+
+
+    @property
+    def _parameter_index(self):
+        file = os.path.join(self.time_step_dir, simulation.model.constants.DATABASE_PARAMETERS_INDEX_FILENAME)
+        try:
+            parameter_index = self._parameter_indices[file]
+        except KeyError:
+            typical_parameters = simulation.model.constants.MODEL_PARAMETER_TYPICAL[self.model_options.model_name]
+            parameter_index = simulation.model.parameter_index.Parameter_Index(file, typical_parameters)
+            self._parameter_indices[file] = parameter_index
+        return parameter_index
+
+
+    def _build_parameter_index(self):
+        ## index of existing database is built once (without run locks since all spinups are checked)
+        if not self._parameter_index.exists():
+            self.rebuild_parameter_index()
+
+
+    def _add_to_parameter_index(self, run_dir):
+        ## parameter set of finished spinup run in the time step dir of this model can be used for warm starts
+        parameter_set_dir = simulation.model.catalog.parameter_set_dir_of(run_dir)
+        if parameter_set_dir is not None and simulation.model.catalog.run_kind(run_dir) == 'spinup' and os.path.dirname(parameter_set_dir) == os.path.normpath(self.time_step_dir):
+            parameter_index = self._parameter_index
+            if parameter_index.exists():
+                index = util.pattern.get_int_in_string(os.path.basename(parameter_set_dir))
+                parameter_index.add(index, self._parameter_db.get_value(index))
+            else:
+                self.rebuild_parameter_index()
+
+
+    def rebuild_parameter_index(self):
+        ## index all parameter sets with finished spinup
+        parameter_db = self._parameter_db
+        indices = []
+        parameters_list = []
+        for index in parameter_db.used_indices():
+            last_run_dir = self.last_run_dir(self.spinup_dir_with_index(index))
+            if last_run_dir is not None and self.is_run_finished(last_run_dir):
+                indices.append(index)
+                parameters_list.append(parameter_db.get_value(index))
+        self._parameter_index.rebuild(indices, parameters_list)
+
+
     @property
     def closest_parameter_set_dir(self):
         parameters = self.model_options.parameters
         logger.debug('Searching for directory for parameters as close as possible to {}.'.format(parameters))
 
-        ## get closest indices
-        closest_indices = self._parameter_db.closest_indices(parameters)
-
-        ## check if run dirs exist
-        i = 0
-        while i < len(closest_indices) and self.last_run_dir(self.spinup_dir_with_index[i]) is None:
-            i = i +1
-        if i < len(closest_indices):
-            closest_index = closest_indices[i]
-        else:
-            closest_index = None
+        ## get closest indices with finished spinup and check if run dirs exist
+        closest_index = None
+        for index in self._parameter_index.nearest_indices(parameters):
+            if self.last_run_dir(self.spinup_dir_with_index(index)) is not None:
+                closest_index = index
+                break
 
         ## get parameter set dir and return
         closest_parameter_set_dir = self.parameter_set_dir_with_index(closest_index)
@@ -285,7 +402,10 @@ class Model_Database:
 
     @property
     def closest_spinup_dir(self):
-        spinup_dir = os.path.join(self.closest_parameter_set_dir, simulation.model.constants.DATABASE_SPINUP_DIRNAME)
+        closest_parameter_set_dir = self.closest_parameter_set_dir
+        if closest_parameter_set_dir is None:
+            return None
+        spinup_dir = os.path.join(closest_parameter_set_dir, simulation.model.constants.DATABASE_SPINUP_DIRNAME)
         logger.debug('Returning closest spinup directory {}.'.format(spinup_dir))
         return spinup_dir
 
@@ -328,9 +448,10 @@ class Model_Database:
             last_run_dirname = simulation.model.constants.DATABASE_RUN_DIRNAME.format(last_run_index)
             last_run_dir = os.path.join(search_path, last_run_dirname)
 
-            ## check job options file
-            with simulation.model.job.Metos3D_Job(last_run_dir, force_load=True) as job:
-                pass
+            ## check job options file (if run is not only reserved)
+            if not self.is_run_reserved(last_run_dir):
+                with simulation.model.job.Metos3D_Job(last_run_dir, force_load=True) as job:
+                    pass
         else:
             last_run_dir = None
 
@@ -351,28 +472,115 @@ class Model_Database:
 
 
     def make_new_run_dir(self, output_path):
-        ## get next run index
-        os.makedirs(output_path, exist_ok=True)
-        next_run_index = len(self.run_dirs(output_path))
+        with self._run_lock(output_path):
+            ## get next run index
+            next_run_index = len(self.run_dirs(output_path))
+
+            ## remove ledger entries of removed runs
+            try:
+                simulation.model.run_ledger.Run_Ledger(output_path).remove_from(next_run_index)
+            except OSError as exception:
+                logger.warn('Run ledger in {} could not be updated: {}'.format(output_path, exception))
 
-        ## create run dir
-        run_dirname = simulation.model.constants.DATABASE_RUN_DIRNAME.format(next_run_index)
-        run_dir = os.path.join(output_path, run_dirname)
+            ## create run dir
+            run_dirname = simulation.model.constants.DATABASE_RUN_DIRNAME.format(next_run_index)
+            run_dir = os.path.join(output_path, run_dirname)
+
+            logger.debug('Creating new run directory {} at {}.'.format(run_dir, output_path))
+            os.makedirs(run_dir, exist_ok=False)
+
+            ## mark run as reserved until its job is started
+            simulation.model.job.reserve(run_dir)
+
+            self._update_catalog('remove_runs_from', output_path, next_run_index)
+            self._update_catalog('add_run', run_dir, simulation.model.catalog.parameter_set_dir_of(run_dir), simulation.model.catalog.run_kind(run_dir), next_run_index)
 
-        logger.debug('Creating new run directory {} at {}.'.format(run_dir, output_path))
-        os.makedirs(run_dir, exist_ok=False)
         return run_dir
 
 
-    def matching_run_dir(self, spinup_options):
+    ## run reservation
+
+    def _lock(self, dir, filename):
+        ## one lock object per file so that locks are reentrant in this process
+        file = os.path.join(dir, filename)
+        try:
+            lock = self._locks[file]
+        except KeyError:
+            os.makedirs(dir, exist_ok=True)
+            lock = util.io.filelock.unix.FileLock(file, exclusive=True)
+            self._locks[file] = lock
+        return lock
+
+
+    def _run_lock(self, output_path):
+        return self._lock(output_path, simulation.model.constants.DATABASE_RUN_LOCK_FILENAME)
+
+
+    def is_run_reserved(self, run_dir):
+        ## run dir created by make_new_run_dir whose job is not yet started
+        return simulation.model.job.is_reserved(run_dir)
+
+
+    def is_run_in_progress(self, run_dir):
+        return self.is_run_reserved(run_dir) or not self.is_run_finished(run_dir)
+
+
+    def _remove_abandoned_run(self, output_path):
+        ## remove last run dir if it was reserved but its job was never started
+        last_run_index = len(self.run_dirs(output_path)) - 1
+        if last_run_index >= 0:
+            run_dir = os.path.join(output_path, simulation.model.constants.DATABASE_RUN_DIRNAME.format(last_run_index))
+            if simulation.model.job.is_abandoned(run_dir):
+                logger.warn('Run {} was reserved but never started. It is removed.'.format(run_dir))
+                util.io.fs.remove_recursively(run_dir, not_exist_okay=True, exclude_dir=False)
+                self._update_catalog('remove_run', run_dir)
+
+
+    def _wait_until_run_reservation_ended(self, run_dir):
+        pause_seconds = simulation.model.constants.JOB_WAIT_PAUSE_SECONDS_MIN
+        while self.is_run_reserved(run_dir):
+            logger.debug('Run {} is reserved by another process. Waiting {}s.'.format(run_dir, pause_seconds))
+            time.sleep(pause_seconds)
+            pause_seconds = min(pause_seconds * 2, simulation.model.constants.JOB_WAIT_PAUSE_SECONDS_MAX)
+
+
+    def matching_run_dir(self, spinup_options, wait_until_finished=True):
         spinup_options = util.options.as_options(spinup_options, simulation.model.options.SpinupOptions)
 
         ## get spinup dir
         spinup_dir = self.spinup_dir
         logger.debug('Searching for matching spinup run with options {} in {}.'.format(spinup_options, spinup_dir))
 
-        ## get last run dir
-        last_run_dir = self.last_run_dir(spinup_dir)
+        ## index of parameter sets with finished spinup is needed for starting from closest parameters
+        if self.start_from_closest_parameters:
+            self._build_parameter_index()
+
+        ## search or start run exclusively, but wait for runs in progress (of other processes or needed as initial state) without lock
+        while True:
+            with self._run_lock(spinup_dir):
+                self._remove_abandoned_run(spinup_dir)
+                last_run_dir = self.last_run_dir(spinup_dir)
+                if last_run_dir is None or not self.is_run_in_progress(last_run_dir):
+                    run_dir, wait_run_dir = self._matching_run_dir(spinup_options, spinup_dir, last_run_dir)
+                    if wait_run_dir is None:
+                        break
+                else:
+                    wait_run_dir = last_run_dir
+
+            logger.debug('Run {} is in progress.'.format(wait_run_dir))
+            if not wait_until_finished:
+                return wait_run_dir
+            self.wait_until_run_finished(wait_run_dir)
+
+        ## wait to finish
+        if wait_until_finished:
+            self.wait_until_run_finished(run_dir)
+
+        return run_dir
+
+
+    def _matching_run_dir(self, spinup_options, spinup_dir, last_run_dir):
+        ## returns matching or started run dir or run dir in progress which has to be waited for (without lock) before trying again
 
         ## matching run found
         if self.is_run_matching_options(last_run_dir, spinup_options):
@@ -385,18 +593,34 @@ class Model_Database:
 
             logger.debug('Matching spinup run with match type {} found at {}.'.format(spinup_options.match_type, run_dir))
 
+            ## parameter set with finished spinup can be used for warm starts
+            if self.start_from_closest_parameters and self.is_run_finished(run_dir):
+                self._add_to_parameter_index(run_dir)
+
         ## create new run
         else:
             logger.debug('No matching spinup run found.')
 
-            ## no previous run exists and starting from closest parameters get last run from closest parameters
+            ## no previous run exists and multilevel spinup get run with next coarser time step
+            ## (years with coarser time step are not counted as spinup years, so only spinups with tolerance can be shortened)
+            coarse_run_dir = None
+            if last_run_dir is None and spinup_options.combination == 'or' and spinup_options.tolerance > 0:
+                coarse_run_dir = self.matching_coarse_run_dir(spinup_options, wait_until_finished=False)
+                last_run_dir = coarse_run_dir
+
+            ## no previous run exists and starting from closest parameters interpolate nearest parameter sets or get last run from closest parameters
+            warm_start_tracer_vectors = None
             if last_run_dir is None and self.start_from_closest_parameters:
-                closest_spinup_dir = self.closest_spinup_dir
-                last_run_dir = self.last_run_dir(closest_spinup_dir)
+                if self.warm_start_interpolation:
+                    warm_start_tracer_vectors = self.warm_start_tracer_vectors()
+                if warm_start_tracer_vectors is None:
+                    closest_spinup_dir = self.closest_spinup_dir
+                    if closest_spinup_dir is not None:
+                        last_run_dir = self.last_run_dir(closest_spinup_dir)
 
-            ## finish last run
-            if last_run_dir is not None:
-                self.wait_until_run_finished(last_run_dir)
+            ## last run as initial state has to be finished
+            if last_run_dir is not None and self.is_run_in_progress(last_run_dir):
+                return (None, last_run_dir)
 
             ## make new run
             years = spinup_options.years
@@ -407,8 +631,8 @@ class Model_Database:
                 ## create new run
                 run_dir = self.make_new_run_dir(spinup_dir)
 
-                ## calculate last years
-                if last_run_dir is not None:
+                ## calculate last years (years with coarser time step or of other parameter sets are not counted)
+                if last_run_dir is not None and coarse_run_dir is None and os.path.dirname(os.path.normpath(last_run_dir)) == os.path.normpath(spinup_dir):
                     last_years = self.real_years(last_run_dir)
                     logger.debug('Found previous run(s) with total {} years.'.format(last_years))
                 else:
@@ -420,40 +644,243 @@ class Model_Database:
 
                 initial_concentration_options = self.model_options.initial_concentration_options
 
-                if last_run_dir is None and initial_concentration_options.use_constant_concentrations:
+                if warm_start_tracer_vectors is not None:
+                    concentration_files = self.save_warm_start_tracer_vectors(run_dir, warm_start_tracer_vectors)
+                    self.start_run(parameters, run_dir, years, tolerance=tolerance, job_options=self.job_options_for_kind('spinup', years=years), tracer_input_files=concentration_files, wait_until_finished=False)
+                elif last_run_dir is None and initial_concentration_options.use_constant_concentrations:
                     constant_concentrations = initial_concentration_options.concentrations
-                    self.start_run(parameters, run_dir, years, tolerance=tolerance, job_options=self.job_options_for_kind('spinup'), initial_constant_concentrations=constant_concentrations, wait_until_finished=True)
+                    self.start_run(parameters, run_dir, years, tolerance=tolerance, job_options=self.job_options_for_kind('spinup', years=years), initial_constant_concentrations=constant_concentrations, wait_until_finished=False)
                 else:
                     if last_run_dir is None:
                         concentration_files = self.initial_concentration_files
                     else:
                         with simulation.model.job.Metos3D_Job(last_run_dir, force_load=True) as job:
                             concentration_files = job.tracer_output_files
-                    self.start_run(parameters, run_dir, years, tolerance=tolerance, job_options=self.job_options_for_kind('spinup'), tracer_input_files=concentration_files, wait_until_finished=True)
+                    self.start_run(parameters, run_dir, years, tolerance=tolerance, job_options=self.job_options_for_kind('spinup', years=years), tracer_input_files=concentration_files, wait_until_finished=False)
 
             else:
                 assert combination == 'and'
+                ## (multilevel options are not passed since they are not used with tolerance 0)
                 spinup_options = simulation.model.options.SpinupOptions({'years':years, 'tolerance':0, 'combination':'or'})
-                run_dir = self.matching_run_dir(spinup_options)
+                run_dir = self.matching_run_dir(spinup_options, wait_until_finished=False)
+                if self.is_run_in_progress(run_dir):
+                    return (None, run_dir)
                 spinup_options = simulation.model.options.SpinupOptions({'years':self.model_spinup_max_years, 'tolerance':tolerance, 'combination':'or'})
-                run_dir = self.matching_run_dir(spinup_options)
+                run_dir = self.matching_run_dir(spinup_options, wait_until_finished=False)
 
             logger.debug('Spinup run directory created at {}.'.format(run_dir))
 
+        return (run_dir, None)
+
+
+    def matching_coarse_run_dir(self, spinup_options, wait_until_finished=True):
+        ## spinup with next coarser multilevel time step (which itself starts from the next coarser time step)
+        time_step = self.model_options.time_step
+        coarse_time_steps = [coarse_time_step for coarse_time_step in spinup_options.multilevel_time_steps if coarse_time_step > time_step]
+        if len(coarse_time_steps) == 0:
+            return None
+        coarse_time_step = min(coarse_time_steps)
+
+        coarse_spinup_options = simulation.model.options.SpinupOptions({'years': spinup_options.multilevel_years, 'tolerance': spinup_options.multilevel_tolerance, 'combination': 'or', 'match_type': 'best', 'multilevel_time_steps': spinup_options.multilevel_time_steps, 'multilevel_years': spinup_options.multilevel_years, 'multilevel_tolerance': spinup_options.multilevel_tolerance})
+        logger.debug('Using spinup with coarser time step {} and options {} as initial state for time step {}.'.format(coarse_time_step, coarse_spinup_options, time_step))
+
+        self.model_options.time_step = coarse_time_step
+        try:
+            coarse_run_dir = self.matching_run_dir(coarse_spinup_options, wait_until_finished=wait_until_finished)
+        finally:
+            self.model_options.time_step = time_step
+
+        return coarse_run_dir
+
+
+    ## warm start
+
+    def _warm_start_partial_derivative_runs(self, index, spinup_run_dir):
+        ## finished forward or backward partial derivative runs for all model parameters of the parameter set with passed index
+        derivative_options = self.model_options.derivative_options
+        derivative_dirname = simulation.model.constants.DATABASE_DERIVATIVE_DIRNAME.format(spinup_real_years=self.real_years(spinup_run_dir), derivative_step_size=derivative_options.step_size, derivative_years=derivative_options.years)
+        derivative_dir = os.path.join(self.parameter_set_dir_with_index(index), derivative_dirname)
+        if not os.path.exists(derivative_dir):
+            return None
+
+        partial_derivative_runs = []
+        for parameter_index in range(self.model_options.parameters_len):
+            partial_derivative_run = None
+            for h_factor in (1, -1):
+                partial_derivative_dirname = simulation.model.constants.DATABASE_PARTIAL_DERIVATIVE_DIRNAME.format(kind='model_parameters', index=parameter_index, h_factor=h_factor)
+                partial_derivative_dir = os.path.join(derivative_dir, partial_derivative_dirname)
+                if os.path.exists(partial_derivative_dir):
+                    partial_derivative_run_dir = self.last_run_dir(partial_derivative_dir)
+                    if partial_derivative_run_dir is not None and self.is_run_finished(partial_derivative_run_dir):
+                        partial_derivative_run = simulation.model.warm_start.run_parameters_and_tracer_vectors(partial_derivative_run_dir)
+                        break
+            if partial_derivative_run is None:
+                logger.debug('No finished partial derivative run for parameter {} in {} available.'.format(parameter_index, derivative_dir))
+                return None
+            partial_derivative_runs.append(partial_derivative_run)
+
+        return partial_derivative_runs
+
+
+    def warm_start_tracer_vectors(self):
+        parameters = self.model_options.parameters
+        logger.debug('Predicting initial tracer vectors for parameters {} from nearest parameter sets.'.format(parameters))
+
+        ## get finished runs of nearest parameter sets
+        neighbour_indices = []
+        neighbour_run_dirs = []
+        neighbour_parameters = []
+        neighbour_tracer_vectors = []
+        nearest_indices, distances = self._parameter_index.nearest(parameters, k=self.warm_start_neighbours)
+        for index in nearest_indices:
+            run_dir = self.last_run_dir(self.spinup_dir_with_index(index))
+            if run_dir is not None and self.is_run_finished(run_dir):
+                run_parameters, tracer_vectors = simulation.model.warm_start.run_parameters_and_tracer_vectors(run_dir)
+                neighbour_indices.append(index)
+                neighbour_run_dirs.append(run_dir)
+                neighbour_parameters.append(run_parameters)
+                neighbour_tracer_vectors.append(tracer_vectors)
+
+        if len(neighbour_indices) == 0:
+            logger.debug('No finished runs of nearest parameter sets available.')
+            return None
+
+        ## get partial derivative runs of nearest parameter set
+        if self.warm_start_taylor:
+            partial_derivative_runs = self._warm_start_partial_derivative_runs(neighbour_indices[0], neighbour_run_dirs[0])
+        else:
+            partial_derivative_runs = None
+
+        ## a single neighbour without derivative is the closest run
+        if len(neighbour_indices) == 1 and partial_derivative_runs is None:
+            logger.debug('Only one nearest parameter set without partial derivative runs available.')
+            return None
+
+        typical_parameters = simulation.model.constants.MODEL_PARAMETER_TYPICAL[self.model_options.model_name]
+        return simulation.model.warm_start.predicted_tracer_vectors(parameters, neighbour_parameters, neighbour_tracer_vectors, typical_parameters, partial_derivative_runs=partial_derivative_runs)
+
+
+    def save_warm_start_tracer_vectors(self, run_dir, tracer_vectors):
+        warm_start_files = [os.path.join(run_dir, simulation.model.constants.DATABASE_WARM_START_FILENAME.format(tracer=tracer)) for tracer in self.model_options.tracers]
+        simulation.model.warm_start.save_tracer_vectors(warm_start_files, tracer_vectors)
+        logger.debug('Initial tracer vectors saved to {}.'.format(warm_start_files))
+        return [self._output_path_with_env(warm_start_file) for warm_start_file in warm_start_files]
+
+
+    def accelerated_matching_run_dir(self, spinup_options=None, segment_years=None, memory=None):
+        ## chain short runs in the spinup dir, each starting from the anderson accelerated state of the previous runs
+        if spinup_options is None:
+            spinup_options = self.model_options.spinup_options
+        spinup_options = util.options.as_options(spinup_options, simulation.model.options.SpinupOptions)
+        if segment_years is None:
+            segment_years = simulation.model.constants.MODEL_SPINUP_ACCELERATION_SEGMENT_YEARS
+
+        if spinup_options.combination == 'or':
+            max_years = spinup_options.years
+        else:
+            max_years = self.model_spinup_max_years
+        tolerance = spinup_options.tolerance
+        parameters = self.model_options.parameters
+
+        spinup_dir = self.spinup_dir
+        logger.debug('Accelerated spinup with options {}, segments of {} years in {}.'.format(spinup_options, segment_years, spinup_dir))
+
+        accelerator = simulation.model.accelerated_spinup.Anderson_Accelerator(memory=memory)
+        is_accelerator_seeded = False
+
+        ## decide and start next segment exclusively, but wait for runs in progress without lock
+        while True:
+            with self._run_lock(spinup_dir):
+                self._remove_abandoned_run(spinup_dir)
+                run_dir = self.last_run_dir(spinup_dir)
+
+                if run_dir is None or not self.is_run_in_progress(run_dir):
+
+                    ## matching run found
+                    if self.is_run_matching_options(run_dir, spinup_options):
+                        break
+
+                    ## first segment as usual spinup
+                    if run_dir is None:
+                        first_spinup_options = simulation.model.options.SpinupOptions({'years': min(segment_years, max_years), 'tolerance': tolerance, 'combination': 'or', 'multilevel_time_steps': spinup_options.multilevel_time_steps, 'multilevel_years': spinup_options.multilevel_years, 'multilevel_tolerance': spinup_options.multilevel_tolerance})
+                        run_dir = self.matching_run_dir(first_spinup_options, wait_until_finished=False)
+
+                    else:
+                        ## stop if max years reached
+                        last_years = self.real_years(run_dir)
+                        if last_years >= max_years:
+                            logger.debug('Accelerated spinup reached {} years without matching options.'.format(last_years))
+                            break
+
+                        ## seed history with the previous runs of the chain (which may have been started by another process)
+                        if not is_accelerator_seeded:
+                            previous_run_dirs = []
+                            previous_run_dir = self.previous_run_dir(run_dir)
+                            while previous_run_dir is not None and len(previous_run_dirs) < accelerator.memory:
+                                previous_run_dirs.insert(0, previous_run_dir)
+                                previous_run_dir = self.previous_run_dir(previous_run_dir)
+                            simulation.model.accelerated_spinup.update_accelerator_with_runs(accelerator, previous_run_dirs)
+                            is_accelerator_seeded = True
+
+                        ## accelerate (with clipped negative concentrations and preserved total mass)
+                        tracer_input_vectors, tracer_output_vectors = simulation.model.accelerated_spinup.run_input_and_output_tracer_vectors(run_dir)
+                        if tracer_input_vectors is None:
+                            next_tracer_vectors = tracer_output_vectors
+                        else:
+                            next_state = accelerator.next_state(simulation.model.accelerated_spinup.state_from_tracer_vectors(tracer_input_vectors), simulation.model.accelerated_spinup.state_from_tracer_vectors(tracer_output_vectors))
+                            next_tracer_vectors = simulation.model.warm_start.clipped_tracer_vectors(simulation.model.accelerated_spinup.tracer_vectors_from_state(next_state, tracer_output_vectors), tracer_output_vectors)
+
+                        ## start next segment
+                        years = min(segment_years, max_years - last_years)
+                        run_dir = self.make_new_run_dir(spinup_dir)
+                        tracer_input_files = [os.path.join(run_dir, simulation.model.constants.DATABASE_ACCELERATED_SPINUP_FILENAME.format(tracer=tracer)) for tracer in self.model_options.tracers]
+                        simulation.model.warm_start.save_tracer_vectors(tracer_input_files, next_tracer_vectors)
+                        tracer_input_files = [self._output_path_with_env(tracer_input_file) for tracer_input_file in tracer_input_files]
+                        self.start_run(parameters, run_dir, years, tolerance=tolerance, job_options=self.job_options_for_kind('spinup', years=years), tracer_input_files=tracer_input_files, wait_until_finished=False)
+
+            logger.debug('Waiting for run {} in progress.'.format(run_dir))
+            self.wait_until_run_finished(run_dir)
+
+        logger.debug('Accelerated spinup run directory is {}.'.format(run_dir))
         return run_dir
 
 
-    def start_run(self, model_parameters, output_path, years, tolerance=0, job_options=None, write_trajectory=False, initial_constant_concentrations=None, tracer_input_files=None, total_concentration_factor=1, make_read_only=True, wait_until_finished=True):
+    def start_matching_run(self, spinup_options=None):
+        if spinup_options is None:
+            spinup_options = self.model_options.spinup_options
+
+        ## last run is still running
+        last_run_dir = self.last_run_dir(self.spinup_dir)
+        if last_run_dir is not None and not self.is_run_finished(last_run_dir):
+            logger.debug('Last run {} is not finished. No new run is started.'.format(last_run_dir))
+            return last_run_dir
+
+        ## start matching run if needed without waiting
+        return self.matching_run_dir(spinup_options, wait_until_finished=False)
+
+
+    def _output_path_with_env(self, output_path):
+        return output_path.replace(simulation.constants.SIMULATION_OUTPUT_DIR, '${{{}}}'.format(simulation.constants.SIMULATION_OUTPUT_DIR_ENV_NAME))
+
+
+    def write_run(self, model_parameters, output_path, years, tolerance=0, job_options=None, write_trajectory=False, write_trajectory_modulo=1, initial_constant_concentrations=None, tracer_input_files=None, total_concentration_factor=1):
 
         model_name = self.model_options.model_name
         time_step = self.model_options.time_step
 
+        ## write job
+        with simulation.model.job.Metos3D_Job(self._output_path_with_env(output_path)) as job:
+            job.write_job_file(model_name, model_parameters, years=years, tolerance=tolerance, time_step=time_step, initial_constant_concentrations=initial_constant_concentrations, tracer_input_files=tracer_input_files, total_concentration_factor=total_concentration_factor, write_trajectory=write_trajectory, write_trajectory_modulo=write_trajectory_modulo, job_options=job_options)
+
+
+    def start_run(self, model_parameters, output_path, years, tolerance=0, job_options=None, write_trajectory=False, write_trajectory_modulo=1, initial_constant_concentrations=None, tracer_input_files=None, total_concentration_factor=1, make_read_only=True, wait_until_finished=True):
+
         ## execute job
-        output_path_with_env = output_path.replace(simulation.constants.SIMULATION_OUTPUT_DIR, '${{{}}}'.format(simulation.constants.SIMULATION_OUTPUT_DIR_ENV_NAME))
-        with simulation.model.job.Metos3D_Job(output_path_with_env) as job:
-            job.write_job_file(model_name, model_parameters, years=years, tolerance=tolerance, time_step=time_step, initial_constant_concentrations=initial_constant_concentrations, tracer_input_files=tracer_input_files, total_concentration_factor=total_concentration_factor, write_trajectory=write_trajectory, job_options=job_options)
-            job.start()
+        self.write_run(model_parameters, output_path, years, tolerance=tolerance, job_options=job_options, write_trajectory=write_trajectory, write_trajectory_modulo=write_trajectory_modulo, initial_constant_concentrations=initial_constant_concentrations, tracer_input_files=tracer_input_files, total_concentration_factor=total_concentration_factor)
+        with simulation.model.job.Metos3D_Job(self._output_path_with_env(output_path), force_load=True) as job:
+            job_handle = job.start()
             job.make_read_only_input(make_read_only)
+        simulation.model.job.release(output_path)
 
         ## wait to finish
         if wait_until_finished:
@@ -461,15 +888,139 @@ class Model_Database:
         else:
             logger.debug('Not waiting for job to finish.')
 
+        return job_handle
+
+
+    ## batch jobs
+
+    def _batch_nodes_setup(self, job_options):
+        nodes_setup = job_options.get('nodes_setup')
+        if nodes_setup is None:
+            nodes_setup = util.batch.universal.system.NodeSetup(memory=simulation.model.constants.JOB_MEMORY_GB)
+        return nodes_setup
+
+
+    def _batch_parallel_runs(self, nodes_setup, number_of_runs, parallel_runs=None):
+        ## at most one parallel run for each cpu of the batch job (by default as many as possible)
+        total_cpus = nodes_setup.nodes * nodes_setup.cpus
+        if parallel_runs is None:
+            parallel_runs = total_cpus
+        return max(min(parallel_runs, number_of_runs, total_cpus), 1)
+
+
+    def _batch_run_nodes_setup(self, nodes_setup, parallel_runs=1):
+        ## each parallel run gets a disjoint share of the nodes and cpus of the batch job
+        nodes = nodes_setup.nodes
+        cpus = nodes_setup.cpus
+        if parallel_runs <= nodes:
+            run_nodes = nodes // parallel_runs
+            run_cpus = cpus
+        else:
+            run_nodes = 1
+            run_cpus = max(cpus // int(np.ceil(parallel_runs / nodes)), 1)
+        return util.batch.universal.system.NodeSetup(memory=nodes_setup.memory, node_kind=nodes_setup.node_kind, nodes=run_nodes, cpus=run_cpus, nodes_max=run_nodes)
+
+
+    def _copy_job_options(self, job_options):
+        job_options = job_options.copy()
+        if job_options.get('nodes_setup') is not None:
+            job_options['nodes_setup'] = job_options['nodes_setup'].copy()
+        return job_options
+
+
+    def start_runs_batch(self, run_dirs, nodes_setup, job_name, tmp_base_dir, parallel_runs=1, array=False, make_read_only=True):
+        ## start written runs in one batch job or as one job array
+        run_walltime_seconds = []
+        for run_dir in run_dirs:
+            with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+                walltime_seconds = job.estimated_walltime_seconds
+                if walltime_seconds is None:
+                    walltime_seconds = (job.walltime_hours or 0) * 60**2
+                run_walltime_seconds.append(walltime_seconds)
+        if nodes_setup.walltime is None and max(run_walltime_seconds) > 0:
+            if array:
+                nodes_setup.walltime = int(np.ceil(max(run_walltime_seconds) / 60**2))
+            else:
+                ## the groups of parallel runs are executed one after another, each as long as its longest run
+                walltime_seconds = sum(max(run_walltime_seconds[i:i + parallel_runs]) for i in range(0, len(run_walltime_seconds), parallel_runs))
+                nodes_setup.walltime = int(np.ceil(walltime_seconds / 60**2))
+
+        batch_dir = self._tmp_dir(tmp_base_dir, prefix='batch_tmp_')
+        with simulation.model.job.Metos3D_Batch_Job(self._output_path_with_env(batch_dir)) as batch_job:
+            batch_job.write_job_file([self._output_path_with_env(run_dir) for run_dir in run_dirs], nodes_setup, job_name=job_name, parallel_runs=parallel_runs, array=array)
+            job_handles = batch_job.start()
+        self._batch_dirs.append(batch_dir)
+
+        for run_dir in run_dirs:
+            with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+                job.make_read_only_input(make_read_only)
+            simulation.model.job.release(run_dir)
+
+        logger.debug('Runs {} started in batch job {}.'.format(run_dirs, batch_dir))
+        return job_handles
+
+
+    def remove_finished_batch_jobs(self):
+        for batch_dir in tuple(self._batch_dirs):
+            with simulation.model.job.Metos3D_Batch_Job(batch_dir, force_load=True) as batch_job:
+                are_jobs_finished = batch_job.are_jobs_finished()
+            if are_jobs_finished:
+                logger.debug('Removing finished batch job {}.'.format(batch_dir))
+                util.io.fs.remove_recursively(batch_dir, not_exist_okay=True, exclude_dir=False)
+                self._batch_dirs.remove(batch_dir)
+
 
     ##  access run properties
 
     def wait_until_run_finished(self, run_dir, make_read_only=True):
+        self._wait_until_run_reservation_ended(run_dir)
         with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
             job.make_read_only_input(make_read_only)
             job.wait_until_finished()
             job.make_read_only_output(make_read_only)
 
+        ## parameter set with finished spinup can be used for warm starts
+        if self.start_from_closest_parameters:
+            self._add_to_parameter_index(run_dir)
+
+
+    async def wait_until_run_finished_async(self, run_dir, make_read_only=True):
+        await simulation.model.asynchronous.wait_until_finished(run_dir)
+        model = self._concurrent_copy()
+        await simulation.model.asynchronous.run_blocking(model.wait_until_run_finished, run_dir, make_read_only=make_read_only)
+
+
+    async def matching_run_dir_async(self, spinup_options=None, model_options=None):
+        ## evaluated with an own copy of the model options, so concurrent evaluations do not interfere
+        model = self._concurrent_copy(model_options)
+        if spinup_options is None:
+            spinup_options = model.model_options.spinup_options
+
+        ## runs needed as initial state (also of coarser time steps or of other parameter sets) are returned while they are in progress
+        def start_matching_run():
+            run_dir = model.start_matching_run(spinup_options)
+            is_matching = os.path.dirname(os.path.normpath(run_dir)) == os.path.normpath(model.spinup_dir) and model.is_run_finished(run_dir) and model.is_run_matching_options(run_dir, spinup_options)
+            return (run_dir, is_matching)
+
+        ## start runs and wait for them until a finished matching run is available
+        while True:
+            run_dir, is_matching = await simulation.model.asynchronous.run_blocking(start_matching_run)
+            if is_matching:
+                logger.debug('Matching run {} for spinup options {} is available.'.format(run_dir, spinup_options))
+                return run_dir
+            await self.wait_until_run_finished_async(run_dir)
+
+
+    def is_run_finished(self, run_dir):
+        (spinup_dir, run_dirname) = os.path.split(run_dir)
+        run_index = util.pattern.get_int_in_string(run_dirname)
+        if simulation.model.run_ledger.Run_Ledger(spinup_dir).entry(run_index) is not None:
+            return True
+        if self.is_run_reserved(run_dir):
+            return False
+        with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+            return job.is_finished(check_exit_code=False)
+
 
     def is_run_matching_options(self, run_dir, spinup_options):
         if run_dir is not None:
@@ -480,8 +1031,7 @@ class Model_Database:
             tolerance = spinup_options.tolerance
             combination = spinup_options.combination
 
-            run_years = self.real_years(run_dir)
-            run_tolerance = self.real_tolerance(run_dir)
+            (run_last_years, run_years, run_tolerance, run_finished) = self.run_ledger_entry(run_dir)
 
             if combination == 'and':
                 is_matching = (run_years >= years and run_tolerance <= tolerance) or run_years >= model_spinup_max_years
@@ -503,43 +1053,168 @@ class Model_Database:
         return is_matching
 
 
+    def run_ledger_entry(self, run_dir):
+        (spinup_dir, run_dirname) = os.path.split(run_dir)
+        run_index = util.pattern.get_int_in_string(run_dirname)
+        run_ledger = simulation.model.run_ledger.Run_Ledger(spinup_dir)
+        entries = run_ledger.entries()
+
+        ## add missing entries of run chain from job output
+        if run_index not in entries:
+            first_missing_run_index = run_index
+            while first_missing_run_index > 0 and first_missing_run_index - 1 not in entries:
+                first_missing_run_index -= 1
+
+            for missing_run_index in range(first_missing_run_index, run_index + 1):
+                missing_run_dir = os.path.join(spinup_dir, simulation.model.constants.DATABASE_RUN_DIRNAME.format(missing_run_index))
+                with simulation.model.job.Metos3D_Job(missing_run_dir, force_load=True) as job:
+                    years = job.last_year
+                    tolerance = job.last_tolerance
+                    finished = job.is_finished(check_exit_code=False)
+                if missing_run_index > 0:
+                    cumulative_years = entries[missing_run_index - 1][1] + years
+                else:
+                    cumulative_years = years
+                entries[missing_run_index] = (years, cumulative_years, tolerance, finished)
+
+                ## only finished runs are added since runs in progress change
+                if finished:
+                    try:
+                        run_ledger.add(missing_run_index, years, cumulative_years, tolerance, finished=True)
+                    except OSError as exception:
+                        logger.warn('Run ledger in {} could not be updated: {}'.format(spinup_dir, exception))
+                    self._update_catalog('add_run', missing_run_dir, simulation.model.catalog.parameter_set_dir_of(missing_run_dir), simulation.model.catalog.run_kind(missing_run_dir), missing_run_index, years=years, cumulative_years=cumulative_years, tolerance=tolerance, finished=True)
+
+        return entries[run_index]
+
+
     def real_years(self, run_dir=None):
         if run_dir is None:
             run_dir = self.run_dir
-        real_years = 0
-        while run_dir is not None:
-            with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
-                years = job.last_year
-            real_years += years
-            run_dir = self.previous_run_dir(run_dir)
+        (years, real_years, tolerance, finished) = self.run_ledger_entry(run_dir)
         return real_years
 
 
     def real_tolerance(self, run_dir):
         if run_dir is None:
             run_dir = self.run_dir
-        with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
-            tolerance = job.last_tolerance
+        (years, real_years, tolerance, finished) = self.run_ledger_entry(run_dir)
         return tolerance
 
 
     ## job options
 
-    def job_options_for_kind(self, kind):
-        job_options = self.job_options[kind]
-        job_options = job_options.copy()
-        try:
-            job_options['nodes_setup']
-        except KeyError:
-            pass
-        else:
-            if job_options['nodes_setup'] is not None:
-                job_options['nodes_setup'] = job_options['nodes_setup'].copy()
+    def job_options_for_kind(self, kind, years=None):
+        job_options = self._copy_job_options(self.job_options[kind])
+
+        ## select node setup with minimal expected time to result
+        if self.nodes_setup_selector is not None:
+            if years is None:
+                if kind == 'spinup':
+                    years = self.model_options.spinup_options.years
+                elif kind == 'derivative':
+                    years = self.model_options.derivative_options.years
+                else:
+                    years = 1
+            job_options['nodes_setup'] = self.nodes_setup_selector.select_for_nodes_setup(job_options.get('nodes_setup'), self.model_options.model_name, self.model_options.time_step, years)
+
         return job_options
 
 
+    ## catalog
+
+    @property
+    def _concentrations_kind(self):
+        if self.model_options.initial_concentration_options.use_constant_concentrations:
+            return 'constant'
+        else:
+            return 'vector'
+
+
+    def _update_catalog(self, method_name, *args, **kargs):
+        if self.catalog is not None:
+            try:
+                getattr(self.catalog, method_name)(*args, **kargs)
+            except (sqlite3.Error, OSError) as exception:
+                logger.warn('{} could not be updated: {}'.format(self.catalog, exception))
+                ## catalog is missing this change, so it must not be used instead of the directories until it is rebuilt
+                try:
+                    self.catalog.set_complete(False)
+                except (sqlite3.Error, OSError) as exception:
+                    logger.warn('{} could not be marked as incomplete: {}'.format(self.catalog, exception))
+
+
+    def _is_catalog_complete(self):
+        if self.catalog is None:
+            return False
+        try:
+            return self.catalog.is_complete()
+        except (sqlite3.Error, OSError) as exception:
+            logger.warn('{} could not be read: {}'.format(self.catalog, exception))
+            return False
+
+
+    def rebuild_catalog(self, model_names=None):
+        if self.catalog is None:
+            raise ValueError('The catalog is disabled.')
+
+        ## search all parameter sets, runs and cached files in the directories
+        parameter_sets = []
+        runs = []
+        files = []
+
+        for model_options in self._iterator_from_directories(model_names=model_names):
+            parameter_set_dir = self.parameter_set_dir
+            logger.debug('Adding {} to catalog.'.format(parameter_set_dir))
+            parameter_sets.append((parameter_set_dir, model_options.model_name, self._concentrations_kind, self.initial_concentration_dir_index, model_options.initial_concentration_options.concentrations, model_options.time_step, self._parameter_hash.index(model_options.parameters), model_options.parameters))
+
+            job_option_files = util.io.fs.get_files(parameter_set_dir, filename_pattern='*/' + simulation.model.constants.JOB_OPTIONS_FILENAME, use_absolute_filenames=True, recursive=True)
+            for job_option_file in job_option_files:
+                run_dir = os.path.dirname(job_option_file)
+                try:
+                    (years, cumulative_years, tolerance, finished) = self.run_ledger_entry(run_dir)
+                except OSError as exception:
+                    logger.warn('Run {} could not be added to catalog: {}'.format(run_dir, exception))
+                else:
+                    runs.append((run_dir, parameter_set_dir, simulation.model.catalog.run_kind(run_dir), util.pattern.get_int_in_string(os.path.basename(run_dir)), years, cumulative_years, tolerance, finished))
+
+            run_base_dirs = tuple(os.path.join(parameter_set_dir, dirname) + os.sep for dirname in (simulation.model.constants.DATABASE_SPINUP_DIRNAME, simulation.model.constants.DATABASE_DERIVATIVE_DIRNAME.split(os.sep)[0]))
+            for file in util.io.fs.get_files(parameter_set_dir, filename_pattern='*.np[yz]', use_absolute_filenames=True, recursive=True):
+                if not file.startswith(run_base_dirs):
+                    files.append((file, parameter_set_dir))
+
+        self.catalog.rebuild(parameter_sets, runs, files)
+
+
     ## iterator
+
     def iterator(self, model_names=None):
+        if self._is_catalog_complete():
+            return self._iterator_from_catalog(model_names=model_names)
+        else:
+            return self._iterator_from_directories(model_names=model_names)
+
+
+    def _iterator_from_catalog(self, model_names=None):
+        if model_names is None:
+            model_names = simulation.model.constants.MODEL_NAMES
+        old_model_options = self.model_options.copy()
+        model_options = self.model_options
+        model_options.spinup_options = {'years':1, 'tolerance':0.0, 'combination':'or'}
+
+        for (parameter_set_dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters) in self.catalog.parameter_sets(model_names=model_names):
+            model_options.model_name = model_name
+            if concentrations_kind != 'constant':
+                concentrations = self._vector_concentrations_db.get_value(concentrations_index)
+            model_options.initial_concentration_options.concentrations = concentrations
+            model_options.time_step = time_step
+            model_options.parameters = parameters
+            yield model_options
+
+        self.model_options = old_model_options
+
+
+    def _iterator_from_directories(self, model_names=None):
         if model_names is None:
             model_names = simulation.model.constants.MODEL_NAMES
         time_steps = simulation.model.constants.METOS_TIME_STEPS
@@ -583,20 +1258,37 @@ class Model_Database:
         self.model_options = model_options
 
         try:
-            for model_name in model_names:
-                model_options.model_name = model_name
-                model_dir = self.model_dir
-                if os.path.exists(model_dir):
-                    if os.path.exists(os.path.join(model_dir, simulation.model.constants.DATABASE_CONSTANT_CONCENTRATIONS_DIRNAME)):
-                        concentrations_db = self._constant_concentrations_db
-                        concentrations_db.check_integrity()
-                        for concentration in concentrations_db.all_values():
-                            model_options.initial_concentration_options.concentrations = concentration
-                            for time_step in time_steps:
-                                model_options.time_step = time_step
-                                if os.path.exists(self.time_step_dir):
-                                    parameter_db = self._parameter_db
-                                    parameter_db.check_integrity()
+            ## use catalog if complete, otherwise search database
+            if self._is_catalog_complete():
+                checked_concentrations_models = set()
+                checked_time_step_dirs = set()
+                for (parameter_set_dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters) in self.catalog.parameter_sets(model_names=model_names):
+                    if concentrations_kind == 'constant':
+                        model_options.model_name = model_name
+                        if model_name not in checked_concentrations_models:
+                            self._constant_concentrations_db.check_integrity()
+                            checked_concentrations_models.add(model_name)
+                        time_step_dir = os.path.dirname(parameter_set_dir)
+                        if time_step_dir not in checked_time_step_dirs:
+                            model_options.initial_concentration_options.concentrations = concentrations
+                            model_options.time_step = time_step
+                            self._parameter_db.check_integrity()
+                            checked_time_step_dirs.add(time_step_dir)
+            else:
+                for model_name in model_names:
+                    model_options.model_name = model_name
+                    model_dir = self.model_dir
+                    if os.path.exists(model_dir):
+                        if os.path.exists(os.path.join(model_dir, simulation.model.constants.DATABASE_CONSTANT_CONCENTRATIONS_DIRNAME)):
+                            concentrations_db = self._constant_concentrations_db
+                            concentrations_db.check_integrity()
+                            for concentration in concentrations_db.all_values():
+                                model_options.initial_concentration_options.concentrations = concentration
+                                for time_step in time_steps:
+                                    model_options.time_step = time_step
+                                    if os.path.exists(self.time_step_dir):
+                                        parameter_db = self._parameter_db
+                                        parameter_db.check_integrity()
         except util.index_database.general.DatabaseError as e:
             logger.error(e)
             raise
@@ -664,37 +1356,194 @@ class Model_With_F(Model_Database):
         return interpolated_values
 
 
-    def _trajectory_with_load_function(self, trajectory_load_function, run_dir, model_parameters, tracers=None):
+    def _write_trajectory_modulo(self, time_dim):
+        averaging_mode = self.trajectory_averaging_mode
+
+        ## write all time steps and average afterwards
+        if time_dim is None or averaging_mode == 'average':
+            write_trajectory_modulo = 1
+
+        ## write only time steps for desired time dim
+        elif averaging_mode == 'snapshot':
+            time_steps_per_year = self.model_options.time_steps_per_year
+            if time_steps_per_year % time_dim != 0:
+                raise ValueError('The desired time dimension {0} can not be satisfied because the time steps per year {1} are not divisible by {0}.'.format(time_dim, time_steps_per_year))
+            write_trajectory_modulo = time_steps_per_year // time_dim
+
+        else:
+            raise ValueError('Trajectory averaging mode "{}" unknown. Possible modes are: {}'.format(averaging_mode, ['average', 'snapshot']))
+
+        logger.debug('Using trajectory write modulo {} for time dim {} and averaging mode {}.'.format(write_trajectory_modulo, time_dim, averaging_mode))
+        return write_trajectory_modulo
+
+
+    def _trajectory_store_key(self, run_dir, model_parameters):
+        ## output of run dir identifies trajectory (run dirs can be removed and made again)
+        with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+            run_tracer_output_files = job.tracer_output_files
+        run_tracer_output_files = [os.path.expanduser(os.path.expandvars(file)) for file in run_tracer_output_files]
+        run_tracer_output_modification_times = tuple(os.stat(file).st_mtime_ns for file in run_tracer_output_files)
+
+        key = (os.path.realpath(run_dir), tuple(float(p) for p in model_parameters), run_tracer_output_modification_times)
+        return key
+
+
+    def _tmp_dir(self, run_dir, prefix='trajectory_tmp_'):
         TMP_DIR = simulation.model.constants.DATABASE_TMP_DIR
 
+        if TMP_DIR is not None:
+            tmp_dir = TMP_DIR
+            os.makedirs(tmp_dir, exist_ok=True)
+        else:
+            tmp_dir = run_dir
+
+        return tempfile.mkdtemp(dir=tmp_dir, prefix=prefix)
+
+
+    def _write_trajectory_run(self, run_dir, model_parameters, write_trajectory_modulo=1, job_options=None):
+        if job_options is None:
+            job_options = self.job_options_for_kind('trajectory', years=1)
+
+        ## write trajectory
+        trajectory_dir = self._tmp_dir(run_dir)
+
+        with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+            run_tracer_output_files = job.tracer_output_files
+
+        self.write_run(model_parameters, trajectory_dir, years=1, tolerance=0, job_options=job_options, tracer_input_files=run_tracer_output_files, write_trajectory=True, write_trajectory_modulo=write_trajectory_modulo)
+        return trajectory_dir
+
+
+    def _start_trajectory_run(self, run_dir, model_parameters, write_trajectory_modulo=1):
+        trajectory_dir = self._write_trajectory_run(run_dir, model_parameters, write_trajectory_modulo=write_trajectory_modulo)
+        with simulation.model.job.Metos3D_Job(self._output_path_with_env(trajectory_dir), force_load=True) as job:
+            job.start()
+        return trajectory_dir
+
+
+    def start_trajectory_runs_batch(self, run_dirs_and_model_parameters, time_dim=None, parallel_runs=None):
+        ## the trajectories are extracted in one batch job and are used by _trajectory_with_load_function afterwards
+        if parallel_runs is None:
+            parallel_runs = self.trajectory_batch_parallel_runs
+        write_trajectory_modulo = self._write_trajectory_modulo(time_dim)
+        run_dirs_and_model_parameters = [(run_dir, model_parameters) for run_dir, model_parameters in run_dirs_and_model_parameters if (os.path.normpath(run_dir), write_trajectory_modulo) not in self._prepared_trajectory_dirs]
+        if len(run_dirs_and_model_parameters) == 0:
+            return []
+
+        ## node setup of batch job and of each run in it
+        job_options = self.job_options_for_kind('trajectory', years=1)
+        nodes_setup = self._batch_nodes_setup(job_options)
+        parallel_runs = self._batch_parallel_runs(nodes_setup, len(run_dirs_and_model_parameters), parallel_runs=parallel_runs)
+        run_job_options = {'name': job_options['name'], 'nodes_setup': self._batch_run_nodes_setup(nodes_setup, parallel_runs=parallel_runs)}
+
+        ## write trajectory runs
+        trajectory_dirs = []
+        for run_dir, model_parameters in run_dirs_and_model_parameters:
+            trajectory_dir = self._write_trajectory_run(run_dir, model_parameters, write_trajectory_modulo=write_trajectory_modulo, job_options=self._copy_job_options(run_job_options))
+            trajectory_dirs.append(trajectory_dir)
+
+        ## start batch job
+        self.start_runs_batch(trajectory_dirs, nodes_setup, job_options['name'] + '_batch', run_dirs_and_model_parameters[0][0], parallel_runs=parallel_runs, make_read_only=False)
+
+        ## register trajectory dirs as prepared
+        for (run_dir, model_parameters), trajectory_dir in zip(run_dirs_and_model_parameters, trajectory_dirs):
+            self._prepared_trajectory_dirs[(os.path.normpath(run_dir), write_trajectory_modulo)] = trajectory_dir
+
+        logger.debug('Trajectory runs {} started in one batch job.'.format(trajectory_dirs))
+        return trajectory_dirs
+
+
+    async def _prepare_trajectory_async(self, run_dir, model_parameters, time_dim=None, model_options=None):
+        model = self._concurrent_copy(model_options)
+        write_trajectory_modulo = model._write_trajectory_modulo(time_dim)
+        prepared_trajectory_key = (os.path.normpath(run_dir), write_trajectory_modulo)
+
+        if prepared_trajectory_key not in self._prepared_trajectory_dirs:
+            trajectory_dir = await simulation.model.asynchronous.run_blocking(model._start_trajectory_run, run_dir, model_parameters, write_trajectory_modulo=write_trajectory_modulo)
+            await self.wait_until_run_finished_async(trajectory_dir, make_read_only=False)
+
+            ## trajectory could be prepared concurrently
+            if prepared_trajectory_key in self._prepared_trajectory_dirs:
+                util.io.fs.remove_recursively(trajectory_dir, not_exist_okay=True, exclude_dir=False)
+            else:
+                self._prepared_trajectory_dirs[prepared_trajectory_key] = trajectory_dir
+                logger.debug('Trajectory for run {} prepared in {}.'.format(run_dir, trajectory_dir))
+
+        return prepared_trajectory_key
+
+
+    def _remove_prepared_trajectories(self, prepared_trajectory_keys):
+        ## remove prepared trajectories which were not used (because values were cached meanwhile)
+        for prepared_trajectory_key in prepared_trajectory_keys:
+            trajectory_dir = self._prepared_trajectory_dirs.pop(prepared_trajectory_key, None)
+            if trajectory_dir is not None:
+                logger.debug('Removing unused prepared trajectory in {}.'.format(trajectory_dir))
+                util.io.fs.remove_recursively(trajectory_dir, not_exist_okay=True, exclude_dir=False)
+
+
+    def _trajectory_with_load_function(self, trajectory_load_function, run_dir, model_parameters, tracers=None, time_dim=None, capture_function=None):
         assert callable(trajectory_load_function)
         tracers = self.check_tracers(tracers)
 
         trajectory_values = {}
 
+        ## use trajectory store only if all time steps are written
+        write_trajectory_modulo = self._write_trajectory_modulo(time_dim)
+        if write_trajectory_modulo == 1:
+            trajectory_store = self.trajectory_store
+        else:
+            trajectory_store = None
+        if time_dim is not None:
+            store_time_dim = time_dim
+        else:
+            store_time_dim = self.model_options.time_steps_per_year
+
+        ## read stored trajectories
+        if trajectory_store is not None and len(tracers) > 0:
+            trajectory_store_key = self._trajectory_store_key(run_dir, model_parameters)
+            for tracer in tracers:
+                trajectory = trajectory_store.load(trajectory_store_key, tracer, store_time_dim)
+                if trajectory is not None:
+                    trajectory_loader = simulation.model.data.trajectory_loader_for_array(trajectory)
+                    trajectory_values[tracer] = trajectory_load_function(trajectory_loader, tracer=tracer)
+
+        not_stored_tracers = [tracer for tracer in tracers if tracer not in trajectory_values]
+
+        ## get prepared trajectory
+        prepared_trajectory_key = (os.path.normpath(run_dir), write_trajectory_modulo)
+        trajectory_dir = self._prepared_trajectory_dirs.pop(prepared_trajectory_key, None)
+        if trajectory_dir is not None and len(not_stored_tracers) == 0:
+            util.io.fs.remove_recursively(trajectory_dir, not_exist_okay=True, exclude_dir=False)
+
         ## create and read trajectory
-        if len(tracers) > 0:
+        if len(not_stored_tracers) > 0:
 
             ## create trajectory
-            if TMP_DIR is not None:
-                tmp_dir = TMP_DIR
-                os.makedirs(tmp_dir, exist_ok=True)
+            if trajectory_dir is None:
+                trajectory_dir = self._start_trajectory_run(run_dir, model_parameters, write_trajectory_modulo=write_trajectory_modulo)
             else:
-                tmp_dir = run_dir
+                logger.debug('Using prepared trajectory in {}.'.format(trajectory_dir))
+            self.wait_until_run_finished(trajectory_dir, make_read_only=False)
 
-            ## write trajectory
-            trajectory_dir = tempfile.mkdtemp(dir=tmp_dir, prefix='trajectory_tmp_')
+            ## read trajectory
+            trajectory_output_dir = os.path.join(trajectory_dir, 'trajectory')
+            for tracer in not_stored_tracers:
+                trajectory_loader = simulation.model.data.trajectory_loader_for_files(trajectory_output_dir, tracer)
 
-            with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
-                run_tracer_output_files = job.tracer_output_files
+                ## store time aggregated trajectory
+                if trajectory_store is not None:
+                    trajectory = trajectory_loader(time_dim_desired=store_time_dim)
+                    try:
+                        trajectory_store.save(trajectory_store_key, tracer, trajectory)
+                    except OSError as exception:
+                        logger.warn('Trajectory for tracer {} could not be saved in {}: {}'.format(tracer, trajectory_store, exception))
+                    trajectory_loader = simulation.model.data.trajectory_loader_for_array(trajectory)
 
-            self.start_run(model_parameters, trajectory_dir, years=1, tolerance=0, job_options=self.job_options_for_kind('trajectory'), tracer_input_files=run_tracer_output_files, write_trajectory=True, make_read_only=False)
+                trajectory_values[tracer] = trajectory_load_function(trajectory_loader, tracer=tracer)
 
-            ## read trajectory
-            trajectory_output_dir = os.path.join(trajectory_dir, 'trajectory')
-            for tracer in tracers:
-                trajectory_values_tracer = trajectory_load_function(trajectory_output_dir, tracer=tracer)
-                trajectory_values[tracer] = trajectory_values_tracer
+            ## capture further values from complete trajectory
+            if capture_function is not None and write_trajectory_modulo == 1:
+                capture_function(trajectory_output_dir)
 
             ## remove trajectory
             util.io.fs.remove_recursively(trajectory_dir, not_exist_okay=True, exclude_dir=False)
@@ -705,13 +1554,135 @@ class Model_With_F(Model_Database):
 
 
     def _trajectory_load_function_for_all(self, time_dim):
-        trajectory_load_function = lambda trajectory_path, tracer: simulation.model.data.load_trajectories_to_map(trajectory_path, tracer, time_dim_desired=time_dim)
+        trajectory_load_function = lambda trajectory_loader, tracer: simulation.model.data.convert_trajectory_to_map(trajectory_loader(time_dim_desired=time_dim))
         return trajectory_load_function
 
 
+    def _interpolation_operator_file(self, points_hash, time_dim):
+        from .constants import MODEL_INTERPOLATION_OPERATOR_DIR, MODEL_INTERPOLATION_OPERATOR_FILENAME
+        filename = MODEL_INTERPOLATION_OPERATOR_FILENAME.format(lsm=self.model_lsm, time_dim=time_dim, points_hash=points_hash)
+        return os.path.join(MODEL_INTERPOLATION_OPERATOR_DIR, filename)
+
+
+    def _calculate_interpolation_operator(self, points, time_dim):
+        from .constants import MODEL_INTERPOLATOR_AMOUNT_OF_WRAP_AROUND, METOS_SPACE_DIM, METOS_VECTOR_LEN
+
+        ## convert points to map indices
+        interpolation_points = self.model_lsm.coordinates_to_map_indices(points, discard_year=True, int_indices=False)
+        assert interpolation_points.ndim == 2 and interpolation_points.shape[1] == 4
+
+        ## nearest time index (all time steps contain the same boxes)
+        time_indices = np.round(interpolation_points[:, 0] * (time_dim / self.model_lsm.t_dim)).astype(np.int64) % time_dim
+
+        ## nearest box as metos vector index
+        space_points = np.array(np.unravel_index(simulation.model.data.metos_vector_3D_flat_indices(), METOS_SPACE_DIM)).swapaxes(0, 1)
+        space_interpolator = util.math.interpolate.Periodic_Interpolator(data_points=space_points, data_values=np.arange(METOS_VECTOR_LEN), point_range_size=METOS_SPACE_DIM, wrap_around_amount=MODEL_INTERPOLATOR_AMOUNT_OF_WRAP_AROUND[1:], number_of_linear_interpolators=0)
+        space_indices = np.round(space_interpolator.interpolate(interpolation_points[:, 1:])).astype(np.int64)
+
+        ## make sparse operator (points x trajectory entries)
+        points_len = len(interpolation_points)
+        row_indices = np.arange(points_len)
+        column_indices = time_indices * METOS_VECTOR_LEN + space_indices
+        interpolation_operator = scipy.sparse.csr_matrix((np.ones(points_len), (row_indices, column_indices)), shape=(points_len, time_dim * METOS_VECTOR_LEN))
+        return interpolation_operator
+
+
+    def _interpolation_operator(self, points, time_dim):
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        points_hash = hashlib.sha1(points.tobytes()).hexdigest()
+        key = (str(self.model_lsm), time_dim, points_hash)
+
+        ## try to get cached operator
+        try:
+            interpolation_operator = self._cached_interpolation_operators[key]
+        except KeyError:
+            interpolation_operator_file = self._interpolation_operator_file(points_hash, time_dim)
+
+            ## otherwise try to get saved operator
+            if os.path.exists(interpolation_operator_file):
+                interpolation_operator = scipy.sparse.load_npz(interpolation_operator_file).tocsr()
+                logger.debug('Interpolation operator loaded from {}.'.format(interpolation_operator_file))
+
+            ## if no operator exists, create and save new operator
+            else:
+                interpolation_operator = self._calculate_interpolation_operator(points, time_dim)
+                try:
+                    os.makedirs(os.path.dirname(interpolation_operator_file), exist_ok=True)
+                    scipy.sparse.save_npz(interpolation_operator_file, interpolation_operator)
+                except OSError as exception:
+                    logger.warn('Interpolation operator could not be saved to {}: {}'.format(interpolation_operator_file, exception))
+                else:
+                    util.io.fs.make_read_only(interpolation_operator_file)
+                    logger.debug('Interpolation operator saved to {}.'.format(interpolation_operator_file))
+
+            self._cached_interpolation_operators[key] = interpolation_operator
+        else:
+            logger.debug('Returning cached interpolation operator.')
+
+        assert interpolation_operator.shape == (len(points), time_dim * simulation.model.constants.METOS_VECTOR_LEN)
+        return interpolation_operator
+
+
+    def _reduce_interpolation_operator_to_used_time_indices(self, interpolation_operator):
+        METOS_VECTOR_LEN = simulation.model.constants.METOS_VECTOR_LEN
+
+        ## get used time indices
+        interpolation_operator = interpolation_operator.tocsr()
+        time_indices, reduced_time_indices = np.unique(interpolation_operator.indices // METOS_VECTOR_LEN, return_inverse=True)
+        time_dim = interpolation_operator.shape[1] // METOS_VECTOR_LEN
+        logger.debug('Interpolation operator uses {} of {} time steps.'.format(len(time_indices), time_dim))
+
+        ## make operator for trajectory with used time indices only
+        reduced_column_indices = reduced_time_indices.reshape(-1) * METOS_VECTOR_LEN + interpolation_operator.indices % METOS_VECTOR_LEN
+        reduced_interpolation_operator = scipy.sparse.csr_matrix((interpolation_operator.data, reduced_column_indices, interpolation_operator.indptr), shape=(interpolation_operator.shape[0], len(time_indices) * METOS_VECTOR_LEN))
+        return reduced_interpolation_operator, time_indices
+
+
+    def _trajectory_load_function_for_points_with_operator(self, points):
+        time_dim = self.model_options.time_steps_per_year
+
+        ## prepare interpolation operator for each tracer
+        interpolation_operator_dict = {}
+
+        for tracer, points_for_tracer in points.items():
+            logger.debug('Calculating model output for tracer {} at {} points.'.format(tracer, len(points_for_tracer)))
+
+            ## check tracer and points
+            if tracer not in self.model_options.tracers:
+                raise ValueError('Tracer {} is not supported for model {}.'.format(tracer, self.model_options.model_name))
+            points_for_tracer = np.asanyarray(points_for_tracer)
+
+            ## get interpolation operator reduced to needed time steps
+            if len(points_for_tracer) > 0:
+                interpolation_operator = self._interpolation_operator(points_for_tracer, time_dim)
+                interpolation_operator_dict[tracer] = self._reduce_interpolation_operator_to_used_time_indices(interpolation_operator)
+
+
+        ## interpolate trajectory function
+        def interpolate_trajectory(trajectory_loader, tracer):
+
+            ## check if points for tracer are available
+            try:
+                interpolation_operator, time_indices = interpolation_operator_dict[tracer]
+            except KeyError:
+                return np.empty([0,1])
+
+            ## interpolate if points for tracer are available
+            else:
+                tracer_trajectory = trajectory_loader(time_dim_desired=time_dim, time_indices=time_indices)
+                interpolated_values_for_tracer = interpolation_operator * tracer_trajectory.reshape(-1)
+                return interpolated_values_for_tracer
+
+        return interpolate_trajectory
+
+
     def _trajectory_load_function_for_points(self, points):
         from .constants import MODEL_INTERPOLATOR_NUMBER_OF_LINEAR_INTERPOLATOR
 
+        ## use sparse interpolation operator for nearest interpolation
+        if MODEL_INTERPOLATOR_NUMBER_OF_LINEAR_INTERPOLATOR == 0:
+            return self._trajectory_load_function_for_points_with_operator(points)
+
         ## convert points to map indices
         interpolation_points_dict = {}
 
@@ -743,7 +1714,7 @@ class Model_With_F(Model_Database):
 
 
         ## interpolate trajectory function
-        def interpolate_trajectory(trajectory_path, tracer):
+        def interpolate_trajectory(trajectory_loader, tracer):
 
             ## check if points for tracer are available
             try:
@@ -753,7 +1724,7 @@ class Model_With_F(Model_Database):
 
             ## interpolate if points for tracer are available
             else:
-                tracer_trajectory = simulation.model.data.load_trajectories_to_map_index_array(trajectory_path, tracers=tracer)
+                tracer_trajectory = simulation.model.data.convert_trajectory_to_map_index_array(trajectory_loader())
                 interpolated_values_for_tracer = self._interpolate(tracer_trajectory, interpolation_points_for_tracer)
                 return interpolated_values_for_tracer
 
@@ -817,11 +1788,16 @@ class Model_With_F(Model_Database):
         return tracer_splitted_dict
 
 
-    def _f(self, trajectory_load_function, tracers=None):
+    def _capture_trajectory(self, trajectory_output_dir):
+        ## called with the trajectory of the matching run before it is removed (used by subclasses to save further values)
+        pass
+
+
+    def _f(self, trajectory_load_function, tracers=None, time_dim=None):
         tracers = self.check_tracers(tracers)
         matching_run_dir = self.run_dir
         model_parameters = self.model_options.parameters
-        f = self._trajectory_with_load_function(trajectory_load_function, matching_run_dir, model_parameters, tracers=tracers)
+        f = self._trajectory_with_load_function(trajectory_load_function, matching_run_dir, model_parameters, tracers=tracers, time_dim=time_dim, capture_function=self._capture_trajectory)
 
         assert f is not None
         assert len(f) == len(tracers)
@@ -833,7 +1809,7 @@ class Model_With_F(Model_Database):
     def f_all(self, time_dim, tracers=None):
 
         logger.debug('Calculating all f values for tracers {} with time dimension {}.'.format(tracers, time_dim))
-        f = self._f(self._trajectory_load_function_for_all(time_dim), tracers=tracers)
+        f = self._f(self._trajectory_load_function_for_all(time_dim), tracers=tracers, time_dim=time_dim)
 
         return f
 
@@ -870,15 +1846,7 @@ class Model_With_F_And_DF(Model_With_F):
         return derivative_dir
 
 
-    def _df(self, trajectory_load_function, partial_derivative_kind, tracers=None):
-        ## check tracers
-        tracers = self.check_tracers(tracers)
-
-        ## return empty array if no tracer wanted
-        if len(tracers) == 0:
-            return {}
-
-        ## apply partial_derivative_kind
+    def _partial_derivative_options(self, partial_derivative_kind):
         if partial_derivative_kind == 'model_parameters':
             def convert_partial_derivative_parameters_to_start_run_parameters(partial_derivative_parameters):
                 assert len(partial_derivative_parameters) == self.model_options.parameters_len
@@ -900,34 +1868,27 @@ class Model_With_F_And_DF(Model_With_F):
         else:
             raise ValueError('Partial derivative kind {} is not supported.'.format(partial_derivative_kind))
 
+        return convert_partial_derivative_parameters_to_start_run_parameters, partial_derivative_parameters_bounds, partial_derivative_parameters_typical_values, partial_derivative_parameters_undisturbed
+
+
+    def start_partial_derivative_runs(self, partial_derivative_kind='model_parameters'):
+        ## get partial derivative options
+        convert_partial_derivative_parameters_to_start_run_parameters, partial_derivative_parameters_bounds, partial_derivative_parameters_typical_values, partial_derivative_parameters_undisturbed = self._partial_derivative_options(partial_derivative_kind)
+
         ## get needed model options
         MODEL_DERIVATIVE_SPINUP_YEARS = self.model_options.derivative_options.years
         MODEL_DERIVATIVE_STEP_SIZE = self.model_options.derivative_options.step_size
         MODEL_DERIVATIVE_ACCURACY_ORDER = self.model_options.derivative_options.accuracy_order
         spinup_options = self.model_options.spinup_options
 
-
         ## get direavtive dir and spinup run dir
         derivative_dir = self.derivative_dir
         spinup_matching_run_dir = self.matching_run_dir(spinup_options)
-        spinup_matching_run_years = self.real_years(spinup_matching_run_dir)
-
 
-        ## get f if accuracy_order is 1
-        if MODEL_DERIVATIVE_ACCURACY_ORDER == 1:
-            spinup_options_f = {'years':spinup_matching_run_years + MODEL_DERIVATIVE_SPINUP_YEARS, 'tolerance':0, 'combination':'or'}
-            spinup_options_f = simulation.model.options.SpinupOptions(spinup_options_f)
-            self.model_options.spinup_options = spinup_options_f
-            f_parameters = self._f(trajectory_load_function)
-            self.model_options.spinup_options = spinup_options
-        else:
-            f_parameters = None
-
-
-        ## define evaluation functions for finite differences
-
-        job_options = self.job_options_for_kind('derivative')
+        ## start function for finite differences
+        job_options = self.job_options_for_kind('derivative', years=MODEL_DERIVATIVE_SPINUP_YEARS)
         partial_derivative_run_dirs = {}
+        partial_derivative_runs_to_start = []
 
         def start_partial_derivative_run(partial_derivative_parameters):
             parameter_index = np.where(partial_derivative_parameters != partial_derivative_parameters_undisturbed)[0]
@@ -944,9 +1905,22 @@ class Model_With_F_And_DF(Model_With_F):
             ## get run dir
             partial_derivative_dirname = simulation.model.constants.DATABASE_PARTIAL_DERIVATIVE_DIRNAME.format(kind=partial_derivative_kind, index=parameter_index, h_factor=h_factor)
             partial_derivative_dir = os.path.join(derivative_dir, partial_derivative_dirname)
+            with self._run_lock(partial_derivative_dir):
+                partial_derivative_run_dir = start_partial_derivative_run_if_needed(partial_derivative_parameters, partial_derivative_dir)
+            partial_derivative_run_dirs[tuple(partial_derivative_parameters)] = partial_derivative_run_dir
+
+            return 0
+
+        def start_partial_derivative_run_if_needed(partial_derivative_parameters, partial_derivative_dir):
+            self._remove_abandoned_run(partial_derivative_dir)
             partial_derivative_run_dir = self.last_run_dir(partial_derivative_dir)
             logger.debug('Checking partial derivative runs in {}.'.format(partial_derivative_dir))
 
+            ## run in progress (the directory determines spinup and derivative options)
+            if partial_derivative_run_dir is not None and self.is_run_in_progress(partial_derivative_run_dir):
+                logger.debug('Partial derivative run {} is in progress.'.format(partial_derivative_run_dir))
+                return partial_derivative_run_dir
+
             ## get corresponding spinup run dir
             if partial_derivative_run_dir is not None:
                 try:
@@ -966,6 +1940,7 @@ class Model_With_F_And_DF(Model_With_F):
                 if partial_derivative_run_dir is not None:
                     logger.debug('Old partial derivative run {} is not matching desired option. It is removed.'.format(partial_derivative_run_dir))
                     util.io.fs.remove_recursively(partial_derivative_run_dir, not_exist_okay=True, exclude_dir=False)
+                    self._update_catalog('remove_run', partial_derivative_run_dir)
 
                 ## create new run dir
                 partial_derivative_run_dir = self.make_new_run_dir(partial_derivative_dir)
@@ -979,27 +1954,179 @@ class Model_With_F_And_DF(Model_With_F):
                 tracer_input_filenames = ['{}_output.petsc'.format(tracer) for tracer in self.model_options.tracers]
                 tracer_input_files = [os.path.join(spinup_matching_run_dir_with_env, tracer_input_filename) for tracer_input_filename in tracer_input_filenames]
 
-                ## start job
+                ## remember job to start
                 start_run_parameters_dict = convert_partial_derivative_parameters_to_start_run_parameters(partial_derivative_parameters)
                 partial_derivative_model_parameters = start_run_parameters_dict['model_parameters']
                 total_concentration_factor = start_run_parameters_dict['total_concentration_factor']
+                partial_derivative_runs_to_start.append((partial_derivative_model_parameters, partial_derivative_run_dir, tracer_input_files, total_concentration_factor))
+
+            return partial_derivative_run_dir
+
+        ## start runs for all disturbed parameters (f of undisturbed parameters is not needed)
+        util.math.finite_differences.calculate(start_partial_derivative_run, partial_derivative_parameters_undisturbed, f_x=0, typical_x=partial_derivative_parameters_typical_values, bounds=partial_derivative_parameters_bounds, accuracy_order=MODEL_DERIVATIVE_ACCURACY_ORDER, eps=MODEL_DERIVATIVE_STEP_SIZE, use_always_typical_x=True)
+
+        ## start all runs as one job array or one batch job
+        if self.derivative_spinup_batch and len(partial_derivative_runs_to_start) > 1:
+            array = simulation.model.job.Metos3D_Batch_Job.array_options() is not None
+            nodes_setup = self._batch_nodes_setup(job_options)
+            if array:
+                parallel_runs = 1
+            else:
+                parallel_runs = self._batch_parallel_runs(nodes_setup, len(partial_derivative_runs_to_start))
+            run_job_options = {'name': job_options['name'], 'nodes_setup': self._batch_run_nodes_setup(nodes_setup, parallel_runs=parallel_runs)}
+
+            for partial_derivative_model_parameters, partial_derivative_run_dir, tracer_input_files, total_concentration_factor in partial_derivative_runs_to_start:
+                self.write_run(partial_derivative_model_parameters, partial_derivative_run_dir, MODEL_DERIVATIVE_SPINUP_YEARS, tolerance=0, job_options=self._copy_job_options(run_job_options), tracer_input_files=tracer_input_files, total_concentration_factor=total_concentration_factor)
+            partial_derivative_run_dirs_to_start = [partial_derivative_run_dir for partial_derivative_model_parameters, partial_derivative_run_dir, tracer_input_files, total_concentration_factor in partial_derivative_runs_to_start]
+            self.start_runs_batch(partial_derivative_run_dirs_to_start, nodes_setup, job_options['name'] + '_batch', derivative_dir, parallel_runs=parallel_runs, array=array)
+
+        ## start each run as own job
+        else:
+            for partial_derivative_model_parameters, partial_derivative_run_dir, tracer_input_files, total_concentration_factor in partial_derivative_runs_to_start:
                 self.start_run(partial_derivative_model_parameters, partial_derivative_run_dir, MODEL_DERIVATIVE_SPINUP_YEARS, tolerance=0, job_options=job_options, tracer_input_files=tracer_input_files, wait_until_finished=False, total_concentration_factor=total_concentration_factor)
 
-            partial_derivative_run_dirs[tuple(partial_derivative_parameters)] = partial_derivative_run_dir
+        logger.debug('Partial derivative runs {} started.'.format(tuple(partial_derivative_run_dirs.values())))
+        return partial_derivative_run_dirs
 
-            return 0
 
+    async def _prepare_spinup_trajectory_async(self, spinup_options, time_dim=None, model_options=None):
+        if model_options is None:
+            model_options = self.model_options
+        model_options = model_options.copy()
+        model_options.spinup_options = spinup_options
+
+        run_dir = await self.matching_run_dir_async(model_options=model_options)
+        return await self._prepare_trajectory_async(run_dir, model_options.parameters, time_dim=time_dim, model_options=model_options)
+
+
+    async def _prepare_partial_derivative_trajectories_async(self, partial_derivative_kind, time_dim=None, model_options=None):
+        model = self._concurrent_copy(model_options)
+        model_options = model.model_options
+        convert_partial_derivative_parameters_to_start_run_parameters = model._partial_derivative_options(partial_derivative_kind)[0]
+
+        ## start partial derivative runs
+        partial_derivative_run_dirs = await simulation.model.asynchronous.run_blocking(model.start_partial_derivative_runs, partial_derivative_kind)
+
+        ## prepare trajectory of each partial derivative run as soon as it is finished
+        async def prepare_partial_derivative_trajectory(partial_derivative_parameters, partial_derivative_run_dir):
+            await self.wait_until_run_finished_async(partial_derivative_run_dir)
+            partial_derivative_model_parameters = convert_partial_derivative_parameters_to_start_run_parameters(np.array(partial_derivative_parameters))['model_parameters']
+            return await self._prepare_trajectory_async(partial_derivative_run_dir, partial_derivative_model_parameters, time_dim=time_dim, model_options=model_options)
+
+        awaitables = [prepare_partial_derivative_trajectory(partial_derivative_parameters, partial_derivative_run_dir) for partial_derivative_parameters, partial_derivative_run_dir in partial_derivative_run_dirs.items()]
+
+        ## prepare trajectory of longer spinup if accuracy_order is 1
+        if model_options.derivative_options.accuracy_order == 1:
+            spinup_run_years = await simulation.model.asynchronous.run_blocking(lambda: model.real_years(model.run_dir))
+            spinup_options_f = {'years':spinup_run_years + model_options.derivative_options.years, 'tolerance':0, 'combination':'or'}
+            spinup_options_f = simulation.model.options.SpinupOptions(spinup_options_f)
+            awaitables.append(self._prepare_spinup_trajectory_async(spinup_options_f, time_dim=time_dim, model_options=model_options))
+
+        return await asyncio.gather(*awaitables)
+
+
+    def _df(self, trajectory_load_function, partial_derivative_kind, tracers=None, time_dim=None):
+        ## check tracers
+        tracers = self.check_tracers(tracers)
+
+        ## return empty array if no tracer wanted
+        if len(tracers) == 0:
+            return {}
+
+        ## get partial derivative options
+        convert_partial_derivative_parameters_to_start_run_parameters, partial_derivative_parameters_bounds, partial_derivative_parameters_typical_values, partial_derivative_parameters_undisturbed = self._partial_derivative_options(partial_derivative_kind)
+
+        ## get needed model options
+        MODEL_DERIVATIVE_SPINUP_YEARS = self.model_options.derivative_options.years
+        MODEL_DERIVATIVE_STEP_SIZE = self.model_options.derivative_options.step_size
+        MODEL_DERIVATIVE_ACCURACY_ORDER = self.model_options.derivative_options.accuracy_order
+        spinup_options = self.model_options.spinup_options
+
+        ## start partial derivative runs
+        partial_derivative_run_dirs = self.start_partial_derivative_runs(partial_derivative_kind)
 
+        ## spinup options for f if accuracy_order is 1
+        if MODEL_DERIVATIVE_ACCURACY_ORDER == 1:
+            spinup_matching_run_dir = self.matching_run_dir(spinup_options)
+            spinup_matching_run_years = self.real_years(spinup_matching_run_dir)
+            spinup_options_f = {'years':spinup_matching_run_years + MODEL_DERIVATIVE_SPINUP_YEARS, 'tolerance':0, 'combination':'or'}
+            spinup_options_f = simulation.model.options.SpinupOptions(spinup_options_f)
+
+        def calculate_f_parameters():
+            model = self._concurrent_copy()
+            model.model_options.spinup_options = spinup_options_f
+            return model._f(trajectory_load_function, time_dim=time_dim)
+
+        ## calculate values of partial derivative runs in order of completion
+        ## (with explicit model options, so that the model options of this model are not changed in between)
+        model_options = self.model_options.copy()
+        partial_derivative_run_values = {}
+        f_parameters = None
+
+        async def calculate_partial_derivative_run_values():
+            semaphore = asyncio.Semaphore(simulation.model.constants.MODEL_DERIVATIVE_MAX_CONCURRENT_TRAJECTORIES)
+
+            async def calculate_partial_derivative_run_value(partial_derivative_parameters, partial_derivative_run_dir):
+                await self.wait_until_run_finished_async(partial_derivative_run_dir)
+                async with semaphore:
+                    partial_derivative_model_parameters = convert_partial_derivative_parameters_to_start_run_parameters(np.array(partial_derivative_parameters))['model_parameters']
+                    await self._prepare_trajectory_async(partial_derivative_run_dir, partial_derivative_model_parameters, time_dim=time_dim, model_options=model_options)
+                    model = self._concurrent_copy(model_options)
+                    partial_derivative_run_values[partial_derivative_parameters] = await simulation.model.asynchronous.run_blocking(model._trajectory_with_load_function, trajectory_load_function, partial_derivative_run_dir, partial_derivative_model_parameters, tracers=tracers, time_dim=time_dim)
+
+            async def calculate_f_parameters_async():
+                nonlocal f_parameters
+                spinup_model_options = model_options.copy()
+                spinup_model_options.spinup_options = spinup_options_f
+                await self.matching_run_dir_async(model_options=spinup_model_options)
+                async with semaphore:
+                    await self._prepare_spinup_trajectory_async(spinup_options_f, time_dim=time_dim, model_options=model_options)
+                    f_parameters = await simulation.model.asynchronous.run_blocking(calculate_f_parameters)
+
+            awaitables = [calculate_partial_derivative_run_value(partial_derivative_parameters, partial_derivative_run_dir) for partial_derivative_parameters, partial_derivative_run_dir in partial_derivative_run_dirs.items()]
+            if MODEL_DERIVATIVE_ACCURACY_ORDER == 1:
+                awaitables.append(calculate_f_parameters_async())
+            await asyncio.gather(*awaitables)
+
+        def start_trajectory_runs_batch():
+            for partial_derivative_run_dir in partial_derivative_run_dirs.values():
+                self.wait_until_run_finished(partial_derivative_run_dir)
+            run_dirs_and_model_parameters = [(partial_derivative_run_dir, convert_partial_derivative_parameters_to_start_run_parameters(np.array(partial_derivative_parameters))['model_parameters']) for partial_derivative_parameters, partial_derivative_run_dir in partial_derivative_run_dirs.items()]
+            if MODEL_DERIVATIVE_ACCURACY_ORDER == 1:
+                run_dirs_and_model_parameters.append((self.matching_run_dir(spinup_options_f), self.model_options.parameters))
+            self.start_trajectory_runs_batch(run_dirs_and_model_parameters, time_dim=time_dim)
+
+        if self.derivative_trajectory_batch:
+            ## extract all trajectories in one batch job
+            start_trajectory_runs_batch()
+            if MODEL_DERIVATIVE_ACCURACY_ORDER == 1:
+                f_parameters = calculate_f_parameters()
+        else:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                asyncio.run(calculate_partial_derivative_run_values())
+            else:
+                ## inside an event loop the values are calculated with an own event loop in another thread
+                logger.warn('Partial derivative values are calculated synchronously inside a running event loop, which is blocked until they are available. Use the asynchronous methods instead.')
+                with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                    executor.submit(asyncio.run, calculate_partial_derivative_run_values()).result()
+
+
+        ## define evaluation function for finite differences
         tracer_start_stop_indices = [0]
 
         def get_partial_derivative_run_value(partial_derivative_parameters):
-            ## wait partial derivative run to finish
-            partial_derivative_run_dir = partial_derivative_run_dirs[tuple(partial_derivative_parameters)]
-            self.wait_until_run_finished(partial_derivative_run_dir)
+            partial_derivative_parameters_tuple = tuple(partial_derivative_parameters)
 
             ## get trajectory
-            partial_derivative_model_parameters = convert_partial_derivative_parameters_to_start_run_parameters(partial_derivative_parameters)['model_parameters']
-            trajectory_dict = self._trajectory_with_load_function(trajectory_load_function, partial_derivative_run_dir, partial_derivative_model_parameters)
+            try:
+                trajectory_dict = partial_derivative_run_values.pop(partial_derivative_parameters_tuple)
+            except KeyError:
+                partial_derivative_run_dir = partial_derivative_run_dirs[partial_derivative_parameters_tuple]
+                self.wait_until_run_finished(partial_derivative_run_dir)
+                partial_derivative_model_parameters = convert_partial_derivative_parameters_to_start_run_parameters(partial_derivative_parameters)['model_parameters']
+                trajectory_dict = self._trajectory_with_load_function(trajectory_load_function, partial_derivative_run_dir, partial_derivative_model_parameters, tracers=tracers, time_dim=time_dim)
             trajectory_list = [trajectory_dict[tracer] for tracer in tracers]
 
             ## store length of each tracer
@@ -1017,10 +2144,12 @@ class Model_With_F_And_DF(Model_With_F):
 
 
         ## calculate deviation
-        for function in (start_partial_derivative_run, get_partial_derivative_run_value):
-            df_concatenated = util.math.finite_differences.calculate(function, partial_derivative_parameters_undisturbed, f_x=f_parameters, typical_x=partial_derivative_parameters_typical_values, bounds=partial_derivative_parameters_bounds, accuracy_order=MODEL_DERIVATIVE_ACCURACY_ORDER, eps=MODEL_DERIVATIVE_STEP_SIZE, use_always_typical_x=True)
+        df_concatenated = util.math.finite_differences.calculate(get_partial_derivative_run_value, partial_derivative_parameters_undisturbed, f_x=f_parameters, typical_x=partial_derivative_parameters_typical_values, bounds=partial_derivative_parameters_bounds, accuracy_order=MODEL_DERIVATIVE_ACCURACY_ORDER, eps=MODEL_DERIVATIVE_STEP_SIZE, use_always_typical_x=True)
         df_concatenated = np.moveaxis(df_concatenated, 0, -1)
 
+        ## remove finished batch jobs
+        self.remove_finished_batch_jobs()
+
         ## unpack concatenation
         logger.debug('Unpacking derivative with shape {} for tracers with tracer_start_stop_indices {}.'.format(df_concatenated.shape, tracer_start_stop_indices))
         assert len(tracer_start_stop_indices) == len(tracers) + 1
@@ -1044,7 +2173,7 @@ class Model_With_F_And_DF(Model_With_F):
 
         logger.debug('Calculating all df values for tracers {} with time dimension {} and partial_derivative_kind {}.'.format(tracers, time_dim, partial_derivative_kind))
 
-        df = self._df(self._trajectory_load_function_for_all(time_dim=time_dim), partial_derivative_kind=partial_derivative_kind, tracers=tracers)
+        df = self._df(self._trajectory_load_function_for_all(time_dim=time_dim), partial_derivative_kind=partial_derivative_kind, tracers=tracers, time_dim=time_dim)
         return df
 
 
@@ -1141,7 +2270,7 @@ class Model_Database_MemoryCached(Model_Database):
         return super().closest_spinup_dir
 
     @property
-    @util.cache.memory.method_decorator(dependency=('self.spinup_dir', 'self.model_options.spinup_options.years', 'self.model_options.spinup_options.tolerance', 'self.model_options.spinup_options.combination', 'self.model_options.spinup_options.match_type'))
+    @util.cache.memory.method_decorator(dependency=('self.spinup_dir', 'self.model_options.spinup_options.years', 'self.model_options.spinup_options.tolerance', 'self.model_options.spinup_options.combination', 'self.model_options.spinup_options.match_type', 'self.model_options.spinup_options.multilevel_time_steps', 'self.model_options.spinup_options.multilevel_years', 'self.model_options.spinup_options.multilevel_tolerance'))
     def run_dir(self):
         return super().run_dir
 
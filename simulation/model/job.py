@@ -1,10 +1,15 @@
+import collections
 import os
+import socket
 import time
 import re
 
 import numpy as np
 
+import simulation.model.asynchronous
 import simulation.model.constants
+import simulation.model.walltime_estimator
+import simulation.model.watch
 
 import util.batch.universal.system
 import util.io.fs
@@ -14,23 +19,187 @@ import util.logging
 logger = util.logging.logger
 
 
+## job output parsing
+
+# 9.704s 0010 Spinup Function norm 2.919666257647e+00
+# 9.704s 0010 Spinup Function norm 2.919666257647e+00 7.012035082243e+06
+SPINUP_LINE_SEARCH_STRING = 'Spinup Function norm'
+SPINUP_LINE_REGULAR_EXPRESSION = re.compile(r'^\s*(\S+?)s\s+(\d+)\s+' + SPINUP_LINE_SEARCH_STRING + r'\s+(\S+)', re.MULTILINE)
+OUTPUT_IGNORE_ERRORS = ('Error_Path = ', 'cpuinfo: error while loading shared libraries: libgcc_s.so.1: cannot open shared object file: No such file or directory')
+OUTPUT_ERROR_REGULAR_EXPRESSION = re.compile('error', re.IGNORECASE)
+OUTPUT_FINAL_SEARCH_STRING = 'Metos3DFinal'
+
+
+def last_line_containing(file, search_str, block_size=2**16):
+    search_bytes = search_str.encode()
+
+    with open(file, 'rb') as file_object:
+        ## read blocks from end of file
+        position = file_object.seek(0, os.SEEK_END)
+        remaining_bytes = b''
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            file_object.seek(position)
+            lines = (file_object.read(read_size) + remaining_bytes).split(b'\n')
+
+            ## first line is only complete at the beginning of the file
+            if position > 0:
+                remaining_bytes = lines[0]
+                lines = lines[1:]
+            for line in reversed(lines):
+                if search_bytes in line:
+                    return line.decode(errors='replace')
+
+    return None
+
+
+def _parse_output(output):
+    ## spinup lines as year, time and norm
+    spinup_history = []
+    for match in SPINUP_LINE_REGULAR_EXPRESSION.finditer(output):
+        try:
+            spinup_history.append((int(match.group(2)) + 1, float(match.group(1)), float(match.group(3))))
+        except ValueError:
+            logger.warn('Spinup line "{}" could not be parsed.'.format(match.group(0)))
+    spinup_history = np.array(spinup_history, dtype=np.float64).reshape(-1, 3)
+
+    ## errors
+    for ignore_error in OUTPUT_IGNORE_ERRORS:
+        output = output.replace(ignore_error, '')
+    error_found = OUTPUT_ERROR_REGULAR_EXPRESSION.search(output) is not None
+
+    ## final output
+    final_found = OUTPUT_FINAL_SEARCH_STRING in output
+
+    return spinup_history, error_found, final_found
+
+
+class _Output_Parser:
+
+    def __init__(self, file):
+        self.file = file
+        self._reset(None)
+
+
+    def _reset(self, file_id):
+        self.file_id = file_id
+        self.offset = 0
+        self.spinup_history = np.empty((0, 3), dtype=np.float64)
+        self.error_found = False
+        self.final_found = False
+
+
+    def update(self):
+        ## read appended bytes
+        with open(self.file, 'rb') as file_object:
+            file_stat = os.fstat(file_object.fileno())
+            file_id = (file_stat.st_dev, file_stat.st_ino)
+            if file_id != self.file_id or file_stat.st_size < self.offset:
+                self._reset(file_id)
+            file_object.seek(self.offset)
+            appended_bytes = file_object.read()
+
+        ## parse complete lines only once
+        complete_len = appended_bytes.rfind(b'\n') + 1
+        if complete_len > 0:
+            spinup_history, error_found, final_found = _parse_output(appended_bytes[:complete_len].decode(errors='replace'))
+            self.spinup_history = np.concatenate([self.spinup_history, spinup_history])
+            self.error_found = self.error_found or error_found
+            self.final_found = self.final_found or final_found
+            self.offset += complete_len
+
+        ## parse incomplete last line
+        if complete_len < len(appended_bytes):
+            spinup_history, error_found, final_found = _parse_output(appended_bytes[complete_len:].decode(errors='replace'))
+            spinup_history = np.concatenate([self.spinup_history, spinup_history])
+            error_found = self.error_found or error_found
+            final_found = self.final_found or final_found
+        else:
+            spinup_history = self.spinup_history
+            error_found = self.error_found
+            final_found = self.final_found
+
+        return spinup_history, error_found, final_found
+
+
+## parsers of recently used output files (least recently used are discarded)
+_OUTPUT_PARSERS = collections.OrderedDict()
+
+def output_parser(file):
+    try:
+        parser = _OUTPUT_PARSERS[file]
+    except KeyError:
+        parser = _Output_Parser(file)
+        _OUTPUT_PARSERS[file] = parser
+        while len(_OUTPUT_PARSERS) > simulation.model.constants.JOB_OUTPUT_PARSERS_CACHE_SIZE:
+            _OUTPUT_PARSERS.popitem(last=False)
+    else:
+        _OUTPUT_PARSERS.move_to_end(file)
+    return parser
+
+
+
+## reservation of output dirs whose jobs are not started yet
+
+def reserve(output_dir):
+    reservation_file = os.path.join(output_dir, simulation.model.constants.DATABASE_RUN_RESERVATION_FILENAME)
+    with open(reservation_file, 'w') as file_object:
+        file_object.write('{} {:d} {}\n'.format(socket.gethostname(), os.getpid(), time.time()))
+
+
+def release(output_dir):
+    ## called after the job is started (its id is written)
+    reservation_file = os.path.join(output_dir, simulation.model.constants.DATABASE_RUN_RESERVATION_FILENAME)
+    try:
+        os.remove(reservation_file)
+    except FileNotFoundError:
+        pass
+
+
+def is_started(output_dir):
+    return os.path.exists(os.path.join(output_dir, simulation.model.constants.JOB_ID_FILENAME))
+
+
+def is_reserved(output_dir, timeout=None):
+    if timeout is None:
+        timeout = simulation.model.constants.DATABASE_RUN_RESERVATION_TIMEOUT
+    if is_started(output_dir):
+        return False
+    reservation_file = os.path.join(output_dir, simulation.model.constants.DATABASE_RUN_RESERVATION_FILENAME)
+    try:
+        reservation_age = time.time() - os.path.getmtime(reservation_file)
+    except FileNotFoundError:
+        return False
+    return reservation_age <= timeout
+
+
+def is_abandoned(output_dir):
+    ## reserved, but job was not started within the reservation timeout (also if its job options are written)
+    reservation_file = os.path.join(output_dir, simulation.model.constants.DATABASE_RUN_RESERVATION_FILENAME)
+    return os.path.exists(reservation_file) and not is_started(output_dir) and not is_reserved(output_dir)
+
+
+
 class Metos3D_Job(util.batch.universal.system.Job):
 
     ## run options
 
+    @property
+    def spinup_history(self):
+        ## columns: spinup year (number of finished years), time in seconds, spinup function norm
+        spinup_history, error_found, final_found = output_parser(self.output_file).update()
+        spinup_history = spinup_history.view()
+        spinup_history.flags.writeable = False
+        return spinup_history
+
+
     @property
     def last_spinup_line(self):
         self.wait_until_finished()
 
-        # 9.704s 0010 Spinup Function norm 2.919666257647e+00
-        # 9.704s 0010 Spinup Function norm 2.919666257647e+00 7.012035082243e+06
-
-        search_str = 'Spinup Function norm'
-        last_spinup_line = None
-        output = self.output
-        for line in output.splitlines():
-            if search_str in line:
-                last_spinup_line = line
+        search_str = SPINUP_LINE_SEARCH_STRING
+        last_spinup_line = last_line_containing(self.output_file, search_str)
 
         if last_spinup_line is None:
             error_message = 'In job output is no "{}" line.'.format(search_str)
@@ -67,6 +236,12 @@ class Metos3D_Job(util.batch.universal.system.Job):
         return last_spinup_tolerance
 
 
+    @property
+    def estimated_walltime_seconds(self):
+        ## unrounded estimated walltime (batch jobs sum it up for runs executed one after another)
+        return self.option_value('/job/estimated_walltime_seconds', not_exist_okay=True)
+
+
     @property
     def time_step(self):
         opt = self.options
@@ -156,6 +331,13 @@ class Metos3D_Job(util.batch.universal.system.Job):
                 util.io.fs.make_read_only(file)
 
 
+    ## start
+
+    def start(self):
+        super().start()
+        return simulation.model.asynchronous.Job_Handle(os.path.expandvars(self.output_dir))
+
+
     ## exit code and is finished
 
     @property
@@ -170,18 +352,14 @@ class Metos3D_Job(util.batch.universal.system.Job):
             ValueError('Output file {} does not exist. The job is not finished'.format(self.output_file))
 
         ## check output file for errors
-        IGNORE_ERRORS = ('Error_Path = ', 'cpuinfo: error while loading shared libraries: libgcc_s.so.1: cannot open shared object file: No such file or directory')
-        output = self.output
-        for ingore_error in IGNORE_ERRORS:
-            output = output.replace(ingore_error, '')
-        output = output.lower()
-        if 'error' in output:
+        spinup_history, error_found, final_found = output_parser(self.output_file).update()
+        if error_found:
             return 255
         else:
             return 0
 
 
-    def is_finished(self, check_exit_code=True):
+    def is_finished(self, check_exit_code=True, wait_until_output_written=True):
         ## check if finished without exit code check
         if not super().is_finished(check_exit_code=False):
             return False
@@ -195,22 +373,75 @@ class Metos3D_Job(util.batch.universal.system.Job):
             return False
 
         ## check if output file is completely written
-        job_output = self.output
-        if 'Metos3DFinal' in job_output:
+        spinup_history, error_found, final_found = output_parser(self.output_file).update()
+        if final_found:
             return True
+        elif wait_until_output_written:
+            return self._wait_until_output_completely_written()
         else:
-            time.sleep(30)
-            if self.output != job_output:
-                return False
-            else:
-                raise util.batch.universal.system.JobError(self, 'The job output file is not completely written!', job_output)
+            return self._check_output_not_stalled()
+
+
+    def _check_output_not_stalled(self):
+        ## output not completely written yet, error if it was not changed within timeout
+        output_age = time.time() - os.path.getmtime(self.output_file)
+        if output_age >= simulation.model.constants.JOB_OUTPUT_COMPLETELY_WRITTEN_TIMEOUT:
+            raise util.batch.universal.system.JobError(self, 'The job output file is not completely written!', self.output)
+        return False
+
+
+    def _wait_until_output_completely_written(self):
+        output_file = self.output_file
+        output_timeout = simulation.model.constants.JOB_OUTPUT_COMPLETELY_WRITTEN_TIMEOUT
+        logger.debug('Waiting for job output file {} to be completely written.'.format(output_file))
+
+        output_size = os.path.getsize(output_file)
+        output_change_time = time.monotonic()
+
+        with simulation.model.watch.File_Watcher(os.path.dirname(output_file), watch_modifications=True) as watcher:
+            for pause_seconds in simulation.model.watch.backoff_pause_seconds(simulation.model.constants.JOB_WAIT_PAUSE_SECONDS_MIN, simulation.model.constants.JOB_WAIT_PAUSE_SECONDS_MAX):
+                ## final output written
+                spinup_history, error_found, final_found = output_parser(output_file).update()
+                if final_found:
+                    return True
+
+                ## output still growing
+                current_time = time.monotonic()
+                current_output_size = os.path.getsize(output_file)
+                if current_output_size != output_size:
+                    output_size = current_output_size
+                    output_change_time = current_time
+                elif current_time - output_change_time >= output_timeout:
+                    raise util.batch.universal.system.JobError(self, 'The job output file is not completely written!', self.output)
+
+                watcher.wait(min(pause_seconds, output_change_time + output_timeout - current_time))
+
+
+    def wait_until_finished(self, check_exit_code=True, pause_seconds=None, **kargs):
+        ## use fixed sleep period if desired
+        if pause_seconds is not None:
+            return super().wait_until_finished(check_exit_code=check_exit_code, pause_seconds=pause_seconds, **kargs)
+
+        ## otherwise wait for changes of finished file with exponential backoff
+        logger.debug('Waiting for job {} to finish with file watcher and exponential backoff.'.format(self.id))
+        watch_dirs = [os.path.dirname(self.finished_file)]
+        if self.output_file is not None:
+            watch_dirs.append(os.path.dirname(self.output_file))
+
+        with simulation.model.watch.File_Watcher(*watch_dirs) as watcher:
+            for pause_seconds in simulation.model.watch.backoff_pause_seconds(simulation.model.constants.JOB_WAIT_PAUSE_SECONDS_MIN, simulation.model.constants.JOB_WAIT_PAUSE_SECONDS_MAX):
+                if self.is_finished(check_exit_code=check_exit_code):
+                    break
+                watcher.wait(pause_seconds)
+
+        logger.debug('Job {} finished with exit code {}.'.format(self.id, self.exit_code))
 
 
     ## write job file
 
-    def write_job_file(self, model_name, model_parameters, years, tolerance=None, time_step=1, initial_constant_concentrations=None, tracer_input_files=None, total_concentration_factor=1, write_trajectory=False, job_options=None):
+    def write_job_file(self, model_name, model_parameters, years, tolerance=None, time_step=1, initial_constant_concentrations=None, tracer_input_files=None, total_concentration_factor=1, write_trajectory=False, write_trajectory_modulo=1, job_options=None):
 
-        logger.debug('Initialising job with model {}, parameters {},  years {}, tolerance {}, time step {}, initial_constant_concentrations {}, tracer_input_files {}, total concentration factor {} and job_options {}.'.format(model_name, model_parameters, years, tolerance, time_step, initial_constant_concentrations, tracer_input_files, total_concentration_factor, job_options))
+        logger.debug('Initialising job with model {}, parameters {},  years {}, tolerance {}, time step {}, initial_constant_concentrations {}, tracer_input_files {}, total concentration factor {}, write trajectory {} with modulo {} and job_options {}.'.format(model_name, model_parameters, years, tolerance, time_step, initial_constant_concentrations, tracer_input_files, total_concentration_factor, write_trajectory, write_trajectory_modulo, job_options))
 
         ## check input
         if not time_step in simulation.model.constants.METOS_TIME_STEPS:
@@ -223,6 +454,8 @@ class Metos3D_Job(util.batch.universal.system.Job):
             raise ValueError('Tolerance must be greater or equal 0, but it is {} .'.format(tolerance))
         if total_concentration_factor < 0:
             raise ValueError('Total_concentration_factor must be greater or equal 0, but it is {} .'.format(total_concentration_factor))
+        if write_trajectory_modulo < 1 or (simulation.model.constants.METOS_T_DIM / time_step) % write_trajectory_modulo != 0:
+            raise ValueError('Write_trajectory_modulo must be a positive divisor of the time steps per year {}, but it is {} .'.format(int(simulation.model.constants.METOS_T_DIM / time_step), write_trajectory_modulo))
 
         if initial_constant_concentrations is not None and tracer_input_files is not None:
             raise ValueError('You can not set the initial concentration and the tracer input files simultaneously.')
@@ -267,10 +500,22 @@ class Metos3D_Job(util.batch.universal.system.Job):
             logger.warn('The chosen memory {} is below the needed memory {}. Changing to needed memory.'.format(nodes_setup.memory, simulation.model.constants.JOB_MEMORY_GB))
             nodes_setup.memory = simulation.model.constants.JOB_MEMORY_GB
 
+        ## limit nodes to recommended nodes
+        walltime_estimator = simulation.model.walltime_estimator.estimator()
+        if walltime_estimator is not None and nodes_setup['nodes'] is None and isinstance(nodes_setup['node_kind'], str):
+            node_infos = util.batch.universal.system.BATCH_SYSTEM.node_infos
+            node_kind = nodes_setup['node_kind']
+            nodes_max = node_infos.nodes(node_kind)
+            if nodes_setup.nodes_max is not None:
+                nodes_max = min(nodes_max, nodes_setup.nodes_max)
+            recommended_nodes = walltime_estimator.recommended_nodes(model_name, node_kind, node_infos.cpus(node_kind), time_step, years, node_infos.max_walltime(node_kind), int(nodes_max))
+            logger.debug('The recommended number of nodes for {} years with time step {} is {}.'.format(years, time_step, recommended_nodes))
+            nodes_setup.nodes_max = recommended_nodes
+
         ## check/set walltime
-        sec_per_year = np.exp(- (nodes_setup.nodes * nodes_setup.cpus) / (6*16)) * 10 + 2.5
-        sec_per_year /= time_step**(1/2)
-        estimated_walltime_hours = np.ceil(years * sec_per_year / 60**2)
+        sec_per_year = simulation.model.walltime_estimator.seconds_per_year(model_name, nodes_setup.node_kind, nodes_setup.nodes, nodes_setup.cpus, time_step)
+        estimated_walltime_seconds = years * sec_per_year
+        estimated_walltime_hours = np.ceil(estimated_walltime_seconds / 60**2)
         logger.debug('The estimated walltime for {} nodes with {} cpus, {} years and time step {} is {} hours.'.format(nodes_setup.nodes, nodes_setup.cpus, years, time_step, estimated_walltime_hours))
         if nodes_setup.walltime is None:
             nodes_setup.walltime = estimated_walltime_hours
@@ -289,6 +534,8 @@ class Metos3D_Job(util.batch.universal.system.Job):
 
         ## init job
         super().set_job_options(job_name, nodes_setup)
+        self.options['/job/node_kind'] = nodes_setup.node_kind
+        self.options['/job/estimated_walltime_seconds'] = estimated_walltime_seconds
 
 
         ## get output dir
@@ -315,6 +562,8 @@ class Metos3D_Job(util.batch.universal.system.Job):
         opt['/metos3d/data_dir'] = simulation.model.constants.METOS_DATA_DIR_ENV
         opt['/metos3d/sim_file'] = simulation.model.constants.METOS_SIM_FILE_ENV.format(model_name=model_name, METOS3D_DIR='{METOS3D_DIR}')
         opt['/metos3d/write_trajectory'] = write_trajectory
+        if write_trajectory:
+            opt['/metos3d/write_trajectory_modulo'] = write_trajectory_modulo
 
         if not write_trajectory:
             opt['/metos3d/tracer_output_dir'] = output_dir_not_expanded
@@ -438,7 +687,7 @@ class Metos3D_Job(util.batch.universal.system.Job):
 
         if opt['/metos3d/write_trajectory']:
             f.write('-Metos3DSpinupMonitorFileFormatPrefix   sp$0004d-,ts$0004d- \n')
-            f.write('-Metos3DSpinupMonitorModuloStep         1,1 \n')
+            f.write('-Metos3DSpinupMonitorModuloStep         1,{:d} \n'.format(opt['/metos3d/write_trajectory_modulo']))
 
         util.io.fs.flush_and_close(f)
 
@@ -541,3 +790,116 @@ class Metos3D_Job(util.batch.universal.system.Job):
         ## tracer output files
         tracer_output_files = tuple(map(lambda filename: os.path.join(options['/metos3d/tracer_output_dir'], filename), options['/metos3d/tracer_output_filenames']))
         tuple(map(lambda file: check_if_file_exists(file, should_exists=not self.is_running(), should_be_in_output_dir=True), tracer_output_files))
+
+
+
+class Metos3D_Batch_Job(util.batch.universal.system.Job):
+
+    ## runs the job files of several written metos3d jobs in one batch job or as one job array
+    ## (each job writes its own output, unfinished and finished file, so they can be waited for as usual)
+
+    @property
+    def job_dirs(self):
+        return self.options['/batch/job_dirs']
+
+    @property
+    def parallel_runs(self):
+        return self.options['/batch/parallel_runs']
+
+    @property
+    def is_array(self):
+        return self.options['/batch/array']
+
+
+    @staticmethod
+    def array_options():
+        batch_system_str = getattr(util.batch.universal.system, 'BATCH_SYSTEM_STR', None)
+        return simulation.model.constants.JOB_ARRAY_OPTIONS.get(batch_system_str)
+
+
+    def write_job_file(self, job_dirs, nodes_setup, job_name='Metos3D_batch', parallel_runs=1, array=False):
+        logger.debug('Initialising batch job for {} jobs with node setup {}, {} parallel runs and array {}.'.format(len(job_dirs), nodes_setup, parallel_runs, array))
+
+        ## check input
+        if len(job_dirs) == 0:
+            raise ValueError('The batch job needs at least one job dir.')
+        if parallel_runs < 1:
+            raise ValueError('Parallel_runs must be greater or equal 1, but it is {} .'.format(parallel_runs))
+        if array:
+            array_options = self.array_options()
+            if array_options is None:
+                raise ValueError('The batch system does not support job arrays.')
+            if len(job_dirs) < 2:
+                raise ValueError('A job array needs at least two job dirs.')
+
+        ## init job
+        super().set_job_options(job_name, nodes_setup)
+        self.options['/batch/job_dirs'] = list(job_dirs)
+        self.options['/batch/parallel_runs'] = parallel_runs
+        self.options['/batch/array'] = array
+
+        ## get command of each job
+        commands = []
+        for job_dir in job_dirs:
+            with Metos3D_Job(job_dir, force_load=True) as job:
+                job_file = job.option_value('/job/option_file', replace_environment_vars=False)
+                job_output_file = job.option_value('/job/output_file', replace_environment_vars=False)
+            commands.append('bash {} > {} 2>&1'.format(job_file, job_output_file))
+
+        ## run job with array index
+        content = []
+        if array:
+            array_header, array_index_variable = array_options
+            content.append('case ${} in'.format(array_index_variable))
+            for i, command in enumerate(commands):
+                content.append('    {:d}) {} ;;'.format(i, command))
+            content.append('esac')
+
+        ## run job files, in groups of parallel runs if desired
+        else:
+            for i, command in enumerate(commands):
+                if parallel_runs > 1:
+                    command += ' &'
+                content.append(command)
+                if parallel_runs > 1 and (i + 1) % parallel_runs == 0:
+                    content.append('wait')
+            ## exit codes of the jobs are in their finished files
+            content.append('wait')
+        command = os.linesep.join(content)
+
+        ## write job file
+        job_file_header = self._job_file_header(use_mpi=True)
+        if array:
+            job_file_header += array_header.format(max_index=len(job_dirs) - 1) + os.linesep
+        job_file_command = job_file_header + os.linesep + self._job_file_command(command, add_timing=False, use_mpi=False)
+        with open(self.option_file, mode='w') as file:
+            file.write(job_file_command)
+
+        logger.debug('Batch job initialised.')
+
+
+    def start(self):
+        super().start()
+
+        ## the jobs in the batch job have the id of the batch job or of their array element
+        job_handles = []
+        for i, job_dir in enumerate(self.job_dirs):
+            job_id = self.id
+            if self.is_array:
+                job_id = job_id.replace('[]', '[{:d}]'.format(i), 1)
+            with Metos3D_Job(job_dir, force_load=True) as job:
+                job.options['/job/id'] = job_id
+                with open(job.id_file, 'w') as id_file:
+                    id_file.write(job_id)
+                job_handles.append(simulation.model.asynchronous.Job_Handle(os.path.expandvars(job.output_dir)))
+        return job_handles
+
+
+    def are_jobs_finished(self):
+        for job_dir in self.job_dirs:
+            ## removed jobs are finished
+            if os.path.exists(os.path.expandvars(job_dir)):
+                with Metos3D_Job(job_dir, force_load=True) as job:
+                    if not os.path.exists(job.finished_file):
+                        return False
+        return True
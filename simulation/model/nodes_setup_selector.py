@@ -0,0 +1,148 @@
+import numpy as np
+
+import util.batch.general.system
+import util.batch.universal.system
+import util.logging
+
+import simulation.model.constants
+import simulation.model.walltime_estimator
+
+logger = util.logging.logger
+
+
+
+class Nodes_Setup_Selector:
+
+    ## chooses node kind, nodes and cpus with minimal expected time to result (queue wait and runtime)
+
+    def __init__(self, batch_system=None, queue_seconds_per_missing_node=None):
+        if batch_system is None:
+            batch_system = util.batch.universal.system.BATCH_SYSTEM
+        if queue_seconds_per_missing_node is None:
+            queue_seconds_per_missing_node = simulation.model.constants.NODES_SETUP_SELECTION_QUEUE_SECONDS_PER_MISSING_NODE
+        self.batch_system = batch_system
+        self.queue_seconds_per_missing_node = queue_seconds_per_missing_node
+
+
+    def __str__(self):
+        return 'Nodes_Setup_Selector({})'.format(self.batch_system)
+
+
+    def _nodes_state(self):
+        try:
+            return self.batch_system._nodes_state()
+        except NotImplementedError:
+            logger.debug('Batch system {} has no nodes state. All nodes are assumed to be free.'.format(self.batch_system))
+            return None
+
+
+    def _node_kinds(self, node_kind=None):
+        if node_kind is None:
+            return self.batch_system.node_infos.kinds()
+        elif isinstance(node_kind, str):
+            return (node_kind,)
+        else:
+            return tuple(node_kind)
+
+
+    def expected_queue_seconds(self, nodes_state, memory, node_kind, nodes, cpus):
+        if nodes_state is None:
+            return 0
+        free_cpus = nodes_state.free_cpus(node_kind, required_memory=memory)
+        free_nodes = free_cpus[free_cpus >= cpus].size - self.batch_system.node_infos.leave_free(node_kind)
+        missing_nodes = max(nodes - max(free_nodes, 0), 0)
+        return missing_nodes * self.queue_seconds_per_missing_node
+
+
+    def expected_run_seconds(self, model_name, time_step, years, node_kind, nodes, cpus):
+        return years * simulation.model.walltime_estimator.seconds_per_year(model_name, node_kind, nodes, cpus, time_step)
+
+
+    def candidates(self, nodes_state, memory, node_kind=None, nodes_max=float('inf'), total_cpus_max=float('inf')):
+        node_infos = self.batch_system.node_infos
+        candidates = []
+
+        for kind in self._node_kinds(node_kind):
+            if memory is not None and node_infos.memory(kind) < memory:
+                continue
+
+            ## full nodes and currently free cpus of nodes
+            cpus_per_node = node_infos.cpus(kind)
+            cpus_to_check = {cpus_per_node}
+            if nodes_state is not None:
+                cpus_to_check.update(int(cpus) for cpus in nodes_state.free_cpus(kind, required_memory=memory) if cpus > 0)
+
+            nodes_available = node_infos.nodes(kind) - node_infos.leave_free(kind)
+            for cpus in cpus_to_check:
+                for nodes in range(1, int(min(nodes_available, nodes_max)) + 1):
+                    if nodes * cpus <= total_cpus_max:
+                        candidates.append((kind, nodes, cpus))
+
+        return candidates
+
+
+    def select(self, model_name, time_step, years, memory=None, node_kind=None, nodes_max=float('inf'), total_cpus_max=float('inf')):
+        if memory is None:
+            memory = simulation.model.constants.JOB_MEMORY_GB
+        node_infos = self.batch_system.node_infos
+        nodes_state = self._nodes_state()
+
+        ## expected time to result of each candidate within max walltime
+        best_setup = None
+        best_seconds = float('inf')
+        best_run_seconds = float('inf')
+        for kind, nodes, cpus in self.candidates(nodes_state, memory, node_kind=node_kind, nodes_max=nodes_max, total_cpus_max=total_cpus_max):
+            run_seconds = self.expected_run_seconds(model_name, time_step, years, kind, nodes, cpus)
+            if run_seconds <= node_infos.max_walltime(kind) * 60**2:
+                seconds = run_seconds + self.expected_queue_seconds(nodes_state, memory, kind, nodes, cpus)
+            else:
+                seconds = float('inf')
+            if seconds < best_seconds or (seconds == best_seconds and run_seconds < best_run_seconds):
+                best_setup = (kind, nodes, cpus)
+                best_seconds = seconds
+                best_run_seconds = run_seconds
+
+        if best_setup is None:
+            raise ValueError('No node setup with memory {}, node kind {}, nodes max {} and total cpus max {} is available.'.format(memory, node_kind, nodes_max, total_cpus_max))
+
+        logger.debug('Selected node kind, nodes and cpus {} for {} years of model {} with time step {} with expected time to result {}s.'.format(best_setup, years, model_name, time_step, best_seconds))
+        return best_setup
+
+
+    def select_for_nodes_setup(self, nodes_setup, model_name, time_step, years):
+        ## the passed node setup restricts memory, node kind, nodes max and total cpus max
+        if nodes_setup is None:
+            nodes_setup = util.batch.universal.system.NodeSetup(memory=simulation.model.constants.JOB_MEMORY_GB)
+        memory = nodes_setup['memory']
+        if memory is None:
+            memory = simulation.model.constants.JOB_MEMORY_GB
+        nodes_max = nodes_setup['nodes_max']
+        if nodes_max is None:
+            nodes_max = float('inf')
+        total_cpus_max = nodes_setup['total_cpus_max']
+        if total_cpus_max is None:
+            total_cpus_max = float('inf')
+
+        node_kind, nodes, cpus = self.select(model_name, time_step, years, memory=memory, node_kind=nodes_setup['node_kind'], nodes_max=nodes_max, total_cpus_max=total_cpus_max)
+        return util.batch.universal.system.NodeSetup(memory=memory, node_kind=node_kind, nodes=nodes, cpus=cpus, nodes_max=nodes, walltime=nodes_setup.walltime)
+
+
+
+class Local_Batch_System(util.batch.general.system.BatchSystem):
+
+    ## stand-in batch system with fixed node infos and nodes state (free cpus and free memory of each node for each node kind)
+
+    def __init__(self, node_infos, nodes_state=None):
+        super().__init__({}, (), node_infos=node_infos)
+        self.nodes_state = nodes_state
+
+
+    def __str__(self):
+        return 'Local batch system'
+
+
+    def _nodes_state(self):
+        if self.nodes_state is None:
+            raise NotImplementedError()
+        nodes_state = {kind: (np.asarray(free_cpus), np.asarray(free_memory)) for kind, (free_cpus, free_memory) in self.nodes_state.items()}
+        return util.batch.general.system.NodesState(nodes_state)
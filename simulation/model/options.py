@@ -1,3 +1,5 @@
+import warnings
+
 import numpy as np
 
 import util.options
@@ -137,10 +139,15 @@ class ModelOptions(util.options.Options):
 
 class SpinupOptions(util.options.Options):
     
-    OPTIONS = ('years', 'tolerance', 'combination', 'match_type')
+    OPTIONS = ('years', 'tolerance', 'combination', 'match_type', 'multilevel_time_steps', 'multilevel_years', 'multilevel_tolerance')
+
+    ## multilevel options are checked together after all options are initially set
+    _multilevel_check_enabled = False
 
     def __init__(self, options=None):
         super().__init__(options=options, default_options=simulation.model.constants.MODEL_DEFAULT_SPINUP_OPTIONS, option_names=SpinupOptions.OPTIONS)
+        self._multilevel_check_enabled = True
+        self._multilevel_check()
     
     
     ## options methods
@@ -153,12 +160,14 @@ class SpinupOptions(util.options.Options):
     def tolerance_check(self, tolerance):
         if tolerance < 0:
             raise ValueError('Tolerance must be greater or equal to 0, but it is {} .'.format(tolerance))
+        self._multilevel_check(tolerance=tolerance)
     
 
     def combination_check(self, combination):
         POSSIBLE_VALUES = ['and', 'or']
         if combination not in POSSIBLE_VALUES:
             raise ValueError('Combination "{}" unknown. Possible combinations are: {}'.format(combination, POSSIBLE_VALUES))
+        self._multilevel_check(combination=combination)
     
 
     def match_type_check(self, match_type):
@@ -167,6 +176,36 @@ class SpinupOptions(util.options.Options):
             raise ValueError('Match type "{}" unknown. Possible match typies are: {}'.format(match_type, POSSIBLE_VALUES))
 
 
+    def multilevel_time_steps_check(self, multilevel_time_steps):
+        for time_step in multilevel_time_steps:
+            if not time_step in simulation.model.constants.METOS_TIME_STEPS:
+                raise ValueError('Wrong multilevel time step {}. Time steps have to be in {} .'.format(time_step, simulation.model.constants.METOS_TIME_STEPS))
+        self._multilevel_check(multilevel_time_steps=multilevel_time_steps)
+
+
+    def _multilevel_check(self, multilevel_time_steps=None, tolerance=None, combination=None):
+        ## years with coarser time steps are not counted as spinup years, so only spinups with tolerance and combination 'or' can be shortened
+        if self._multilevel_check_enabled:
+            if multilevel_time_steps is None:
+                multilevel_time_steps = self.multilevel_time_steps
+            if tolerance is None:
+                tolerance = self.tolerance
+            if combination is None:
+                combination = self.combination
+            if len(multilevel_time_steps) > 0 and (tolerance == 0 or combination == 'and'):
+                warnings.warn('The multilevel time steps {} are ignored, since multilevel spinups are only supported for a tolerance greater than 0 and combination "or", but the tolerance is {} and the combination is "{}".'.format(multilevel_time_steps, tolerance, combination))
+
+
+    def multilevel_years_check(self, multilevel_years):
+        if multilevel_years < 0:
+            raise ValueError('Multilevel years must be greater or equal to 0, but it is {} .'.format(multilevel_years))
+
+
+    def multilevel_tolerance_check(self, multilevel_tolerance):
+        if multilevel_tolerance < 0:
+            raise ValueError('Multilevel tolerance must be greater or equal to 0, but it is {} .'.format(multilevel_tolerance))
+
+
 
 
 class DerivativeOptions(util.options.Options):
@@ -0,0 +1,241 @@
+import itertools
+import os
+import zlib
+
+import numpy as np
+
+import util.index_database.general
+import util.io.filelock.np
+import util.logging
+
+import simulation.model.constants
+
+logger = util.logging.logger
+
+
+
+class Parameter_Hash:
+
+    ## lookup of parameter sets equal within the tolerance options of the parameter database with a spatial hash
+    ## (each parameter is mapped to a coordinate where equal values differ by at most one, the coordinates are quantized in cells,
+    ##  so only the cell of the parameters and the neighbouring cells within distance one have to be checked)
+    ## (the first row of the hash file holds a fingerprint of the tolerance options and the cell size and a signature of the parameter database file,
+    ##  the other rows are the index of a parameter set followed by its cell)
+
+    ## coordinates are clipped to this range so that the cells fit into int64, larger values share the outermost cells
+    MAX_COORDINATE = 2**61
+    ## cell of zero if its absolute tolerance is zero (zero is then only equal to itself)
+    ZERO_CELL = np.iinfo(np.int64).min
+
+    def __init__(self, file, parameter_db, cell_size=None):
+        if cell_size is None:
+            cell_size = simulation.model.constants.DATABASE_PARAMETERS_HASH_CELL_SIZE
+        if cell_size < 1:
+            raise ValueError('The cell size {} has to be at least one.'.format(cell_size))
+        self.cell_size = cell_size
+
+        self.parameter_db = parameter_db
+        self.relative_tolerance = np.asarray(parameter_db.relative_tolerance, dtype=np.float64)
+        self.absolute_tolerance = np.asarray(parameter_db.absolute_tolerance, dtype=np.float64)
+        if np.any(self.relative_tolerance >= 2):
+            raise ValueError('Relative tolerances {} greater or equal two are not supported.'.format(self.relative_tolerance))
+        if np.any(np.logical_and(self.relative_tolerance == 0, self.absolute_tolerance == 0)):
+            raise ValueError('Relative tolerances {} and absolute tolerances {} which are both zero are not supported.'.format(self.relative_tolerance, self.absolute_tolerance))
+        self.fingerprint = zlib.crc32(np.concatenate([self.relative_tolerance, self.absolute_tolerance, [cell_size]]).tobytes())
+
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        self.locked_file = util.io.filelock.np.LockedFile(file)
+
+        self._rows = None
+        self._rows_signature = None
+        self._cells = {}
+
+
+    def __str__(self):
+        return 'Parameter_Hash({})'.format(self.locked_file.file)
+
+
+    ## coordinates
+
+    def coordinates(self, parameters):
+        ## integral of one over the tolerance max(relative * |x|, absolute) from zero to the parameters
+        ## (from one if the absolute tolerance is zero, then zero has no coordinate and nan is returned)
+        parameters = np.asarray(parameters, dtype=np.float64)
+        relative_tolerance = np.broadcast_to(self.relative_tolerance, parameters.shape)
+        absolute_tolerance = np.broadcast_to(self.absolute_tolerance, parameters.shape)
+        abs_parameters = np.abs(parameters)
+        coordinates = np.empty(parameters.shape)
+
+        ## linear below and logarithmic above the threshold where both tolerances are equal
+        absolute_mask = absolute_tolerance > 0
+        coordinates[absolute_mask] = abs_parameters[absolute_mask] / absolute_tolerance[absolute_mask]
+        relative_mask = np.logical_and(absolute_mask, relative_tolerance > 0)
+        if np.any(relative_mask):
+            relative_tolerance_masked = relative_tolerance[relative_mask]
+            threshold = absolute_tolerance[relative_mask] / relative_tolerance_masked
+            abs_relative_parameters = abs_parameters[relative_mask]
+            logarithmic_mask = abs_relative_parameters > threshold
+            logarithmic_coordinates = 1 / relative_tolerance_masked + np.log(np.maximum(abs_relative_parameters, threshold) / threshold) / relative_tolerance_masked
+            coordinates[relative_mask] = np.where(logarithmic_mask, logarithmic_coordinates, coordinates[relative_mask])
+
+        ## only logarithmic without absolute tolerance
+        relative_only_mask = np.logical_not(absolute_mask)
+        if np.any(relative_only_mask):
+            abs_relative_parameters = abs_parameters[relative_only_mask]
+            nonzero_mask = abs_relative_parameters > 0
+            logarithmic_coordinates = np.log(np.where(nonzero_mask, abs_relative_parameters, 1)) / relative_tolerance[relative_only_mask]
+            coordinates[relative_only_mask] = np.where(nonzero_mask, logarithmic_coordinates, np.nan)
+
+        coordinates = np.sign(parameters) * coordinates
+        return np.clip(coordinates, - self.MAX_COORDINATE, self.MAX_COORDINATE)
+
+
+    def _cell_of_coordinates(self, coordinates):
+        zero_mask = np.isnan(coordinates)
+        cell = np.floor(np.where(zero_mask, 0, coordinates) / self.cell_size).astype(np.int64)
+        cell[zero_mask] = self.ZERO_CELL
+        return cell
+
+
+    def cell(self, parameters):
+        return self._cell_of_coordinates(self.coordinates(parameters))
+
+
+    def _neighbour_cells(self, parameters):
+        ## a small margin above one for rounding errors
+        ## (which grow with the coordinates until distinct values can not be equal within the tolerances anymore)
+        coordinates = self.coordinates(parameters)
+        margin = 1 + 1e-6 + 2 * np.finfo(np.float64).eps * np.minimum(np.abs(coordinates), 2**53)
+        lower_cell = self._cell_of_coordinates(coordinates - margin)
+        upper_cell = self._cell_of_coordinates(coordinates + margin)
+        cell_ranges = [range(lower_cell_i, upper_cell_i + 1) for lower_cell_i, upper_cell_i in zip(lower_cell, upper_cell)]
+        for cell in itertools.product(*cell_ranges):
+            yield cell
+
+
+    ## file
+
+    @staticmethod
+    def _file_signature(file):
+        ## cheap signature of a file by its modification time and size
+        try:
+            file_stat = os.stat(file)
+        except FileNotFoundError:
+            return 0
+        else:
+            return zlib.crc32(np.array([file_stat.st_mtime_ns, file_stat.st_size], dtype=np.int64).tobytes())
+
+
+    def _parameter_db_signature(self):
+        return self._file_signature(self.parameter_db.array_file)
+
+
+    def _load(self):
+        ## reload and rebuild cells only if file has changed
+        rows_signature = self._file_signature(self.locked_file.file)
+        if rows_signature != self._rows_signature or rows_signature == 0:
+            try:
+                rows = self.locked_file.load()
+            except FileNotFoundError:
+                rows = None
+            self._cells = {}
+            if self._has_valid_header(rows):
+                for row in rows[1:]:
+                    self._cells.setdefault(tuple(row[1:]), []).append(int(row[0]))
+            self._rows = rows
+            self._rows_signature = rows_signature
+
+        return self._rows
+
+
+    def _has_valid_header(self, rows):
+        return rows is not None and len(rows) > 0 and rows[0, 0] == -1 and rows[0, 1] == self.fingerprint
+
+
+    def _is_valid(self, rows):
+        return self._has_valid_header(rows) and rows[0, 2] == self._parameter_db_signature()
+
+
+    def _header_row(self, number_of_parameters):
+        header_row = np.zeros(1 + number_of_parameters, dtype=np.int64)
+        header_row[0] = -1
+        header_row[1] = self.fingerprint
+        header_row[2] = self._parameter_db_signature()
+        return header_row
+
+
+    def _save(self, rows):
+        self.locked_file.save(rows)
+        self._rows_signature = None
+
+
+    ## access
+
+    def index(self, parameters):
+        parameters = np.asarray(parameters, dtype=np.float64)
+        logger.debug('{}: Searching for index of parameters {}.'.format(self, parameters))
+
+        ## rebuild if hash is missing, for other tolerance options or out of sync with parameter database
+        rows = self._load()
+        if not self._is_valid(rows):
+            self.rebuild()
+
+        ## check parameter sets in neighbouring cells
+        best_index = None
+        best_value_difference = float('inf')
+        for cell in self._neighbour_cells(parameters):
+            for index in self._cells.get(cell, ()):
+                try:
+                    value = self.parameter_db.get_value(index)
+                except util.index_database.general.DatabaseIndexError:
+                    continue
+                value_difference = self.parameter_db.value_difference(parameters, value)
+                if value_difference <= 1 and value_difference < best_value_difference:
+                    best_index = index
+                    best_value_difference = value_difference
+
+        logger.debug('{}: Index for parameters {} is {}.'.format(self, parameters, best_index))
+        return best_index
+
+
+    def add(self, index, parameters):
+        ## the parameter database has just been changed by adding this index (under the index lock after a lookup which has synchronized the hash)
+        row = np.concatenate([[index], self.cell(parameters)])
+        with self.locked_file.lock_object(exclusive=True):
+            rows = self._load()
+            if not self._has_valid_header(rows):
+                rows = self._header_row(len(row) - 1)[np.newaxis]
+            if index not in rows[1:, 0]:
+                logger.debug('{}: Adding parameter set {} with index {}.'.format(self, parameters, index))
+                rows = np.concatenate([rows, row[np.newaxis]])
+            else:
+                rows = rows.copy()
+            rows[0, 2] = self._parameter_db_signature()
+            self._save(rows)
+
+
+    def remove(self, index):
+        ## the parameter database has just been changed by removing this index
+        with self.locked_file.lock_object(exclusive=True):
+            rows = self._load()
+            if self._has_valid_header(rows):
+                logger.debug('{}: Removing parameter set with index {}.'.format(self, index))
+                rows = np.concatenate([rows[:1], rows[1:][rows[1:, 0] != index]])
+                rows[0, 2] = self._parameter_db_signature()
+                self._save(rows)
+
+
+    def rebuild(self):
+        indices = self.parameter_db.used_indices()
+        logger.debug('{}: Rebuilding with {} parameter sets.'.format(self, len(indices)))
+        values = np.asarray(self.parameter_db.all_values(), dtype=np.float64)
+        if len(values) > 0:
+            rows = np.empty((len(indices) + 1, 1 + values.shape[1]), dtype=np.int64)
+            rows[0] = self._header_row(values.shape[1])
+            rows[1:, 0] = indices
+            rows[1:, 1:] = self.cell(values)
+            with self.locked_file.lock_object(exclusive=True):
+                self._save(rows)
+            self._load()
+        else:
+            self._cells = {}
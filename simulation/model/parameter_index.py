@@ -0,0 +1,170 @@
+import os
+
+import numpy as np
+import scipy.spatial
+
+import util.io.filelock.np
+import util.logging
+
+logger = util.logging.logger
+
+
+
+class Parameter_Index:
+
+    ## nearest parameter sets with finished spinup, distances are normalized by typical parameter values
+    ## (each row of the index file is the index of the parameter set followed by its parameters)
+
+    def __init__(self, file, typical_parameters, rebuild_min_size=16):
+        self.typical_parameters = np.asarray(typical_parameters, dtype=np.float64)
+        self.rebuild_min_size = rebuild_min_size
+
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        self.locked_file = util.io.filelock.np.LockedFile(file, cache_beyond_lock=False)
+
+        self._rows = self._empty_rows()
+        self._rows_signature = None
+        self._tree = None
+        self._tree_len = 0
+
+
+    def __str__(self):
+        return 'Parameter_Index({})'.format(self.locked_file.file)
+
+
+    def __len__(self):
+        return len(self._load())
+
+
+    def _empty_rows(self):
+        return np.empty((0, 1 + len(self.typical_parameters)), dtype=np.float64)
+
+
+    def _normalize(self, parameters):
+        return np.asarray(parameters, dtype=np.float64) / self.typical_parameters
+
+
+    ## file
+
+    def exists(self):
+        return os.path.exists(self.locked_file.file)
+
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.locked_file.file)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+
+    def _set_rows(self, rows):
+        ## tree is valid if rows were only appended, rebuild it if too many rows are appended
+        if self._tree is None or len(rows) < self._tree_len or not np.array_equal(rows[:self._tree_len], self._rows[:self._tree_len]) or len(rows) - self._tree_len > max(self.rebuild_min_size, np.sqrt(len(rows))):
+            self._tree = None
+            self._tree_len = 0
+        self._rows = rows
+
+        if self._tree is None and len(rows) > 0:
+            logger.debug('{}: Building tree for {} parameter sets.'.format(self, len(rows)))
+            self._tree = scipy.spatial.cKDTree(self._normalize(rows[:, 1:]))
+            self._tree_len = len(rows)
+
+
+    def _load(self):
+        ## rows are cached until the file is changed (by another index object or process)
+        rows_signature = self._file_signature()
+        if rows_signature is None:
+            if self._rows_signature is not None:
+                self._set_rows(self._empty_rows())
+                self._rows_signature = None
+        elif rows_signature != self._rows_signature:
+            self._set_rows(self.locked_file.load())
+            self._rows_signature = rows_signature
+        return self._rows
+
+
+    def _save(self, rows):
+        self.locked_file.save(rows)
+        self._set_rows(rows)
+        self._rows_signature = self._file_signature()
+
+
+    ## access
+
+    def nearest(self, parameters, k=1):
+        return self._nearest(self._load(), parameters, k=k)
+
+
+    def _nearest(self, rows, parameters, k=1):
+        k = min(k, len(rows))
+        if k == 0:
+            return (np.empty(0, dtype=np.int64), np.empty(0))
+        normalized_parameters = self._normalize(parameters)
+
+        ## query tree
+        if self._tree_len > 0:
+            tree_distances, tree_positions = self._tree.query(normalized_parameters, k=min(k, self._tree_len))
+            tree_distances = np.atleast_1d(tree_distances)
+            tree_positions = np.atleast_1d(tree_positions)
+        else:
+            tree_distances = np.empty(0)
+            tree_positions = np.empty(0, dtype=np.int64)
+
+        ## check rows appended after building the tree
+        appended_positions = np.arange(self._tree_len, len(rows))
+        appended_distances = np.linalg.norm(self._normalize(rows[self._tree_len:, 1:]) - normalized_parameters, axis=1)
+
+        distances = np.concatenate([tree_distances, appended_distances])
+        positions = np.concatenate([tree_positions, appended_positions])
+        order = np.argsort(distances, kind='stable')[:k]
+
+        indices = rows[positions[order], 0].astype(np.int64)
+        return (indices, distances[order])
+
+
+    def nearest_indices(self, parameters):
+        ## yield indices with increasing distance (doubling the number of queried neighbours)
+        ## (rows and tree are loaded once)
+        rows = self._load()
+        k = 1
+        number_of_yielded_indices = 0
+        while number_of_yielded_indices < len(rows):
+            indices, distances = self._nearest(rows, parameters, k=k)
+            for index in indices[number_of_yielded_indices:]:
+                yield index
+            number_of_yielded_indices = len(indices)
+            k = k * 2
+
+
+    def contains(self, parameters):
+        indices, distances = self.nearest(parameters, k=1)
+        return len(distances) > 0 and distances[0] == 0
+
+
+    def add(self, index, parameters):
+        if index in self._load()[:, 0]:
+            return
+        row = np.concatenate([[index], np.asarray(parameters, dtype=np.float64)])
+        with self.locked_file.lock_object(exclusive=True):
+            rows = self._load()
+            if index not in rows[:, 0]:
+                logger.debug('{}: Adding parameter set {} with index {}.'.format(self, parameters, index))
+                self._save(np.concatenate([rows, row[np.newaxis]]))
+
+
+    def remove(self, index):
+        with self.locked_file.lock_object(exclusive=True):
+            rows = self._load()
+            if index in rows[:, 0]:
+                logger.debug('{}: Removing parameter set with index {}.'.format(self, index))
+                self._save(rows[rows[:, 0] != index])
+
+
+    def rebuild(self, indices, parameters_list):
+        rows = self._empty_rows()
+        if len(indices) > 0:
+            rows = np.concatenate([np.asarray(indices, dtype=np.float64)[:, np.newaxis], np.asarray(parameters_list, dtype=np.float64)], axis=1)
+        logger.debug('{}: Rebuilding with {} parameter sets.'.format(self, len(rows)))
+        with self.locked_file.lock_object(exclusive=True):
+            self._save(rows)
@@ -21,7 +21,10 @@ def remove(model_name, concentrations_index, parameter_set_index, time_step=1, u
     parameter_db = m._parameter_db
     
     ## remove indices
+    m._update_catalog('remove_parameter_set', m.parameter_set_dir_with_index(parameter_set_index))
     parameter_db.remove_index(parameter_set_index, force=True)
+    m._parameter_hash.remove(parameter_set_index)
+    m._parameter_index.remove(parameter_set_index)
     if parameter_db.number_of_used_indices() == 0:
         concentration_db.remove_index(concentrations_index, force=True)
     
@@ -0,0 +1,82 @@
+import os
+import tempfile
+
+import util.io.fs
+import util.logging
+
+import simulation.model.constants
+
+logger = util.logging.logger
+
+
+
+class Run_Ledger:
+
+    ## one line per run: run_index years cumulative_years tolerance finished
+
+    def __init__(self, spinup_dir):
+        self.spinup_dir = spinup_dir
+        self.file = os.path.join(spinup_dir, simulation.model.constants.DATABASE_RUN_LEDGER_FILENAME)
+
+
+    def __str__(self):
+        return 'Run_Ledger({})'.format(self.file)
+
+
+    def _format_entry(self, run_index, years, cumulative_years, tolerance, finished):
+        return '{:d} {:d} {:d} {!r} {:d}\n'.format(run_index, years, cumulative_years, float(tolerance), int(finished))
+
+
+    def entries(self):
+        entries = {}
+        try:
+            with open(self.file) as file_object:
+                lines = file_object.readlines()
+        except FileNotFoundError:
+            lines = []
+
+        for line in lines:
+            values = line.split()
+            ## ignore incompletely written lines
+            if len(values) == 5:
+                try:
+                    run_index = int(values[0])
+                    entry = (int(values[1]), int(values[2]), float(values[3]), bool(int(values[4])))
+                except ValueError:
+                    logger.warn('Ignoring invalid line "{}" in run ledger {}.'.format(line.strip(), self.file))
+                else:
+                    entries[run_index] = entry
+        return entries
+
+
+    def entry(self, run_index):
+        try:
+            entry = self.entries()[run_index]
+        except KeyError:
+            entry = None
+        logger.debug('Run ledger {} has entry {} for run index {}.'.format(self.file, entry, run_index))
+        return entry
+
+
+    def add(self, run_index, years, cumulative_years, tolerance, finished=True):
+        line = self._format_entry(run_index, years, cumulative_years, tolerance, finished)
+        logger.debug('Adding entry {} to run ledger {}.'.format(line.strip(), self.file))
+        with open(self.file, 'a') as file_object:
+            file_object.write(line)
+
+
+    def remove_from(self, run_index):
+        entries = self.entries()
+        if any(index >= run_index for index in entries.keys()):
+            logger.debug('Removing entries with run index greater or equal {} from run ledger {}.'.format(run_index, self.file))
+            lines = [self._format_entry(index, *entry) for index, entry in sorted(entries.items()) if index < run_index]
+
+            ## write to temporary file and rename it so that readers see only complete files
+            (fd, tmp_file) = tempfile.mkstemp(dir=self.spinup_dir, prefix='.tmp_')
+            try:
+                with os.fdopen(fd, 'w') as file_object:
+                    file_object.writelines(lines)
+                os.replace(tmp_file, self.file)
+            except:
+                util.io.fs.remove_file(tmp_file, not_exist_okay=True)
+                raise
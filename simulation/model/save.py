@@ -89,7 +89,22 @@ def save_all(concentration_indices=None, time_steps=None, parameter_set_indices=
     model_options.spinup_options.years = 1
     model_options.spinup_options.tolerance = 0
     model_options.spinup_options.combination = 'or'
-    
+
+    ## parameter sets from catalog if complete
+    if model._is_catalog_complete():
+        for (parameter_set_dir, model_name, concentrations_kind, concentrations_index, concentrations, time_step, parameter_set_index, parameters) in model.catalog.parameter_sets(time_steps=time_steps):
+            if (concentration_indices is None or concentrations_index in concentration_indices) and (not use_fix_parameter_sets or parameter_set_index in parameter_set_indices):
+                model_options.model_name = model_name
+                if concentrations_kind != 'constant':
+                    concentrations = model._vector_concentrations_db.get_value(concentrations_index)
+                model_options.initial_concentration_options.concentrations = concentrations
+                model_options.time_step = time_step
+                model_options.parameters = parameters
+                logger.info('Calculating model output in {}.'.format(model.parameter_set_dir))
+                model.f_measurements(*measurements_list)
+        return
+
+    ## parameter sets from index databases
     for model_name in simulation.model.constants.MODEL_NAMES:
         model_options.model_name = model_name
         for concentration_db in (model._constant_concentrations_db, model._vector_concentrations_db):
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import re
+import tempfile
+
+import numpy as np
+
+import util.io.fs
+import util.logging
+
+import simulation.model.constants
+import simulation.model.data
+
+logger = util.logging.logger
+
+
+
+class Trajectory_Store:
+
+    def __init__(self, store_dir, max_size_gb):
+        if max_size_gb <= 0:
+            raise ValueError('The max size of the trajectory store has to be positive, but it is {}.'.format(max_size_gb))
+        self.store_dir = store_dir
+        self.max_size = int(max_size_gb * 1024**3)
+
+
+    def __str__(self):
+        return 'Trajectory_Store({}, max_size={})'.format(self.store_dir, self.max_size)
+
+
+    ## files
+
+    def _entry_dir(self, key):
+        key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.store_dir, key_hash)
+
+
+    def _file(self, key, tracer, time_dim):
+        filename = simulation.model.constants.MODEL_TRAJECTORY_STORE_FILENAME.format(tracer=tracer, time_dim=time_dim)
+        return os.path.join(self._entry_dir(key), filename)
+
+
+    def _stored_files(self, key, tracer):
+        ## make regular expression for stored filenames of tracer
+        filename_prefix, filename_suffix = simulation.model.constants.MODEL_TRAJECTORY_STORE_FILENAME.split('{time_dim:0>4d}')
+        filename_regular_expression = re.compile(re.escape(filename_prefix.format(tracer=tracer)) + r'(\d+)' + re.escape(filename_suffix))
+
+        ## get stored files sorted by time dim
+        entry_dir = self._entry_dir(key)
+        try:
+            filenames = os.listdir(entry_dir)
+        except FileNotFoundError:
+            filenames = []
+        stored_files = [(int(match.group(1)), os.path.join(entry_dir, match.group(0))) for match in map(filename_regular_expression.fullmatch, filenames) if match is not None]
+        stored_files.sort()
+        return stored_files
+
+
+    ## access
+
+    def load(self, key, tracer, time_dim):
+        for stored_time_dim, file in self._stored_files(key, tracer):
+            if stored_time_dim % time_dim == 0:
+                try:
+                    with np.load(file) as stored_values:
+                        if str(stored_values['key']) != repr(key):
+                            logger.warn('Stored trajectory {} belongs to another key. It is ignored.'.format(file))
+                            continue
+                        trajectory = stored_values['trajectory']
+                except (OSError, KeyError, ValueError) as exception:
+                    logger.warn('Stored trajectory {} could not be loaded: {}'.format(file, exception))
+                    continue
+
+                ## mark as recently used
+                try:
+                    os.utime(file)
+                except OSError:
+                    pass
+
+                logger.debug('Trajectory for tracer {} with time dim {} loaded from {}.'.format(tracer, stored_time_dim, file))
+                return simulation.model.data.aggregate_trajectory(trajectory, time_dim_desired=time_dim)
+
+        logger.debug('No stored trajectory for tracer {} with time dim {} available.'.format(tracer, time_dim))
+        return None
+
+
+    def save(self, key, tracer, trajectory):
+        trajectory = np.asanyarray(trajectory)
+        file = self._file(key, tracer, len(trajectory))
+        entry_dir = os.path.dirname(file)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        ## write to temporary file and rename it so that readers see only complete files
+        (fd, tmp_file) = tempfile.mkstemp(dir=entry_dir, prefix='.tmp_', suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as file_object:
+                np.savez_compressed(file_object, trajectory=trajectory, key=repr(key))
+            os.replace(tmp_file, file)
+        except:
+            util.io.fs.remove_file(tmp_file, not_exist_okay=True)
+            raise
+        logger.debug('Trajectory for tracer {} with shape {} saved to {}.'.format(tracer, trajectory.shape, file))
+
+        ## keep disk budget
+        self.evict(keep_files=(file,))
+
+
+    ## eviction
+
+    def stored_files(self):
+        stored_files = []
+
+        def add_file(file):
+            if not os.path.basename(file).startswith('.tmp_'):
+                try:
+                    file_stat = os.stat(file)
+                except FileNotFoundError:
+                    pass
+                else:
+                    stored_files.append((file_stat.st_mtime, file_stat.st_size, file))
+
+        util.io.fs.walk_all_files_in_dir(self.store_dir, add_file)
+        return stored_files
+
+
+    def size(self):
+        return sum(file_size for (file_mtime, file_size, file) in self.stored_files())
+
+
+    def evict(self, keep_files=()):
+        stored_files = self.stored_files()
+        size = sum(file_size for (file_mtime, file_size, file) in stored_files)
+
+        ## remove least recently used files until size fits
+        if size > self.max_size:
+            stored_files.sort()
+            for (file_mtime, file_size, file) in stored_files:
+                if size <= self.max_size:
+                    break
+                if file not in keep_files:
+                    logger.debug('Removing least recently used trajectory {} from trajectory store.'.format(file))
+                    util.io.fs.remove_file(file, not_exist_okay=True)
+                    size -= file_size
+                    try:
+                        os.rmdir(os.path.dirname(file))
+                    except OSError:
+                        pass
+
+        logger.debug('Trajectory store {} has size {}.'.format(self.store_dir, size))
+        return size
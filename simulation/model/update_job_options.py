@@ -1,9 +1,11 @@
 import os
+import sqlite3
 import stat
 
 import numpy as np
 
 import simulation.constants
+import simulation.model.catalog
 import simulation.model.job
 import simulation.model.constants
 
@@ -16,7 +18,31 @@ logger = util.logging.logger
 
 ## general update functions for job options
 
-def update_job_options(update_function, model_names=None):
+def job_files_from_catalog(model_names=None):
+    ## job option files of all runs in the catalog or None if the catalog is not complete
+    if not simulation.model.constants.DATABASE_CATALOG:
+        return None
+    catalog = simulation.model.catalog.Catalog()
+    try:
+        if not catalog.is_complete():
+            return None
+        runs = catalog.runs()
+    except (sqlite3.Error, OSError) as exception:
+        logger.warn('{} could not be read: {}'.format(catalog, exception))
+        return None
+
+    if model_names is not None:
+        model_dirs = tuple(os.path.join(simulation.model.constants.DATABASE_OUTPUT_DIR, simulation.model.constants.DATABASE_MODEL_DIRNAME.format(model_name)) + os.sep for model_name in model_names)
+        runs = [run for run in runs if run[0].startswith(model_dirs)]
+
+    ## reserved runs have no job options file yet
+    job_files = [os.path.join(run[0], simulation.model.constants.JOB_OPTIONS_FILENAME) for run in runs]
+    job_files = [job_file for job_file in job_files if os.path.exists(job_file)]
+    logger.info('Got {} jobs from {}.'.format(len(job_files), catalog))
+    return job_files
+
+
+def job_files_from_directories(model_names=None):
     if model_names is None:
         database_dir = simulation.model.constants.DATABASE_OUTPUT_DIR
         logger.info('Getting jobs in {}.'.format(database_dir))
@@ -31,7 +57,13 @@ def update_job_options(update_function, model_names=None):
             model_job_files = util.io.fs.get_files(model_dir, filename_pattern='*/job_options.hdf5', use_absolute_filenames=True, recursive=True)
             logger.info('Got {} jobs.'.format(len(model_job_files)))
             job_files.extend(model_job_files)
+    return job_files
+
 
+def update_job_options(update_function, model_names=None):
+    job_files = job_files_from_catalog(model_names=model_names)
+    if job_files is None:
+        job_files = job_files_from_directories(model_names=model_names)
 
     for job_file in job_files:
         util.io.fs.make_writable(job_file)
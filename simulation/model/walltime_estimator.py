@@ -0,0 +1,302 @@
+import argparse
+import os
+import re
+import sqlite3
+
+import numpy as np
+import scipy.optimize
+
+import util.io.fs
+import util.logging
+
+import simulation.model.catalog
+import simulation.model.constants
+import simulation.model.job
+
+logger = util.logging.logger
+
+
+## elapsed time written by the time command of the batch system (format [hours:]minutes:seconds)
+
+ELAPSED_TIME_SEARCH_STRING = 'Elapsed time:'
+ELAPSED_TIME_REGULAR_EXPRESSION = re.compile(ELAPSED_TIME_SEARCH_STRING + r'\s*([\d:.]+)s?')
+
+
+def elapsed_seconds(output_file):
+    line = simulation.model.job.last_line_containing(output_file, ELAPSED_TIME_SEARCH_STRING)
+    if line is None:
+        return None
+    match = ELAPSED_TIME_REGULAR_EXPRESSION.search(line)
+    if match is None:
+        return None
+
+    seconds = 0
+    for value in match.group(1).split(':'):
+        seconds = seconds * 60 + float(value)
+    return seconds
+
+
+def default_seconds_per_year(nodes, cpus, time_step):
+    sec_per_year = np.exp(- (nodes * cpus) / (6*16)) * 10 + 2.5
+    sec_per_year /= time_step**(1/2)
+    return sec_per_year
+
+
+
+## samples from finished runs
+
+def sample_for_run(run_dir):
+    ## sample: model name, node kind, total cpus, time step, seconds per year
+    with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+        if not os.path.exists(job.finished_file) or job.output_file is None or not os.path.exists(job.output_file):
+            return None
+
+        seconds = elapsed_seconds(job.output_file)
+        spinup_history = job.spinup_history
+        if seconds is None or len(spinup_history) == 0:
+            return None
+        years = spinup_history[-1, 0]
+
+        node_kind = job.option_value('/job/node_kind', not_exist_okay=True)
+        if node_kind is None:
+            node_kind = job.cpu_kind
+        model_name = job.options['/model/name']
+        total_cpus = job.nodes * job.cpus
+        time_step = job.options['/model/time_step_multiplier']
+
+    if years <= 0 or seconds <= 0:
+        return None
+    return (model_name, node_kind, total_cpus, time_step, seconds / years)
+
+
+def run_dirs_from_catalog(model_names=None):
+    ## run dirs of all runs in the catalog or None if the catalog is not complete
+    if not simulation.model.constants.DATABASE_CATALOG:
+        return None
+    catalog = simulation.model.catalog.Catalog()
+    try:
+        if not catalog.is_complete():
+            return None
+        runs = catalog.runs()
+    except (sqlite3.Error, OSError) as exception:
+        logger.warn('{} could not be read: {}'.format(catalog, exception))
+        return None
+
+    run_dirs = [run[0] for run in runs]
+    if model_names is not None:
+        model_dirs = tuple(os.path.join(simulation.model.constants.DATABASE_OUTPUT_DIR, simulation.model.constants.DATABASE_MODEL_DIRNAME.format(model_name)) + os.sep for model_name in model_names)
+        run_dirs = [run_dir for run_dir in run_dirs if run_dir.startswith(model_dirs)]
+
+    ## reserved runs have no job options file yet
+    run_dirs = [run_dir for run_dir in run_dirs if os.path.exists(os.path.join(run_dir, simulation.model.constants.JOB_OPTIONS_FILENAME))]
+    return run_dirs
+
+
+def run_dirs_from_directories(model_names=None):
+    if model_names is None:
+        base_dirs = [simulation.model.constants.DATABASE_OUTPUT_DIR]
+    else:
+        base_dirs = [os.path.join(simulation.model.constants.DATABASE_OUTPUT_DIR, simulation.model.constants.DATABASE_MODEL_DIRNAME.format(model_name)) for model_name in model_names]
+
+    run_dirs = []
+    for base_dir in base_dirs:
+        job_option_files = util.io.fs.get_files(base_dir, filename_pattern='*/' + simulation.model.constants.JOB_OPTIONS_FILENAME, use_absolute_filenames=True, recursive=True)
+        run_dirs.extend(os.path.dirname(job_option_file) for job_option_file in job_option_files)
+    return run_dirs
+
+
+def samples(model_names=None):
+    ## use catalog if complete, otherwise search database
+    run_dirs = run_dirs_from_catalog(model_names=model_names)
+    if run_dirs is None:
+        run_dirs = run_dirs_from_directories(model_names=model_names)
+
+    samples = []
+    for run_dir in run_dirs:
+        try:
+            sample = sample_for_run(run_dir)
+        except (OSError, KeyError, ValueError) as exception:
+            logger.warn('Run {} could not be used for walltime estimation: {}'.format(run_dir, exception))
+        else:
+            if sample is not None:
+                samples.append(sample)
+
+    logger.debug('{} samples for walltime estimation found.'.format(len(samples)))
+    return samples
+
+
+
+## estimator
+
+class Walltime_Estimator:
+
+    ## seconds per year follow amdahl's law (serial part plus part divided by total cpus) for each model,
+    ## both parts scale with the number of time steps per year and are multiplied by a factor for each node kind
+    ## (models and node kinds without samples use the coefficients fitted with all samples and the factor one)
+
+    def __init__(self, model_coefficients, model_names, node_kind_factors, node_kinds, global_coefficients, safety_factor=1):
+        self.model_coefficients = np.asarray(model_coefficients, dtype=np.float64).reshape(-1, 2)
+        self.model_names = tuple(model_names)
+        self.node_kind_factors = np.asarray(node_kind_factors, dtype=np.float64).reshape(-1)
+        self.node_kinds = tuple(node_kinds)
+        self.global_coefficients = np.asarray(global_coefficients, dtype=np.float64)
+        self.safety_factor = safety_factor
+        assert len(self.model_coefficients) == len(self.model_names)
+        assert len(self.node_kind_factors) == len(self.node_kinds)
+        assert self.global_coefficients.shape == (2,)
+
+
+    def __str__(self):
+        return 'Walltime_Estimator(model_names={}, node_kinds={}, safety_factor={})'.format(self.model_names, self.node_kinds, self.safety_factor)
+
+
+    @staticmethod
+    def _features(total_cpus, time_step):
+        total_cpus = np.asarray(total_cpus, dtype=np.float64)
+        time_step = np.asarray(time_step, dtype=np.float64)
+        return np.stack([1 / time_step, 1 / (time_step * total_cpus)], axis=-1)
+
+
+    @classmethod
+    def _fit_coefficients(cls, total_cpus, time_steps, seconds_per_year):
+        ## nonnegative least squares of relative errors
+        features = cls._features(total_cpus, time_steps) / seconds_per_year[:, np.newaxis]
+        coefficients = scipy.optimize.nnls(features, np.ones(len(seconds_per_year)))[0]
+        ## ensure positive estimation
+        if np.all(coefficients == 0):
+            coefficients[0] = np.mean(seconds_per_year * time_steps)
+        return coefficients
+
+
+    @classmethod
+    def fit(cls, samples, quantile=None, iterations=5):
+        if quantile is None:
+            quantile = simulation.model.constants.JOB_WALLTIME_ESTIMATOR_QUANTILE
+        if len(samples) == 0:
+            raise ValueError('At least one sample is needed to fit the walltime estimator.')
+
+        model_names = tuple(sorted(set(sample[0] for sample in samples)))
+        node_kinds = tuple(sorted(set(sample[1] for sample in samples if sample[1] is not None)))
+        sample_model_names = np.array([sample[0] for sample in samples])
+        sample_node_kinds = [sample[1] for sample in samples]
+        total_cpus = np.array([sample[2] for sample in samples], dtype=np.float64)
+        time_steps = np.array([sample[3] for sample in samples], dtype=np.float64)
+        seconds_per_year = np.array([sample[4] for sample in samples], dtype=np.float64)
+
+        ## alternately fit coefficients of models and factors of node kinds
+        node_kind_factors = np.ones(len(node_kinds))
+        for iteration in range(iterations):
+            sample_node_kind_factors = np.array([node_kind_factors[node_kinds.index(node_kind)] if node_kind in node_kinds else 1 for node_kind in sample_node_kinds])
+            normalized_seconds_per_year = seconds_per_year / sample_node_kind_factors
+
+            global_coefficients = cls._fit_coefficients(total_cpus, time_steps, normalized_seconds_per_year)
+            model_coefficients = np.empty((len(model_names), 2))
+            for i, model_name in enumerate(model_names):
+                mask = sample_model_names == model_name
+                model_coefficients[i] = cls._fit_coefficients(total_cpus[mask], time_steps[mask], normalized_seconds_per_year[mask])
+
+            estimator = cls(model_coefficients, model_names, node_kind_factors, node_kinds, global_coefficients)
+            log_ratios = np.log(seconds_per_year) - np.log([estimator.seconds_per_year(*sample[:2], 1, sample[2], sample[3]) for sample in samples])
+            for j, node_kind in enumerate(node_kinds):
+                mask = np.array([sample_node_kind == node_kind for sample_node_kind in sample_node_kinds])
+                node_kind_factors[j] *= np.exp(np.median(log_ratios[mask]))
+
+        ## safety factor so that the desired quantile of the samples is not underestimated
+        estimator = cls(model_coefficients, model_names, node_kind_factors, node_kinds, global_coefficients)
+        residuals = np.log(seconds_per_year) - np.log([estimator.seconds_per_year(*sample[:2], 1, sample[2], sample[3]) for sample in samples])
+        estimator.safety_factor = max(np.exp(np.percentile(residuals, quantile * 100)), 1)
+
+        logger.debug('{} fitted with {} samples, model coefficients {} and node kind factors {}.'.format(estimator, len(samples), model_coefficients, node_kind_factors))
+        return estimator
+
+
+    def seconds_per_year(self, model_name, node_kind, nodes, cpus, time_step):
+        if model_name in self.model_names:
+            coefficients = self.model_coefficients[self.model_names.index(model_name)]
+        else:
+            coefficients = self.global_coefficients
+        if node_kind in self.node_kinds:
+            node_kind_factor = self.node_kind_factors[self.node_kinds.index(node_kind)]
+        else:
+            node_kind_factor = 1
+        return self._features(nodes * cpus, time_step).dot(coefficients) * node_kind_factor * self.safety_factor
+
+
+    def recommended_nodes(self, model_name, node_kind, cpus, time_step, years, max_walltime_hours, nodes_max):
+        ## least nodes which finish within max walltime
+        for nodes in range(1, nodes_max + 1):
+            walltime_hours = years * self.seconds_per_year(model_name, node_kind, nodes, cpus, time_step) / 60**2
+            if walltime_hours <= max_walltime_hours:
+                return nodes
+        return nodes_max
+
+
+    ## save and load
+
+    def save(self, file):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        np.savez(file, model_coefficients=self.model_coefficients, model_names=np.array(self.model_names, dtype=str), node_kind_factors=self.node_kind_factors, node_kinds=np.array(self.node_kinds, dtype=str), global_coefficients=self.global_coefficients, safety_factor=self.safety_factor)
+        logger.debug('{} saved to {}.'.format(self, file))
+
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as values:
+            estimator = cls(values['model_coefficients'], values['model_names'].tolist(), values['node_kind_factors'], values['node_kinds'].tolist(), values['global_coefficients'], safety_factor=float(values['safety_factor']))
+        logger.debug('{} loaded from {}.'.format(estimator, file))
+        return estimator
+
+
+
+_ESTIMATOR = None
+
+def estimator():
+    global _ESTIMATOR
+
+    if _ESTIMATOR is None:
+        file = simulation.model.constants.JOB_WALLTIME_ESTIMATOR_FILE
+        try:
+            _ESTIMATOR = Walltime_Estimator.load(file)
+        except (OSError, KeyError, ValueError):
+            logger.debug('No walltime estimator available at {}.'.format(file))
+            _ESTIMATOR = False
+
+    if _ESTIMATOR is False:
+        return None
+    else:
+        return _ESTIMATOR
+
+
+def seconds_per_year(model_name, node_kind, nodes, cpus, time_step):
+    fitted_estimator = estimator()
+    if fitted_estimator is not None:
+        return fitted_estimator.seconds_per_year(model_name, node_kind, nodes, cpus, time_step)
+    else:
+        return default_seconds_per_year(nodes, cpus, time_step)
+
+
+def refit(model_names=None, quantile=None):
+    global _ESTIMATOR
+
+    fitted_estimator = Walltime_Estimator.fit(samples(model_names=model_names), quantile=quantile)
+    fitted_estimator.save(simulation.model.constants.JOB_WALLTIME_ESTIMATOR_FILE)
+    _ESTIMATOR = fitted_estimator
+    return fitted_estimator
+
+
+
+if __name__ == "__main__":
+    ## configure arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--refit', action='store_true', help='Refit the walltime estimator with all finished runs in the database.')
+    parser.add_argument('-q', '--quantile', type=float, default=None, help='The quantile of the runs whose walltime should not be underestimated.')
+    parser.add_argument('-m', '--model_names', default=None, nargs='+', help='The models whose runs are used. If not specified all models are used.')
+    parser.add_argument('-d', '--debug_level', choices=util.logging.LEVELS, default='INFO', help='Print debug infos low to passed level.')
+    args = parser.parse_args()
+    ## run
+    with util.logging.Logger(level=args.debug_level):
+        if args.refit:
+            fitted_estimator = refit(model_names=args.model_names, quantile=args.quantile)
+            logger.info('{} fitted.'.format(fitted_estimator))
+        else:
+            logger.info('{} is used.'.format(estimator()))
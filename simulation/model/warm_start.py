@@ -0,0 +1,159 @@
+import os
+
+import numpy as np
+
+import util.petsc.universal
+import util.logging
+
+import simulation.model.constants
+import simulation.model.job
+
+logger = util.logging.logger
+
+
+
+## tracer vectors of runs
+
+def load_tracer_vectors(tracer_files):
+    return [util.petsc.universal.load_petsc_vec_to_numpy_array(os.path.expanduser(os.path.expandvars(tracer_file))) for tracer_file in tracer_files]
+
+
+def save_tracer_vectors(tracer_files, tracer_vectors):
+    for tracer_file, tracer_vector in zip(tracer_files, tracer_vectors):
+        util.petsc.universal.save_numpy_array_to_petsc_vec(tracer_file, tracer_vector)
+
+
+def run_parameters_and_tracer_vectors(run_dir):
+    with simulation.model.job.Metos3D_Job(run_dir, force_load=True) as job:
+        parameters = job.options['/model/parameters']
+        tracer_output_files = job.tracer_output_files
+    return (parameters, load_tracer_vectors(tracer_output_files))
+
+
+
+## mass
+
+_BOX_VOLUMES = None
+
+def box_volumes():
+    global _BOX_VOLUMES
+    if _BOX_VOLUMES is None:
+        _BOX_VOLUMES = util.petsc.universal.load_petsc_vec_to_numpy_array(simulation.model.constants.METOS_VOLUMES_FILE)
+    return _BOX_VOLUMES
+
+
+def total_mass(tracer_vectors):
+    volumes = box_volumes()
+    return sum(volumes.dot(tracer_vector) for tracer_vector in tracer_vectors)
+
+
+def clipped_tracer_vectors(tracer_vectors, reference_tracer_vectors):
+    ## concentrations are not negative and metos3d conserves the total mass which determines the reached equilibrium,
+    ## so negative concentrations are clipped and all tracers are rescaled to the total mass of the reference
+    tracer_vectors = [np.maximum(tracer_vector, 0) for tracer_vector in tracer_vectors]
+    mass = total_mass(tracer_vectors)
+    reference_mass = total_mass(reference_tracer_vectors)
+    if mass > 0:
+        factor = reference_mass / mass
+        logger.debug('Rescaling clipped tracer vectors with factor {} to total mass {}.'.format(factor, reference_mass))
+        return [tracer_vector * factor for tracer_vector in tracer_vectors]
+    else:
+        logger.debug('Clipped tracer vectors have no mass. Reference tracer vectors are used.')
+        return [tracer_vector.copy() for tracer_vector in reference_tracer_vectors]
+
+
+
+## weights
+
+def interpolation_weights(parameters, neighbour_parameters, typical_parameters, regularization=None, max_extrapolation=None):
+    ## affine weights (sum is one) whose combination of the neighbour parameters is as close as possible to the parameters,
+    ## regularized towards inverse distance weights so that the weights are unique if the neighbours are affinely dependent
+    if regularization is None:
+        regularization = simulation.model.constants.MODEL_WARM_START_REGULARIZATION
+    if max_extrapolation is None:
+        max_extrapolation = simulation.model.constants.MODEL_WARM_START_MAX_EXTRAPOLATION
+
+    parameters = np.asarray(parameters, dtype=np.float64) / typical_parameters
+    neighbour_parameters = np.asarray(neighbour_parameters, dtype=np.float64) / typical_parameters
+    k = len(neighbour_parameters)
+    if k == 0:
+        raise ValueError('At least one neighbour is needed for interpolation weights.')
+
+    ## inverse distance weights
+    distances = np.linalg.norm(neighbour_parameters - parameters, axis=1)
+    if np.any(distances == 0):
+        inverse_distance_weights = (distances == 0).astype(np.float64)
+    else:
+        inverse_distance_weights = 1 / distances
+    inverse_distance_weights /= inverse_distance_weights.sum()
+    if k == 1:
+        return inverse_distance_weights
+
+    ## solve equality constrained least squares problem with lagrange multiplier
+    A = neighbour_parameters.T
+    M = np.zeros((k + 1, k + 1))
+    M[:k, :k] = A.T.dot(A) + regularization * np.eye(k)
+    M[:k, k] = 1
+    M[k, :k] = 1
+    b = np.zeros(k + 1)
+    b[:k] = A.T.dot(parameters) + regularization * inverse_distance_weights
+    b[k] = 1
+    try:
+        weights = np.linalg.solve(M, b)[:k]
+    except np.linalg.LinAlgError:
+        weights = inverse_distance_weights
+
+    ## avoid wild extrapolation
+    if np.abs(weights).sum() > max_extrapolation:
+        logger.debug('Interpolation weights {} extrapolate too far. Inverse distance weights are used.'.format(weights))
+        weights = inverse_distance_weights
+
+    return weights
+
+
+
+## prediction
+
+def interpolated_tracer_vectors(weights, neighbour_tracer_vectors):
+    number_of_tracers = len(neighbour_tracer_vectors[0])
+    tracer_vectors = []
+    for i in range(number_of_tracers):
+        tracer_vector = sum(weight * tracer_vectors_i[i] for weight, tracer_vectors_i in zip(weights, neighbour_tracer_vectors))
+        tracer_vectors.append(tracer_vector)
+    return tracer_vectors
+
+
+def taylor_tracer_vectors(parameters, base_parameters, base_tracer_vectors, partial_derivative_runs):
+    ## first order prediction with forward differences of partial derivative runs (list of parameters and tracer vectors)
+    parameters = np.asarray(parameters, dtype=np.float64)
+    base_parameters = np.asarray(base_parameters, dtype=np.float64)
+    tracer_vectors = [tracer_vector.copy() for tracer_vector in base_tracer_vectors]
+
+    for disturbed_parameters, disturbed_tracer_vectors in partial_derivative_runs:
+        disturbed_parameters = np.asarray(disturbed_parameters, dtype=np.float64)
+        parameter_index = np.where(disturbed_parameters != base_parameters)[0]
+        if len(parameter_index) != 1:
+            raise ValueError('Partial derivative run parameters {} have to be disturbed at exactly one index of {}.'.format(disturbed_parameters, base_parameters))
+        parameter_index = parameter_index[0]
+        h = disturbed_parameters[parameter_index] - base_parameters[parameter_index]
+        factor = (parameters[parameter_index] - base_parameters[parameter_index]) / h
+        if factor != 0:
+            for i in range(len(tracer_vectors)):
+                tracer_vectors[i] += factor * (disturbed_tracer_vectors[i] - base_tracer_vectors[i])
+
+    return tracer_vectors
+
+
+def predicted_tracer_vectors(parameters, neighbour_parameters, neighbour_tracer_vectors, typical_parameters, partial_derivative_runs=None):
+    ## use taylor prediction at nearest neighbour if partial derivative runs are available, otherwise interpolate neighbours
+    if partial_derivative_runs is not None:
+        logger.debug('Predicting tracer vectors with first order taylor expansion at {}.'.format(neighbour_parameters[0]))
+        tracer_vectors = taylor_tracer_vectors(parameters, neighbour_parameters[0], neighbour_tracer_vectors[0], partial_derivative_runs)
+    else:
+        weights = interpolation_weights(parameters, neighbour_parameters, typical_parameters)
+        logger.debug('Interpolating tracer vectors of {} neighbours with weights {}.'.format(len(weights), weights))
+        tracer_vectors = interpolated_tracer_vectors(weights, neighbour_tracer_vectors)
+
+    ## concentrations are not negative and total mass is the one of the nearest run
+    tracer_vectors = clipped_tracer_vectors(tracer_vectors, neighbour_tracer_vectors[0])
+    return tracer_vectors
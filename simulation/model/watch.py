@@ -0,0 +1,111 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+import util.logging
+
+logger = util.logging.logger
+
+
+## inotify constants (see <sys/inotify.h>)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+_LIBC = None
+
+def _inotify_libc():
+    global _LIBC
+
+    if _LIBC is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError) as exception:
+            logger.debug('Inotify is not available: {}'.format(exception))
+            libc = False
+        _LIBC = libc
+
+    if _LIBC is False:
+        return None
+    else:
+        return _LIBC
+
+
+def backoff_pause_seconds(pause_seconds_min, pause_seconds_max, factor=2):
+    pause_seconds = pause_seconds_min
+    while True:
+        yield pause_seconds
+        pause_seconds = min(pause_seconds * factor, pause_seconds_max)
+
+
+
+class File_Watcher:
+
+    ## waits for file changes in dirs with inotify if available, else it just sleeps
+    ## (inotify does not notice changes made on other hosts of network file systems, so always wait with timeout)
+
+    def __init__(self, *dirs, watch_modifications=False):
+        self.fd = None
+
+        libc = _inotify_libc()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                logger.debug('Inotify could not be initialized: {}'.format(os.strerror(ctypes.get_errno())))
+            else:
+                mask = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB
+                if watch_modifications:
+                    mask = mask | IN_MODIFY
+                for dir in set(dirs):
+                    if libc.inotify_add_watch(fd, os.fsencode(dir), mask) < 0:
+                        logger.debug('Inotify could not watch {}: {}'.format(dir, os.strerror(ctypes.get_errno())))
+                        os.close(fd)
+                        fd = None
+                        break
+                self.fd = fd
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+    def wait(self, timeout):
+        timeout = max(timeout, 0)
+
+        ## sleep if inotify is not available
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+
+        ## wait for event
+        (readable, writable, exceptional) = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return False
+
+        ## read all events
+        try:
+            while len(os.read(self.fd, 4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+        return True